@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+    Sample script to benchmark the read throughput of the Chronos 1.4 RAW reader.
+
+    Usage:
+        python raw_read_benchmark.py [file.raw width height [bits_per_pixel]]
+
+    If no file is given, a synthetic 12-bit packed recording is written to the
+    temporary directory first. Run the script once against each installed version
+    of pySciCam to compare MB/s before and after a change to the reader.
+    Note that repeated runs will be served from the OS page cache, so the first
+    run after writing the file will be closest to raw disk speed.
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2017-2024 D.Duke
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    Code in this directory is subject to the GPL-3.0+ license, please see ../LICENSE
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2017-2024 D.Duke"
+
+
+try:
+    from pySciCam import chronos14_raw
+    import sys, os, time, tempfile
+    import numpy as np
+except ImportError as e:
+    print( "Missing module:",e )
+    exit()
+
+if len(sys.argv)>=4:
+    filename = sys.argv[1]
+    width = int(sys.argv[2])
+    height = int(sys.argv[3])
+    if len(sys.argv)>4: bits_per_pixel = int(sys.argv[4])
+    else: bits_per_pixel = 12
+else:
+    # 1280x1024 12-bit, 500 frames (~940 MiB)
+    width=1280; height=1024; bits_per_pixel=12; nframes=500
+    filename = os.path.join(tempfile.gettempdir(),'pySciCam_benchmark_12bit.raw')
+    if not os.path.isfile(filename):
+        print( "Writing synthetic test file",filename )
+        frame = np.random.randint(0,256,size=int(width*height*1.5),dtype=np.uint8)
+        with open(filename,'wb') as f:
+            for i in range(nframes): f.write(frame.tobytes())
+
+nbytes = os.path.getsize(filename)
+print( '-'*79 )
+print( "%s: %.1f MiB, %i x %i, %i-bit" % (filename,nbytes/1048576.,width,height,bits_per_pixel) )
+
+# Readers from before the nthreads argument was added unpack on a single thread.
+threaded = True
+for nthreads in sorted(set((1,os.cpu_count() or 1))):
+    if (nthreads > 1) and not threaded: break
+    for old_packing_order in (0,1):
+        kwargs = dict(bits_per_pixel=bits_per_pixel,old_packing_order=old_packing_order,quiet=1)
+        if threaded: kwargs['nthreads'] = nthreads
+        t0 = time.time()
+        try:
+            arr = chronos14_raw.read_chronos_raw(filename,width,height,**kwargs)
+        except TypeError:
+            if not threaded: raise
+            print( "This version of the reader has no nthreads argument (single-threaded)" )
+            threaded = False
+            del kwargs['nthreads']
+            t0 = time.time()
+            arr = chronos14_raw.read_chronos_raw(filename,width,height,**kwargs)
+        dt = time.time()-t0
+        print( "nthreads=%i old_packing_order=%i:\t%.2f sec\t%.1f MB/s"\
+               % (nthreads,old_packing_order,dt,nbytes/1e6/dt) )
+        del arr
+        if bits_per_pixel != 12: break
+
+print( '-'*79 )
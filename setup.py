@@ -24,14 +24,21 @@ __copyright__="Copyright (c) 2018-2024 D.Duke"
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
-import numpy
+import numpy, sys
 
 long_description = """Scientific and High speed camera file importer for Python. The aim of this code is to get your movie, imageset or binary blob into a usable NumPy array as quickly as possible. Uses a range  of libraries (PythonMagick, imageio, Pillow) to achieve widest compatibility and best performance for generic image and movie formats, with parallel file I/O where possible. Supports custom binary file formats for a range of scientific cameras."""
 
+# OpenMP for multi-threaded RAW unpacking (nthreads kwarg).
+# Apple's clang does not support -fopenmp, so the readers run serially there.
+if sys.platform == 'darwin': openmp_args = []
+else: openmp_args = ['-fopenmp']
+
 cython_modules = [
     Extension(
         "pySciCam.chronos14_raw",
         ["src/pySciCam/chronos14_raw.pyx"],
+        extra_compile_args = openmp_args,
+        extra_link_args = openmp_args
     ),
     Extension(
         "pySciCam.b16_raw",
@@ -40,6 +47,8 @@ cython_modules = [
     Extension(
         "pySciCam.photron_mraw",
         ["src/pySciCam/photron_mraw.pyx"],
+        extra_compile_args = openmp_args,
+        extra_link_args = openmp_args
     )
 ]
 
@@ -47,7 +56,10 @@ c_libraries = [
     Extension(
         "libbayer",
         sources = ["src/bayer/bayer.c"],
-        export_symbols = ["dc1394_bayer_decoding_8bit", "dc1394_bayer_decoding_16bit"]
+        export_symbols = ["dc1394_bayer_decoding_8bit", "dc1394_bayer_decoding_16bit",
+                          "dc1394_bayer_decoding_8bit_frames", "dc1394_bayer_decoding_16bit_frames"],
+        extra_compile_args = openmp_args,
+        extra_link_args = openmp_args
     )
 ]
 
@@ -2031,6 +2031,84 @@ dc1394_bayer_decoding_16bit(const uint16_t *restrict bayer, uint16_t *restrict r
 
 }
 
+/**************************************************************
+ *   Batched decoding of a stack of frames, added for pySciCam  *
+ **************************************************************/
+
+/* Frame f of the mosaic is read from bayer + f*in_strides[0], with pixel (x,y)
+ * at x*in_strides[1] + y*in_strides[2]. Decoded pixel (x,y), channel c of frame f
+ * is written to rgb + f*out_strides[0] + c*out_strides[1] + x*out_strides[2]
+ * + y*out_strides[3]. Strides are in elements, not bytes. Each frame is copied
+ * into a contiguous buffer, decoded as by dc1394_bayer_decoding_8bit/16bit and
+ * copied out, so any layout of numpy array can be passed without copying it first.
+ * Frames are decoded in parallel on nthreads OpenMP threads, each with its own
+ * buffers. Pixels the method leaves unset (ie. borders) are zero.
+ * Returns the error of a frame that failed, if any. */
+
+#define BAYER_BLOCK 32
+
+#define DEFINE_BAYER_FRAMES(NAME, T, DECODE)                                        \
+dc1394error_t                                                                       \
+NAME(const T *bayer, T *rgb, uint32_t nframes, uint32_t sx, uint32_t sy,            \
+     const int64_t *in_strides, const int64_t *out_strides,                         \
+     dc1394color_filter_t tile, dc1394bayer_method_t method, uint32_t bits,         \
+     int nthreads)                                                                  \
+{                                                                                   \
+    uint32_t osx = sx, osy = sy;                                                    \
+    dc1394error_t err = DC1394_SUCCESS;                                             \
+    if (method == DC1394_BAYER_METHOD_DOWNSAMPLE) { osx /= 2; osy /= 2; }           \
+    if (nthreads < 1) nthreads = 1;                                                 \
+                                                                                    \
+    _Pragma("omp parallel num_threads(nthreads)")                                   \
+    {                                                                               \
+        T *in = (T*)malloc((size_t)sx * sy * sizeof(T));                            \
+        T *out = (T*)calloc((size_t)3 * osx * osy, sizeof(T));                      \
+        long long f;                                                                \
+        _Pragma("omp for schedule(dynamic)")                                        \
+        for (f = 0; f < (long long)nframes; f++) {                                  \
+            const T *src = bayer + f * in_strides[0];                               \
+            T *dst = rgb + f * out_strides[0];                                      \
+            uint32_t x0, y0, x, y, c;                                               \
+            dc1394error_t e;                                                        \
+            if ((in == NULL) || (out == NULL)) {                                    \
+                e = DC1394_MEMORY_ALLOCATION_FAILURE;                               \
+            } else {                                                                \
+                /* gather, in blocks to stay in cache for any strides */            \
+                for (y0 = 0; y0 < sy; y0 += BAYER_BLOCK)                            \
+                    for (x0 = 0; x0 < sx; x0 += BAYER_BLOCK)                        \
+                        for (y = y0; (y < y0 + BAYER_BLOCK) && (y < sy); y++)       \
+                            for (x = x0; (x < x0 + BAYER_BLOCK) && (x < sx); x++)   \
+                                in[(size_t)y * sx + x] =                            \
+                                    src[x * in_strides[1] + y * in_strides[2]];     \
+                e = DECODE;                                                         \
+                /* scatter */                                                       \
+                if (e == DC1394_SUCCESS)                                            \
+                    for (y0 = 0; y0 < osy; y0 += BAYER_BLOCK)                       \
+                        for (x0 = 0; x0 < osx; x0 += BAYER_BLOCK)                   \
+                            for (y = y0; (y < y0 + BAYER_BLOCK) && (y < osy); y++)  \
+                                for (x = x0; (x < x0 + BAYER_BLOCK) && (x < osx); x++) \
+                                    for (c = 0; c < 3; c++)                         \
+                                        dst[c * out_strides[1] + x * out_strides[2] \
+                                            + y * out_strides[3]] =                 \
+                                            out[((size_t)y * osx + x) * 3 + c];     \
+            }                                                                       \
+            if (e != DC1394_SUCCESS) {                                              \
+                _Pragma("omp critical")                                             \
+                err = e;                                                            \
+            }                                                                       \
+        }                                                                           \
+        free(in);                                                                   \
+        free(out);                                                                  \
+    }                                                                               \
+    return err;                                                                     \
+}
+
+DEFINE_BAYER_FRAMES(dc1394_bayer_decoding_8bit_frames, uint8_t,
+                    dc1394_bayer_decoding_8bit(in, out, sx, sy, tile, method))
+
+DEFINE_BAYER_FRAMES(dc1394_bayer_decoding_16bit_frames, uint16_t,
+                    dc1394_bayer_decoding_16bit(in, out, sx, sy, tile, method, bits))
+
 #if 0
 dc1394error_t
 Adapt_buffer_bayer(dc1394video_frame_t *in, dc1394video_frame_t *out, dc1394bayer_method_t method)
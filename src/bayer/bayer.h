@@ -85,3 +85,10 @@ dc1394_bayer_decoding_8bit(const uint8_t * bayer, uint8_t * rgb, uint32_t sx, ui
 
 dc1394error_t
 dc1394_bayer_decoding_16bit(const uint16_t * bayer, uint16_t * rgb, uint32_t sx, uint32_t sy, dc1394color_filter_t tile, dc1394bayer_method_t method, uint32_t bits);
+
+/* Decode a stack of nframes frames with arbitrary strides, in parallel (see bayer.c) */
+dc1394error_t
+dc1394_bayer_decoding_8bit_frames(const uint8_t * bayer, uint8_t * rgb, uint32_t nframes, uint32_t sx, uint32_t sy, const int64_t * in_strides, const int64_t * out_strides, dc1394color_filter_t tile, dc1394bayer_method_t method, uint32_t bits, int nthreads);
+
+dc1394error_t
+dc1394_bayer_decoding_16bit_frames(const uint16_t * bayer, uint16_t * rgb, uint32_t nframes, uint32_t sx, uint32_t sy, const int64_t * in_strides, const int64_t * out_strides, dc1394color_filter_t tile, dc1394bayer_method_t method, uint32_t bits, int nthreads);
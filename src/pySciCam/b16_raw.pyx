@@ -26,6 +26,7 @@ __copyright__="Copyright (c) 2018-2024 D.Duke"
 
 import numpy as np
 import os
+import struct
 import time
 cimport cython
 cimport numpy as np
@@ -33,15 +34,17 @@ from libc.math cimport floor
 from libc.stdio cimport FILE, fopen, fclose, ftell, fread, fseek,\
                         SEEK_END, SEEK_SET, SEEK_CUR
 from libc.stdlib cimport malloc, free
-cdef FILE * cfile
 
 # this is the type of the output array.
 # should be 16 bit or greater.
 DTYPE = np.uint16
 ctypedef np.uint16_t DTYPE_t
 
+from . import frame_select
+
 def b16_read_header(char* fname):
-    cfile = fopen(fname, "rb")
+    cdef FILE * cfile = fopen(fname, "rb")
+    if cfile == NULL: raise IOError("Could not open file %s" % fname.decode("UTF-8"))
     cdef unsigned char * buffer = <unsigned char*>malloc(4)
     cdef int height, width, flag
     cdef unsigned int skipext = 0
@@ -75,101 +78,151 @@ def b16_read_header(char* fname):
 
 
 
-def b16_reader(filename,doubleExposure=True,quiet=0):
-    """ Read B16 or B16dat file specified by filename """
+# Gap in bytes between image blocks in B16dat files whose concatenated headers
+# cannot be parsed. This is the skip used by earlier versions of the reader.
+B16DAT_LEGACY_GAP = 2016
+
+def b16_layout(filename,doubleExposure=True):
+    """
+    Work out where the image data is in a B16 or B16dat file from its header(s),
+    without reading any pixels.
+    Returns (offsets, block_shape), where offsets is an array of byte offsets of
+    each image block, and block_shape is the shape of the frame(s) in one block.
+    B16 files have one block. B16dat files are a concatenation of B16 blocks.
+    """
+    cdef int height, width, skipext
+    cdef long nbytes_block, hbytes
+    height, width, nbytes_block, hbytes, skipext = b16_read_header(filename.encode("UTF-8"))
+    if nbytes_block < 1: raise IOError("Invalid B16 header in %s" % filename)
+    cdef long long filesize = os.path.getsize(filename)
+
+    offsets = [hbytes]
+    if os.path.splitext(filename)[1].lower() == '.b16dat':
+        # Walk the concatenated headers. Each one gives the header and block size.
+        pos = 0
+        stride = hbytes + nbytes_block
+        with open(filename,'rb') as f:
+            while True:
+                pos += stride
+                if pos + hbytes + nbytes_block > filesize: break
+                f.seek(pos)
+                hdr = f.read(12)
+                if hdr[:4] != b'PCO-':
+                    # Headers not found where expected: fall back to fixed gap
+                    stride = nbytes_block + B16DAT_LEGACY_GAP
+                    offsets = list(range(hbytes,filesize-nbytes_block+1,stride))
+                    break
+                filesize_field, hb = struct.unpack('<II',hdr[4:12])
+                if filesize_field - hb != nbytes_block:
+                    raise IOError("B16dat blocks have inconsistent sizes in %s" % filename)
+                offsets.append(pos + hb)
+                stride = filesize_field
+
+    if doubleExposure: block_shape = (2,height//2,width)
+    else: block_shape = (1,height,width)
+    return np.array(offsets,dtype=np.int64), block_shape
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def b16_reader(filename,doubleExposure=True,quiet=0,frames=None,roi=None,out=None):
+    """
+    Read B16 or B16dat file specified by filename.
+    For B16dat, frames selects blocks (image pairs if double exposed), as a
+    (start,end) tuple, slice or list of block numbers. Only the selected blocks
+    are read, each with a single call straight into the output array.
+    roi=(y1,y2,x1,x2) reads only those rows of each image, then keeps only
+    columns x1:x2 (inclusive bounds, as for ImageSequence.crop).
+    out is an optional preallocated array to read the images into.
+    """
 
     cdef double t0 = time.time()
-    cdef int width=1, height=1
-    cdef np.ndarray[DTYPE_t, ndim=1] images
-    cdef long nbytes = 0, nbytes_from_header = 0
-    cdef long hbytes = 0
-    cdef int nframes
-    cdef long long npix
-
-    is_b16dat = False
-    if os.path.splitext(filename)[1].lower() == '.b16':
-        # b16 file. Either 1 or 2 frames
-        if doubleExposure: nframes = 2
-        else: nframes = 1
-    else:
-        # nframes determined by file size!
-        is_b16dat = True
+    is_b16dat = os.path.splitext(filename)[1].lower() == '.b16dat'
+    offsets, block_shape = b16_layout(filename,doubleExposure)
+    cdef long long nblocks_file = len(offsets)
+    cdef long long block_bytes = 2*np.prod(block_shape)
+
+    if (quiet == 0) and not is_b16dat:
+        if doubleExposure:
+            print("Reading double exposure of %i x %i pixels" % (block_shape[2],block_shape[1]))
+        else:
+            print("Reading single exposure of %i x %i pixels" % (block_shape[2],block_shape[1]))
+
+    # Select blocks
+    if is_b16dat and (frames is not None):
+        offsets = offsets[frame_select.frame_indices(frames,nblocks_file,quiet)]
+    elif not is_b16dat:
+        offsets = offsets[:1]
+    cdef long long nblocks = len(offsets)
+
+    if (quiet == 0) and is_b16dat:
+        if doubleExposure:
+            print("Reading %i double exposed image pairs of %i x %i pixels"\
+                    % (nblocks,block_shape[2],block_shape[1]))
+        else:
+            print("Reading %i images of %i x %i pixels" % (nblocks,block_shape[2],block_shape[1]))
+
+    # Region of interest. Only the rows y1:y2 of each image are read.
+    roi = frame_select.check_roi(roi,block_shape[1],block_shape[2])
+    cdef long long nimg = block_shape[0], img_bytes = 2*block_shape[1]*block_shape[2]
+    cdef long long row0 = 0, roi_bytes = img_bytes
+    out_shape = block_shape
+    if roi is not None:
+        row0 = roi[0]
+        out_shape = (nimg,roi[1]-roi[0]+1,block_shape[2])
+        roi_bytes = 2*out_shape[1]*out_shape[2]
+        if quiet == 0: print("Reading region of interest %i x %i" % (roi[3]-roi[2]+1,out_shape[1]))
+
+    # Shape of the array returned. Single B16 files are trimmed after reading.
+    cdef bint direct = False
+    if is_b16dat or (frames is None):
+        if roi is None: ret_shape = (nblocks,)+out_shape
+        else: ret_shape = (nblocks,nimg,out_shape[1],roi[3]-roi[2]+1)
+        if not (is_b16dat and doubleExposure):
+            ret_shape = (nblocks*nimg,)+ret_shape[2:]
+        frame_select.check_out(out,ret_shape,DTYPE)
+        direct = (roi is None) and frame_select.direct_out(out,DTYPE)
+
+    # make new image array
+    cdef np.ndarray[DTYPE_t, ndim=4] images
+    if direct: images = out.reshape((nblocks,)+out_shape)
+    else: images = np.zeros((nblocks,)+out_shape,dtype=DTYPE)
+    cdef char * data = <char *> images.data
+    cdef long long[::1] off = offsets
+    cdef long long k, i, nread = 0
+    cdef long long row_bytes = 2*block_shape[2]
 
     filename_byte_string = filename.encode("UTF-8")
     cdef char * fname = filename_byte_string
-    cdef unsigned char * buffer = <unsigned char*>malloc(4)
-    cdef long hb
-    cdef unsigned int mb, skipext, block, npixels, flag
-    cdef long long i
-
-    height, width, nbytes_from_header, hbytes, skipext = b16_read_header(fname)
-    nbytes = nbytes_from_header
-
-
-    if (skipext==1) and (quiet==0):
-        print("\nSkipping extended header")
-
-    # div by 2 for double exposure!
-    if doubleExposure:
-        height /= 2
-        if (quiet == 0) and not is_b16dat:
-            print("Reading double exposure of %i x %i pixels" % (width,height))
-    else:
-        if (quiet == 0) and not is_b16dat:
-            print("Reading single exposure of %i x %i pixels" % (width,height))
-
-    cfile = fopen(fname, "rb")
-    if cfile:
-
-        if is_b16dat:
-            # Find true length of file
-            fseek (cfile, 0, SEEK_END)
-            nbytes = ftell(cfile)
-
-            # Find total num frames
-            if doubleExposure:
-                nframes = int(floor((nbytes-hbytes/2)/2/height/width))
-            else:
-                nframes = int(floor((nbytes-hbytes)/2/height/width))
-
-            if quiet == 0:
-                if doubleExposure:
-                    print("Reading %i double exposed image pairs of %i x %i pixels"\
-                            % (nframes/2,width,height))
-                else:
-                    print("Reading %i images of %i x %i pixels" % (nframes,width,height))
-
-        # Skip to end of (first) header
-        fseek (cfile, 1024, SEEK_SET)
-
-        # make new image array (flattened)
-        npix = nframes
-        npix *= height
-        npix *= width
-        images = np.zeros(npix,dtype=DTYPE)
-
-        # Size of b16 pixel blocks in b16dat
-        block = int(nbytes_from_header/2)
-        # Total number of pixels
-        npixels = int(nframes*height*width)
-
-        # Read pixel buffer
-        for i in xrange(npixels):
-            flag = fread (&buffer, 1, 2, cfile)
-            mb = <int>buffer & 0xFFFF
-            images[i] = <DTYPE_t>mb
-
-            # B16dat - skip concatenated header
-            if is_b16dat:
-                if (i%block == 0) and (i>0):
-                    fseek (cfile, 2014, SEEK_CUR)
-
+    cdef FILE * cfile = fopen(fname, "rb")
+    if cfile == NULL:
+        raise IOError("Could not open file %s" % filename)
+    with nogil:
+        if roi_bytes == img_bytes:
+            for k in range(nblocks):
+                if fseek(cfile, off[k], SEEK_SET) != 0: break
+                nread += fread(data + k*block_bytes, 1, block_bytes, cfile)
+        else:
+            for k in range(nblocks):
+                for i in range(nimg):
+                    if fseek(cfile, off[k] + i*img_bytes + row0*row_bytes, SEEK_SET) != 0: break
+                    nread += fread(data + (k*nimg + i)*roi_bytes, 1, roi_bytes, cfile)
     fclose(cfile)
 
-    if quiet == 0: print('Read %.1f MiB in %.1f sec' % (nbytes/1048576,time.time()-t0))
-
-    # Return 3D array (un-flatten the output)
-    if is_b16dat and doubleExposure:
-        return images.reshape((int(nframes/2),2,height,width))
-    else:
-        return images.reshape((nframes,height,width))
+    if quiet == 0: print('Read %.1f MiB in %.1f sec' % (nread/1048576,time.time()-t0))
+
+    # Columns of the region of interest
+    frames_out = images
+    if roi is not None:
+        frames_out = np.ascontiguousarray(images[...,roi[2]:roi[3]+1])
+
+    # Return 3D array for single images, 4D array of image pairs for double exposed B16dat
+    if not (is_b16dat and doubleExposure):
+        frames_out = frames_out.reshape((nblocks*nimg,frames_out.shape[2],frames_out.shape[3]))
+        if not is_b16dat and (frames is not None):
+            frames_out = frames_out[frame_select.frame_indices(frames,frames_out.shape[0],quiet)]
+    if direct: return out
+    if out is None: return frames_out
+    frame_select.check_out(out,frames_out.shape,DTYPE)
+    out[...] = frames_out
+    return out
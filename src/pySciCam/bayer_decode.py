@@ -26,7 +26,8 @@ __copyright__="Copyright (c) 2018-2024 D.Duke"
 
 import site, itertools, glob
 import numpy as np
-import importlib
+import importlib.util
+from . import image_sequence_handler
 
 dc1394bayer_methods = ['DC1394_BAYER_METHOD_NEAREST', 'DC1394_BAYER_METHOD_SIMPLE',
                        'DC1394_BAYER_METHOD_BILINEAR', 'DC1394_BAYER_METHOD_HQLINEAR',
@@ -37,77 +38,93 @@ dc1394color_filters = ['DC1394_COLOR_FILTER_RGGB','DC1394_COLOR_FILTER_GBRG',
                        'DC1394_COLOR_FILTER_GRBG','DC1394_COLOR_FILTER_BGGR']
 
 # Import required ctypes
-from ctypes import cdll, c_uint, c_uint8, c_uint16, c_uint32, POINTER
+from ctypes import cdll, c_int, c_int64, c_uint, c_uint8, c_uint16, c_uint32, c_void_p, POINTER
+
+# libbayer, loaded on first use (once per process).
+__libbayer__ = None
 
 ##########################################################################################
-# internal Parallel wrapper to bayer-decode a some frames.
-# arguments are defined in fbayerDecode.
-def __libbayer_wrapper__(frames,s,enum_tile,enum_method,bits,C_UINT_T,out_nx,out_ny,libpath):
+# Find and load libbayer (should be built as extension by setuptools)
+def __load_libbayer__():
+    global __libbayer__
+    if __libbayer__ is None:
+        try:
+            path_to_libbayer = importlib.util.find_spec("libbayer").origin
+        except (AttributeError,ImportError,ValueError):
+            raise IOError("Can't find libbayer, bayer decode aborted")
+        __libbayer__ = cdll.LoadLibrary(path_to_libbayer)
+    return __libbayer__
 
-    # Load library in this thread
-    libbayer = cdll.LoadLibrary(libpath)
-    
-    # allocate memory for output frame and make pointer to it
-    frame_out = np.zeros((3*out_nx*out_ny),dtype=frames.dtype)
-    rgb_out = frame_out.ctypes.data_as(POINTER(C_UINT_T * (3 * s[1] * s[2])))
-    
-    # determine which function to run (can't pickle a function and send thru Joblib!)
-    if C_UINT_T is c_uint16: func = libbayer.dc1394_bayer_decoding_16bit
-    elif C_UINT_T is c_uint8: func = libbayer.dc1394_bayer_decoding_8bit
-    else: raise ValueError("Unhandled dtype "+str(arr.dtype)+" for bayer decode")
+##########################################################################################
+# internal wrapper to bayer-decode some frames, of shape (nframes,nx,ny).
+# Frames are written into out (nframes,3,out_nx,out_ny), which is a slice of the
+# output array when running in threads. With out=None a new array is returned.
+# The decoder works on one frame at a time in two buffers that are reused for every
+# frame. It reads the mosaic in Fortran order, so each frame is transposed into the
+# input buffer, and the result transposed back to channel,x,y for pySciCam.ImageSequence.
+def __libbayer_wrapper__(frames,enum_tile,enum_method,bits,out_nx,out_ny,out=None):
+
+    libbayer = __load_libbayer__()
+    if frames.dtype == np.uint16:
+        func = libbayer.dc1394_bayer_decoding_16bit
+        C_UINT_T = c_uint16
+    elif frames.dtype == np.uint8:
+        func = libbayer.dc1394_bayer_decoding_8bit
+        C_UINT_T = c_uint8
+    else: raise ValueError("Unhandled dtype "+str(frames.dtype)+" for bayer decode")
+    if out is None: out = np.empty((frames.shape[0],3,out_nx,out_ny),dtype=frames.dtype)
     
-    # make ctypes for sx, sy
-    sx = c_uint32(s[1])
-    sy = c_uint32(s[2])
+    # input and output buffers and pointers to them
+    nx, ny = frames.shape[1:]
+    frame_in = np.empty((ny,nx),dtype=frames.dtype)
+    frame_out = np.zeros((out_ny,out_nx,3),dtype=frames.dtype) # edges may not be written
+    bayer_in = frame_in.ctypes.data_as(POINTER(C_UINT_T))
+    rgb_out = frame_out.ctypes.data_as(POINTER(C_UINT_T))
+    sx = c_uint32(nx)
+    sy = c_uint32(ny)
     
-    # decode one frame
-    if len(frames.shape)==2:
-        # allocate memory for input frame and make pointer to it
-        frame_in = np.asfortranarray(frames)
-        bayer_in = frame_in.ctypes.data_as(POINTER(C_UINT_T * (s[1] * s[2])))
-        # run decode
+    for i in range(frames.shape[0]):
+        np.copyto(frame_in, frames[i].T)
+        # run decode. ctypes releases the GIL, so threads decode in parallel.
         flag = func(bayer_in, rgb_out, sx, sy, enum_tile, enum_method, bits)
         if flag != 0: raise ValueError("Bayer decode error %i" % flag)
-        # return array re-ordered to channel,x,y for pySciCam.ImageSequence
-        return np.moveaxis( frame_out.reshape(out_ny,out_nx,3) , [0,1,2], [2,1,0] )
-
-    # decode several frames
-    elif len(frames.shape)==3:
-        frames_out = np.zeros((frames.shape[0],3,out_nx,out_ny),dtype=frames.dtype)
-        for i in range(frames.shape[0]):
-            # allocate memory for input frame and make pointer to it
-            frame_in = np.asfortranarray(frames[i,...])
-            bayer_in = frame_in.ctypes.data_as(POINTER(C_UINT_T * (s[1] * s[2])))
-            
-            # run decode
-            flag = func(bayer_in, rgb_out, sx, sy, enum_tile, enum_method, bits)
-            if flag != 0: raise ValueError("Bayer decode error %i" % flag)
-
-            # write array re-ordered to channel,x,y for pySciCam.ImageSequence
-            frames_out[i,...] = np.moveaxis( frame_out.reshape(out_ny,out_nx,3) , [0,1,2], [2,1,0] )
+        np.copyto(out[i], frame_out.transpose(2,1,0))
+    return out
 
-        return frames_out
-
-    else: raise IndexError("Not sure how to handle input of shape "+str(frames.shape))
 
+##########################################################################################
+# Bayer-decode all frames of arr into out (nframes,3,out_nx,out_ny) with one call to
+# the batched decoder in libbayer, which reads arr and writes out through their strides
+# (so the C-ordered arrays from the RAW readers are used as they are) and decodes the
+# frames on nthreads OpenMP threads. Same results as __libbayer_wrapper__.
+def __libbayer_frames__(func,arr,out,enum_tile,enum_method,bits,nthreads):
+    if any([st % arr.itemsize for st in arr.strides]): arr = np.ascontiguousarray(arr)
+    in_strides = (c_int64 * 3)(*[st//arr.itemsize for st in arr.strides])
+    out_strides = (c_int64 * 4)(*[st//out.itemsize for st in out.strides])
+    flag = func(c_void_p(arr.ctypes.data), c_void_p(out.ctypes.data), c_uint32(arr.shape[0]),\
+                c_uint32(arr.shape[1]), c_uint32(arr.shape[2]), in_strides, out_strides,\
+                enum_tile, enum_method, bits, c_int(nthreads))
+    if flag != 0: raise ValueError("Bayer decode error %i" % flag)
+    return out
 
 ##########################################################################################
 """ Wrapper for DC1394 Bayer decoding C library.
     user must choose the interpolation method (see bayer_decode.dc1394bayer_methods)
     and the color filter for the camera (see bayer_decode.dc1394color_filters).
     Parallel decoding of multiple frames is supported by settings ncpus>1.
-    frame_chunk_size argument will give each processor a serial loop of that many
-    frames to work on. Larger numbers may be better for low resolution images.
+    If libbayer has the batched decoder (dc1394_bayer_decoding_*bit_frames), all
+    frames are decoded in one call on ncpus OpenMP threads, writing straight into
+    the output array. Otherwise IO_backend='threads' (default) decodes in a pool of
+    threads, each writing its frames straight into the output array.
+    IO_backend='processes' uses joblib, giving each process a serial loop of
+    frame_chunk_size frames which is then copied back. Larger numbers may be better
+    for low resolution images.
 """
 def fbayerDecode(arr, interpolation_method='DC1394_BAYER_METHOD_NEAREST',\
                  camera_filter='DC1394_COLOR_FILTER_RGGB',\
-                 ncpus=1,JobLib_Verbosity=5,frame_chunk_size=4):
+                 ncpus=1,JobLib_Verbosity=5,frame_chunk_size=4,IO_backend='threads',quiet=0):
 
-    # find libbayer (should be built as extension by setuptools)
-    try:
-        path_to_libbayer = [importlib.util.find_spec("libbayer").origin]
-    except:
-        raise IOError("Can't find libbayer, bayer decode aborted")
+    libbayer = __load_libbayer__()
     
     # validate method and tile choices
     if not interpolation_method.upper() in dc1394bayer_methods:
@@ -120,59 +137,55 @@ def fbayerDecode(arr, interpolation_method='DC1394_BAYER_METHOD_NEAREST',\
     else:
         enum_tile = c_uint(dc1394color_filters.index(camera_filter.upper()) + 512)
 
-    print('Bayer settings:',interpolation_method,',', camera_filter)
+    if quiet == 0: print('Bayer settings:',interpolation_method,',', camera_filter)
 
     # Check numpy array provided
-    try:
-        assert isinstance(arr,np.ndarray)
-        s=arr.shape
-        out_nx = s[1]
-        out_ny = s[2]
-    except IndexError:
-        raise IndexError("Image array must be at least 2D. Aborting bayer decode")
+    if not isinstance(arr,np.ndarray) or (arr.ndim != 3):
+        raise IndexError("Image array must be a stack of 2D frames. Aborting bayer decode")
+    s=arr.shape
+    out_nx = s[1]
+    out_ny = s[2]
 
     if interpolation_method.upper() == 'DC1394_BAYER_METHOD_DOWNSAMPLE':
-        out_nx /=2
-        out_ny /=2
+        out_nx //=2
+        out_ny //=2
 
     # Settings depending on 8 or 16 bit type.
     if arr.dtype == np.uint16:
         bits = c_uint32(16)
-        C_UINT_T = c_uint16
     elif arr.dtype == np.uint8:
         bits = c_uint32(8)
-        C_UINT_T = c_uint8
     else:
         raise ValueError("Cannot do bayer decoding on image array with dtype "+str(arr.dtype))
 
     # Check if worth it to run parallel
     if s[0] < ncpus: ncpus=1
-
-    # Run parallel over all frames
-    if ncpus > 1:
-        try:
-            from joblib import Parallel, delayed
-            # determine number of frames for each task to work on.
-            # trade-off between time to slice up arrays and time saved not re-initializing the wrapper function.
-            if s[0]/ncpus < frame_chunk_size: frame_chunk_size=int(s[0]/ncpus)
-            if frame_chunk_size < 1: frame_chunk_size = 1
-            # run parallel loop
-            frame_list = Parallel(n_jobs=ncpus,verbose=JobLib_Verbosity)(delayed(__libbayer_wrapper__)(arr[i:i+frame_chunk_size,...],s,enum_tile,enum_method,bits,C_UINT_T,out_nx,out_ny,\
-                 path_to_libbayer[0]) for i in range(0,s[0],frame_chunk_size))
-            # repack data into 4D array
-            if len(frame_list[0].shape) == 3: newarr = np.stack(frame_list,axis=0)
-            elif len(frame_list[0].shape) == 4: newarr = np.vstack(frame_list)
-            else: raise IndexError("output from joblib in libbayer_wrapper has wrong number of dimensions")
-            del frame_list
-        except ImportError:
-            print('Unable to load joblib module for parallel processing. Falling back to serial')
-            ncpus=1
-
-    # Run serially
-    if ncpus <= 1:
-    
-        newarr = np.stack(__libbayer_wrapper__(arr,s,enum_tile,enum_method,bits,C_UINT_T,out_nx,out_ny,\
-                                               path_to_libbayer[0]),axis=0)
+    if ncpus <= 1: IO_backend = 'serial'
+    newarr = np.empty((s[0],3,out_nx,out_ny),dtype=arr.dtype)
+
+    # Batched decoder, if this build of libbayer has it
+    batched = getattr(libbayer,'dc1394_bayer_decoding_%ibit_frames' % bits.value,None)
+
+    if (batched is not None) and (IO_backend != 'processes'):
+        if IO_backend == 'serial': ncpus = 1
+        __libbayer_frames__(batched,arr,newarr,enum_tile,enum_method,bits,ncpus)
+    elif IO_backend == 'processes':
+        # determine number of frames for each task to work on.
+        # trade-off between time to slice up arrays and time saved not re-initializing the wrapper function.
+        if s[0]/ncpus < frame_chunk_size: frame_chunk_size=int(s[0]/ncpus)
+        if frame_chunk_size < 1: frame_chunk_size = 1
+        starts = range(0,s[0],frame_chunk_size)
+        tasks = [(arr[i:i+frame_chunk_size],enum_tile,enum_method,bits,out_nx,out_ny) for i in starts]
+        frame_list = image_sequence_handler.__run_tasks__(__libbayer_wrapper__,tasks,ncpus,\
+                                                          IO_backend,JobLib_Verbosity)
+        # repack data into 4D array
+        for i,chunk in zip(starts,frame_list): newarr[i:i+chunk.shape[0]] = chunk
+        del frame_list
+    else:
+        # one contiguous block of frames per thread, decoded in place
+        bounds = np.linspace(0,s[0],ncpus+1).astype(int)
+        tasks = [(arr[a:b],enum_tile,enum_method,bits,out_nx,out_ny,newarr[a:b])\
+                 for a,b in zip(bounds[:-1],bounds[1:]) if b > a]
+        image_sequence_handler.__run_tasks__(__libbayer_wrapper__,tasks,ncpus,IO_backend)
 
     return newarr
-
@@ -15,6 +15,8 @@
     Firmware <= 0.3.0 writes a different 12 bit packing order to >=0.3.1. Those older files
     can be read by setting the flag old_packing_order=1.
 
+    See frame_select for the frames, roi and out arguments.
+
     Support for color formats requires Bayer decoding post-loading.
     Note that the Chronos' internal software uses a different Bayer decoding scheme
     and images saved as RGB on the camera will not be identical as those saved RAW.
@@ -38,20 +40,24 @@ cimport numpy as np
 from libc.math cimport floor, ceil
 from libc.stdio cimport FILE, fopen, fclose, fread, fseek, SEEK_END, SEEK_SET, SEEK_CUR
 from libc.stdlib cimport malloc, free
-cdef FILE * cfile
 
 # this is the type of the output array.
 # should be 16 bit or greater.
 DTYPE = np.uint16
 ctypedef np.uint16_t DTYPE_t
 
+from . import frame_select
+
+include "raw_unpack.pxi"
+
+
 @cython.cdivision(True)
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-def read_chronos_raw(filename, int width, int height, tuple frames=None,\
+def read_chronos_raw(filename, int width, int height, frames=None,\
                      int bits_per_pixel=12, long long start_offset = 0, int quiet = 0,\
-                     int old_packing_order = 0):
+                     int old_packing_order = 0, int nthreads = 1, roi = None, out = None):
 
     cdef double t0 = time.time()
     cdef double bytes_per_pixel = bits_per_pixel/8.0
@@ -59,27 +65,17 @@ def read_chronos_raw(filename, int width, int height, tuple frames=None,\
     # width and height MUST be specified.
     if (width is None) or (height is None):
         raise ValueError("RAW reader requires height and width")
+    if (bits_per_pixel != 12) and (bits_per_pixel != 16):
+        raise ValueError("Unknown bits_per_pixel=%i" % bits_per_pixel)
+    if (bits_per_pixel == 12) and ((width*height) % 2 != 0):
+        raise ValueError("12-bit packed RAW requires an even number of pixels per frame")
 
     # Get size of binary file before we start reading
     # (it might be smaller than we think)
     cdef long long nbytes = os.path.getsize(filename)
 
-    # Scanlines are padded to nearest 16 bytes
-    cdef unsigned int scanline_pad = 0 #int((width*1.5)%16)  # disabled for debugging
-    cdef unsigned int scanline_bytes = int(width*1.5) + scanline_pad
-    
-    # Bytes padding between frames
-    cdef int frame_pad =0
-    if scanline_pad > 0: frame_pad = 0
-
-    cdef int bytes_per_frame = int(height*width*bytes_per_pixel) \
-                            + scanline_pad*height + frame_pad
-
-    # Given the supplied width and height, determine number of frames
-    cdef int nframes =  int(floor(nbytes/bytes_per_frame))
-
-    if nframes < 1 : raise IOError("File has no frames at specified resolution")
-
+    # Chronos scanlines and frames are not padded.
+    cdef long long bytes_per_frame = (<long long>width*height*bits_per_pixel)/8
 
     # check start_offset
     if start_offset < 0:
@@ -89,6 +85,12 @@ def read_chronos_raw(filename, int width, int height, tuple frames=None,\
     if (quiet == 0) and (start_offset > 0):
         print('Offset by %i bytes' % start_offset)
 
+    # Given the supplied width and height, determine number of frames
+    cdef int nframes =  int(floor((nbytes-start_offset)/bytes_per_frame))
+
+    if nframes < 1 : raise IOError("File has no frames at specified resolution")
+
+
     if quiet == 0: print("File contains %i frames (%i x %i)" % (nframes,width,height))
     cdef int remainder_bytes = np.mod(nbytes,bytes_per_pixel*width*height)
     if remainder_bytes > 0:
@@ -96,100 +98,69 @@ def read_chronos_raw(filename, int width, int height, tuple frames=None,\
 
 
 
-    # Limit number of frames loaded from file (good for testing)
-    cdef long long start = start_offset # bytes
-    cdef long long end = nbytes
-    if frames is not None:
-        if frames[1] > 0:
-            start = start_offset + int(bytes_per_frame*frames[0])
-            end = start_offset + int(bytes_per_frame*frames[1])
-        if start > nbytes:
-            raise ValueError("frame range: Cannot start reading beyond end of file!")
-        if end > nbytes:
-            print("Warning: requested read past EOF, truncating")
-            end = nbytes
-        if quiet == 0: print("Reading frames %i to %i" % frames)
-        nframes = frames[1]-frames[0]
+    # Select frames to load. Only these are read from the file.
+    indices = frame_select.frame_indices(frames, nframes, quiet)
+    if (quiet == 0) and (frames is not None):
+        print("Reading %s" % frame_select.describe(indices))
+    nframes = len(indices)
+
+    # Region of interest (inclusive bounds)
+    roi = frame_select.check_roi(roi, height, width)
+    cdef int out_height = height, out_width = width
+    if roi is not None:
+        out_height = roi[1]-roi[0]+1
+        out_width = roi[3]-roi[2]+1
+        if quiet == 0: print("Reading region of interest %i x %i" % (out_width,out_height))
 
     # make new image array (flattened)
     cdef long long npix = nframes
-    npix *= height
-    npix *= width
-    cdef np.ndarray[DTYPE_t, ndim=1] images = np.zeros(npix,dtype=DTYPE)
-
-    # read array in
-    cdef long long i
-    cdef int flag
-    cdef int npixels = int(ceil((end-start)/bytes_per_pixel))
-    filename_byte_string = filename.encode("UTF-8")
-    cdef char * fname = filename_byte_string
-    cdef unsigned char * buffer = <unsigned char*>malloc(3)
-    cdef unsigned int buf2
-
-    cfile = fopen(fname, "rb")
-    if cfile:
-        if start>0: fseek (cfile, start, SEEK_SET)
-
-        # READ 16 BIT RAW IMAGES
-        if bits_per_pixel==16: # loop every 2 bytes, write 1 pixel
-            for i in xrange(0,len(images)):
-                flag = fread (&buffer, 1, 2, cfile)
-                buf2 = <int>buffer
-                images[i]   = <DTYPE_t>(buf2 & 0xFFFF)
-
-                # Debugging - show buffer
-                # print '%i %06x %04x' % (i, buf2 & 0xFFFFFF, images[i])
-                # if i >= 10:
-                #     fclose(cfile)
-                #     return images.reshape((nframes,height,width))
-                # End debugging block
-
-        # READ 12 BIT IMAGES (PACKED RAW)
-        elif bits_per_pixel==12: # loop every 3 bytes, read 2 pixels
-
-            if old_packing_order==1: # firmware <= 0.3.0
-
-                for i in xrange(0,len(images)-1,2):
-                    flag = fread (&buffer, 1, 3, cfile)
-                    buf2 = <int>buffer
-
-                    # Read two pixels from three bytes
-                    # Given a pair of two 12-bit pixels in hexidecmal as (0x123, 0xabc),
-                    # v0.3.0 and earlier: (0xab, 0xc1, 0x23)
-                    images[i]   = <DTYPE_t>(((buf2 & 0xFF) << 4) | ((buf2 & 0xF000) >> 12)  )
-                    images[i+1] = <DTYPE_t>(((buf2 & 0xFF0000) >> 16) | (buf2 & 0xF00) )
-
-                    # Scanline padded to nearest 16 bytes
-                    if (i>0) and (i%width==0):
-                        fseek (cfile, scanline_pad, SEEK_CUR)
-                        if (i%(width*height)==0):
-                            fseek (cfile, frame_pad, SEEK_CUR)
-
-            else: # firmware >= 0.3.1 packing
-
-                for i in xrange(0,len(images)-1,2):
-                    flag = fread (&buffer, 1, 3, cfile)
-                    buf2 = <int>buffer
-
-                    # Read two pixels from three bytes
-                    # Given a pair of two 12-bit pixels in hexidecmal as (0x123, 0xabc),
-                    #v0.3.1 and later: (0x23, 0x1c, 0xab)
-                    images[i]   = <DTYPE_t>((buf2 & 0xFF) | ((buf2 & 0xF000) >> 4)  )
-                    images[i+1] = <DTYPE_t>(((buf2 & 0xFF0000) >> 12) | (buf2 & 0xF00) >> 8 )
-
-                    # Debugging - show buffer
-                    # print '%i %06x %03x %03x' % (i, buf2 & 0xFFFFFF, images[i], images[i+1])
-                    # if i >= 10:
-                    #     fclose(cfile)
-                    #     return images.reshape((nframes,height,width))
-                    # End debugging block
-
-        else: print("Unknown bits_per_pixel=",bits_per_pixel)
-
-    fclose(cfile)
-
-    if quiet == 0: print('Read %.1f MiB in %.1f sec' % ((end-start)/1048576,time.time()-t0))
+    npix *= out_height
+    npix *= out_width
+    shape = (nframes,out_height,out_width)
+    frame_select.check_out(out, shape, DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=1] images
+    if frame_select.direct_out(out, DTYPE): images = out.reshape(-1)
+    else: images = np.zeros(npix,dtype=DTYPE)
+    cdef DTYPE_t * data = <DTYPE_t *> images.data
+
+    # Read the file in large blocks of whole frames and unpack each block
+    # with the GIL released, optionally on several threads.
+    # With a region of interest, only the scanlines needed are read.
+    cdef int mode
+    if bits_per_pixel == 16: mode = UNPACK_16BIT
+    elif old_packing_order == 1: mode = UNPACK_12BIT_MSB
+    else: mode = UNPACK_12BIT
+    if (quiet == 0) and (nthreads > 1): print("Unpacking on %i threads" % nthreads)
+    cdef long long pos
+    cdef int pair0, npairs
+    cdef np.ndarray[DTYPE_t, ndim=1] pairs
+    if roi is None:
+        pos = read_frame_blocks(filename.encode("UTF-8"), data, start_offset,\
+                                frame_select.frame_runs(indices), 1,\
+                                bytes_per_frame, 0, <long long>width*height,\
+                                mode, nthreads)
+    elif (bits_per_pixel == 12) and (width % 2 != 0):
+        # With an odd width, every other 12-bit scanline starts half way through a byte.
+        # Read the wanted scanlines in byte-aligned pairs, then crop.
+        pair0 = roi[0]//2
+        npairs = roi[1]//2 - pair0 + 1
+        pairs = np.zeros(nframes*npairs*2*width, dtype=DTYPE)
+        pos = read_frame_blocks(filename.encode("UTF-8"), <DTYPE_t *> pairs.data, start_offset,\
+                                frame_select.frame_runs(indices), height//2,\
+                                3*width, 0, 2*width, mode, nthreads, (pair0, npairs, 0, 2*width))
+        images.reshape(shape)[...] = pairs.reshape((nframes,2*npairs,width))\
+                                     [:,roi[0]-2*pair0:roi[0]-2*pair0+out_height,roi[2]:roi[3]+1]
+    else:
+        pos = read_frame_blocks(filename.encode("UTF-8"), data, start_offset,\
+                                frame_select.frame_runs(indices), height,\
+                                (<long long>width*bits_per_pixel)//8, 0, width,\
+                                mode, nthreads, (roi[0], out_height, roi[2], out_width))
+
+    cdef double dt = time.time()-t0
+    if quiet == 0: print('Read %.1f MiB in %.1f sec (%.1f MiB/s)' % (pos/1048576,dt,\
+                                                                    pos/1048576/max(dt,1e-9)))
 
     # Return 3D array (un-flatten the output)
-    return images.reshape((nframes,height,width))
-
+    if out is None: return images.reshape(shape)
+    if not frame_select.direct_out(out, DTYPE): out[...] = images.reshape(shape)
+    return out
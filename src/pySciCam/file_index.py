@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Directory listing and index files for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    Directories holding hundreds of thousands of images (ie. on network storage)
+    are listed with a single pass of os.scandir, which picks out the files with
+    the image extension as it goes. Only the file names are sorted.
+    Nothing is read from the files themselves, so selecting frames from the
+    listing (the frames kwarg) is all done before any file is opened.
+
+    The sorted listing can also be saved to an index file, by default
+    .pySciCam_index inside the directory. It is reused for as long as the
+    directory's modification time is unchanged, which is the case until files
+    are added, removed or renamed.
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import os, re
+
+# Default index file name, in the directory it lists.
+INDEX_NAME = '.pySciCam_index'
+INDEX_HEADER = 'pySciCam index 2'
+
+####################################################################################
+# Natural sort key, ie. im_2.tif before im_10.tif. Gives the same order as natsort's
+# default natsorted, in about half the time for very long listings.
+__split_digits__ = re.compile(r'(\d+)').split
+
+def natural_key(name):
+    parts = __split_digits__(name)
+    parts[1::2] = map(int,parts[1::2])
+    return parts
+
+####################################################################################
+# One pass over the directory. Returns (extension, file names with that extension),
+# where extension is the first in extensions found in the listing.
+def __scan__(path,extensions):
+    ext = None
+    names = []
+    with os.scandir(path) as it:
+        for entry in it:
+            name = entry.name
+            # Hidden files, ie. macOS AppleDouble ._frame0001.tif, as for glob('*')
+            if name.startswith('.'): continue
+            i = name.rfind('.')
+            if i <= 0: continue
+            e = name[i:].lower()
+            if ext is None:
+                if not e in extensions: continue
+                ext = e
+            if e == ext: names.append(name)
+    return ext, names
+
+# Read index file. Returns (extension, sorted names), or None if it is missing
+# or was written for another directory or an earlier state of this one.
+def __read_index__(index_file,path,mtime_ns):
+    try:
+        with open(index_file,'r',encoding='UTF-8') as f:
+            lines = f.read().split('\n')
+    except (IOError,UnicodeDecodeError):
+        return None
+    header = lines[0].split('\t')
+    if (len(header) != 4) or (header[0] != INDEX_HEADER) or (header[1] != path) or\
+       (header[2] != str(mtime_ns)):
+        return None
+    ext = header[3]
+    if ext == '': return None, []
+    return ext, lines[1:]
+
+# Write index file, recording mtime_ns, the directory's mtime from before it was scanned.
+# Creating the index file inside the directory changes the directory's mtime. If that
+# is the only change since the scan, the mtime after it is recorded instead, so that
+# the index is used next time. The directory's mtime is then the same as the time the
+# index file was created, and a file added in between would make it later.
+def __write_index__(index_file,path,ext,names,mtime_ns):
+    try:
+        before = os.stat(path).st_mtime_ns
+        with open(index_file,'w',encoding='UTF-8') as f:
+            after = os.stat(path).st_mtime_ns
+            if (before == mtime_ns) and (after == os.fstat(f.fileno()).st_ctime_ns):
+                mtime_ns = after
+            f.write('%s\t%s\t%i\t%s\n' % (INDEX_HEADER,path,mtime_ns,ext or ''))
+            f.write('\n'.join(names))
+    except IOError as e:
+        print("\tCould not write index file: %s" % e)
+    return
+
+####################################################################################
+def list_directory(path,extensions,index_file=False):
+    """
+    List the image files in directory path, in natural order.
+    The extension used is the first of extensions found in the directory, and
+    only files with that extension are listed.
+    index_file: False to always list the directory, True to keep the listing in
+        INDEX_NAME inside the directory, or the name of the index file to use
+        (ie. on a local disk if the directory is read-only).
+    Returns (extension, list of file paths), or (None, []) if no files match.
+    """
+    abspath = os.path.abspath(path)
+    if index_file is True: index_file = os.path.join(path,INDEX_NAME)
+    # Taken before the scan, so that files added during it invalidate the index.
+    mtime_ns = os.stat(path).st_mtime_ns
+    if index_file:
+        listing = __read_index__(index_file,abspath,mtime_ns)
+        if listing is not None:
+            ext, names = listing
+            return ext, [os.path.join(path,n) for n in names]
+
+    ext, names = __scan__(path,extensions)
+    names.sort(key=natural_key)
+    if index_file: __write_index__(index_file,abspath,ext,names,mtime_ns)
+    return ext, [os.path.join(path,n) for n in names]
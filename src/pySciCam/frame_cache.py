@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    On-disk cache of decoded image sequences for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    When ImageSequence is given cache_dir, each decoded array is saved there as a
+    .npy file, with the attributes the loader set (src_bpp, fps etc) alongside.
+    Opening the same recording again with the same settings maps the .npy file
+    (copy-on-write, so changes to the array don't reach the cache) instead of
+    reading and decoding the recording again.
+
+    Entries are keyed by the path, size and modification time of each file read,
+    the frames selected and every load setting that changes the array (rawtype,
+    dtype, monochrome, roi etc). Editing or replacing a recording gives a new key.
+    When the cache grows past cache_size bytes, the least recently used entries
+    are deleted. Each hit updates the entry's modification time.
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import os, hashlib, pickle, tempfile
+import numpy as np
+from . import frame_select
+from . import tiff_reader
+from . import photron_cih
+
+# Default size limit of the cache directory, in bytes.
+DEFAULT_CACHE_SIZE = 16*1024**3
+
+# Load settings that don't change the array loaded, so are left out of the key.
+IGNORED_SETTINGS = ['nthreads','defer_bayer']
+
+# ImageSequence attributes that are not saved with the array.
+IGNORED_ATTRIBUTES = ['arr','N','files','load_settings','IO_threads','Joblib_Verbosity','IO_backend',\
+                      'IO_backend_default']
+
+####################################################################################
+# Hashable description of a frames selection.
+def __frames_key__(frames):
+    if (frames is None) or isinstance(frames,(slice,tuple)): return repr(frames)
+    frames = np.asarray(frames)
+    return frames.dtype.str+hashlib.sha1(frames.tobytes()).hexdigest()
+
+def cache_key(all_images,frames,ext,settings):
+    """
+    Key for loading frames of all_images with the given load settings.
+    For sequences of files (or pages), only the selected files are part of the key.
+    """
+    if len(all_images) > 1:
+        all_images = [all_images[i] for i in frame_select.frame_indices(frames,len(all_images),quiet=1)]
+        frames = None
+    settings = dict((k,v) for k,v in settings.items() if not k in IGNORED_SETTINGS)
+    if settings.get('dtype') is not None: settings['dtype'] = np.dtype(settings['dtype']).str
+    h = hashlib.sha1(repr((__version__,ext,__frames_key__(frames),sorted(settings.items()))).encode())
+    stats = {}
+    for fn in all_images:
+        filename, page = tiff_reader.split_page(fn)
+        if not filename in stats: stats[filename] = os.stat(filename)
+        st = stats[filename]
+        h.update(('%s\t%s\t%i\t%i\n' % (os.path.abspath(filename),page,st.st_size,st.st_mtime_ns)).encode())
+    # Photron MRAW size, bit depth and frame count are read from the .cih/.cihx header
+    if ext == '.mraw':
+        cih_file = photron_cih.find_cih(all_images[0])
+        if cih_file is not None:
+            st = os.stat(cih_file)
+            h.update(('%s\t%i\t%i\n' % (os.path.abspath(cih_file),st.st_size,st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+####################################################################################
+def load(target,cache_dir,key):
+    """
+    Map a cached array into target.arr and restore its attributes.
+    Returns True on a hit, False if there is no entry for key.
+    """
+    npy = os.path.join(cache_dir,key+'.npy')
+    meta = os.path.join(cache_dir,key+'.pkl')
+    if not (os.path.isfile(npy) and os.path.isfile(meta)): return False
+    try:
+        with open(meta,'rb') as f: attributes = pickle.load(f)
+        arr = np.load(npy,mmap_mode='c')
+    except (IOError,ValueError,EOFError,pickle.UnpicklingError) as e:
+        print("\tCould not read cached data, reading recording instead: %s" % e)
+        return False
+    target.__dict__.update(attributes)
+    target.arr = arr
+    os.utime(npy) # most recently used
+    return True
+
+def store(target,cache_dir,key,cache_size=DEFAULT_CACHE_SIZE):
+    """
+    Save target.arr and its attributes in cache_dir under key, then delete the
+    least recently used entries until the cache is no larger than cache_size bytes.
+    """
+    arr = np.asarray(target.arr)
+    if arr.nbytes > cache_size:
+        print("\tData is larger than the cache size limit, not caching")
+        return
+    os.makedirs(cache_dir,exist_ok=True)
+    attributes = dict((k,v) for k,v in target.__dict__.items() if not k in IGNORED_ATTRIBUTES)
+
+    # Write to temporary files and rename, so other processes never see part of an entry.
+    for ext, write in (('.pkl',lambda f: pickle.dump(attributes,f)),('.npy',lambda f: np.save(f,arr))):
+        fd, tmp = tempfile.mkstemp(dir=cache_dir,suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f: write(f)
+            os.replace(tmp,os.path.join(cache_dir,key+ext))
+        except (IOError,pickle.PicklingError) as e:
+            print("\tCould not write to cache: %s" % e)
+            if os.path.exists(tmp): os.remove(tmp)
+            return
+    evict(cache_dir,cache_size,keep=key)
+    return
+
+####################################################################################
+def evict(cache_dir,cache_size=DEFAULT_CACHE_SIZE,keep=None):
+    """ Delete least recently used entries until cache_dir holds at most cache_size bytes. """
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith('.npy'): continue
+            key = entry.name[:-4]
+            st = entry.stat()
+            meta = os.path.join(cache_dir,key+'.pkl')
+            nbytes = st.st_size + (os.path.getsize(meta) if os.path.isfile(meta) else 0)
+            entries.append((st.st_mtime_ns,key,nbytes))
+            total += nbytes
+    for mtime, key, nbytes in sorted(entries):
+        if total <= cache_size: break
+        if key == keep: continue
+        for ext in ('.npy','.pkl'):
+            try: os.remove(os.path.join(cache_dir,key+ext))
+            except FileNotFoundError: pass
+        total -= nbytes
+    return
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Frame, region of interest and output buffer helpers for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    The frames kwarg can be given as a (start,end) tuple, a slice with a step,
+    or a list of frame numbers. The readers convert it to a list of frame numbers
+    with frame_indices, then read each run of consecutive frames in one go, so
+    only the selected frames are read from disk or decoded.
+
+    The roi kwarg (y1,y2,x1,x2) selects a region of each frame, with inclusive
+    bounds as for ImageSequence.crop. The readers only read the rows y1:y2 of each
+    frame, and keep the columns x1:x2. It is checked with check_roi.
+
+    The out kwarg is a preallocated array (ie. np.memmap on a scratch disk) that the
+    readers write into instead of allocating their own. It is checked with check_out.
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import numpy as np
+
+####################################################################################
+def frame_indices(frames,nframes,quiet=0):
+    """
+    Convert a frames selection into a list of frame numbers, for a file holding
+    nframes frames. frames may be:
+        None          - all frames
+        (start,end)   - frames start to end-1. end is truncated to the end of the file.
+        slice         - ie. slice(0,None,10) for every 10th frame
+        list or array - frame numbers in the order they should be returned.
+                        Negative numbers count back from the end of the file.
+    Note that a 2-tuple is always treated as a range; use a list to select two frames.
+    """
+    nframes = int(nframes)
+    if frames is None:
+        return list(range(nframes))
+
+    elif isinstance(frames,slice):
+        indices = list(range(*frames.indices(nframes)))
+
+    elif isinstance(frames,tuple) and (len(frames)==2) and \
+         all([isinstance(f,(int,np.integer)) for f in frames]):
+        start, end = int(frames[0]), int(frames[1])
+        if (start < 0) or (start >= nframes):
+            raise ValueError("frame range: Cannot start reading beyond end of file!")
+        if end > nframes:
+            if quiet == 0: print("\tWarning: requested read past EOF, truncating")
+            end = nframes
+        indices = list(range(start,end))
+
+    else:
+        idx = np.asarray(frames)
+        if idx.dtype == bool: idx = np.nonzero(idx)[0]
+        if (idx.size > 0) and not np.issubdtype(idx.dtype,np.integer):
+            raise TypeError("frames must be a (start,end) tuple, slice or list of frame numbers")
+        idx = idx.astype(np.int64).ravel()
+        idx[idx<0] += nframes
+        if np.any(idx<0) or np.any(idx>=nframes):
+            raise IndexError("frame number out of range, file has %i frames" % nframes)
+        indices = [int(i) for i in idx]
+
+    if len(indices) < 1: raise ValueError("frames: no frames selected")
+    return indices
+
+####################################################################################
+# Split a list of frame numbers into runs of consecutive frames.
+# Returns list of [first_frame, position_in_output, count].
+def frame_runs(indices):
+    runs=[]
+    for j,i in enumerate(indices):
+        if len(runs)>0 and i==runs[-1][0]+runs[-1][2]: runs[-1][2]+=1
+        else: runs.append([i,j,1])
+    return runs
+
+####################################################################################
+# Express a list of frame numbers as a slice with a positive step, if possible.
+# Returns None for irregular lists.
+def as_slice(indices):
+    if len(indices) == 1: return slice(indices[0],indices[0]+1,1)
+    step = indices[1]-indices[0]
+    if step < 1: return None
+    for j in range(2,len(indices)):
+        if indices[j]-indices[j-1] != step: return None
+    return slice(indices[0],indices[-1]+1,step)
+
+####################################################################################
+# Compact form of a list of frame numbers for passing on to a reader:
+# (start,end) for a contiguous range, otherwise the list itself.
+def compact(indices):
+    indices = [int(i) for i in indices]
+    if (len(indices) > 0) and (indices[-1]-indices[0] == len(indices)-1) \
+       and (indices == list(range(indices[0],indices[-1]+1))):
+        return (indices[0],indices[-1]+1)
+    return indices
+
+####################################################################################
+# Short description of a selection of frames for status messages.
+def describe(indices):
+    s = as_slice(indices)
+    if s is None: return "%i selected frames" % len(indices)
+    elif s.step == 1: return "frames %i to %i" % (s.start,s.stop)
+    return "%i frames (every %i from %i to %i)" % (len(indices),s.step,s.start,s.stop)
+
+####################################################################################
+def check_roi(roi,height,width):
+    """
+    Check a region of interest (y1,y2,x1,x2), with inclusive bounds, against the
+    frame size. Returns the roi as a tuple of ints, or None if roi is None.
+    """
+    if roi is None: return None
+    if len(roi) != 4: raise ValueError("roi must be a 4-tuple (y1,y2,x1,x2)")
+    y1, y2, x1, x2 = [int(r) for r in roi]
+    if (y1 < 0) or (y2 < y1) or (y2 >= height) or (x1 < 0) or (x2 < x1) or (x2 >= width):
+        raise ValueError("roi %s is outside the %i x %i frame" % (str(roi),width,height))
+    return (y1,y2,x1,x2)
+
+####################################################################################
+def check_out(out,shape,dtype=None):
+    """
+    Check a caller-supplied output array against the shape of the data to be loaded,
+    and that it can hold values of dtype without loss.
+    Returns out, or None if out is None.
+    """
+    if out is None: return None
+    if not isinstance(out,np.ndarray):
+        raise TypeError("out must be a numpy array or np.memmap, not %s" % type(out))
+    if tuple(out.shape) != tuple(shape):
+        raise ValueError("out has shape %s, but the data has shape %s" % (str(out.shape),str(tuple(shape))))
+    if (dtype is not None) and not np.can_cast(dtype,out.dtype,'safe'):
+        raise ValueError("out has dtype %s, which cannot hold %s data" % (out.dtype,np.dtype(dtype)))
+    if not out.flags.writeable: raise ValueError("out is read-only")
+    return out
+
+# True if out can be passed to a reader as its own output buffer of dtype.
+def direct_out(out,dtype):
+    return (out is not None) and (out.dtype == np.dtype(dtype)) and out.flags.c_contiguous
@@ -24,34 +24,83 @@ __copyright__="Copyright (c) 2018-2024 D.Duke"
 # Known tested still frame file extensions
 still_formats = ['.tif','.tiff']
 
-import time, os
+# Valid values for IO_backend kwarg.
+#   threads:   persistent pool of threads, which decode straight into the output array
+#   processes: joblib worker processes, which return each chunk to be copied in
+#   serial:    no parallel I/O
+IO_backends = ['threads','processes','serial']
+
+import time, os, functools
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from . import frame_select
+from . import tiff_reader
+
+##########################################################################################
+# Thread pools are kept between loads, so the threads are only started once.
+# One pool per number of workers, so each load runs at most IO_threads at a time.
+__thread_pools__ = {}
+
+def __get_thread_pool__(n_jobs):
+    if not n_jobs in __thread_pools__:
+        __thread_pools__[n_jobs] = ThreadPoolExecutor(max_workers=n_jobs,\
+                                                      thread_name_prefix='pySciCam_IO')
+    return __thread_pools__[n_jobs]
+
+##########################################################################################
+# Run func(*task) for each task in tasks, on n_jobs workers of the given IO_backend.
+# Returns list of results in the same order as tasks.
+def __run_tasks__(func,tasks,n_jobs,IO_backend='threads',verbosity=0):
+    if not IO_backend in IO_backends:
+        raise ValueError("Unknown IO_backend `%s'. Allowed choices: %s" % (IO_backend,IO_backends))
+    if (n_jobs <= 1) or (len(tasks) <= 1) or (IO_backend == 'serial'):
+        return [func(*t) for t in tasks]
+    if verbosity >= 1: print("%i tasks on %i %s" % (len(tasks),n_jobs,IO_backend))
+    if IO_backend == 'processes':
+        try:
+            from joblib import Parallel, delayed
+            return Parallel(n_jobs=n_jobs,verbose=verbosity)(delayed(func)(*t) for t in tasks)
+        except ImportError:
+            print("Error, joblib is not installed. Using threads for parallel file I/O.")
+    pool = __get_thread_pool__(n_jobs)
+    futures = [pool.submit(func,*t) for t in tasks]
+    return [f.result() for f in futures]
+
+##########################################################################################
+# Allocate array for a chunk of frames, in the layout of ImageSequence.arr.
+def __alloc_chunk__(nframes,height,width,dtype,monochrome,roi=None):
+    if roi is not None: height, width = roi[1]-roi[0]+1, roi[3]-roi[2]+1
+    if monochrome: return np.zeros((nframes,height,width),dtype=dtype) # MONO
+    else: return np.zeros((nframes,3,height,width),dtype=dtype)        # RGB
 
 ##########################################################################################
 # Parallel wrapper to load a chunk of images using PIL.
-def __pil_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome):
+# Frames are written into A, which is a slice of the output array if given,
+# so workers in threads decode straight into their place in the sequence.
+def __pil_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome,roi=None,A=None):
     from PIL import Image
-    if monochrome: A = np.zeros((height,width,len(fseq)),dtype=dtype_dest) # MONO
-    else: A = np.zeros((height,width,3,len(fseq)),dtype=dtype_dest)        # RGB
+    if A is None: A = __alloc_chunk__(len(fseq),height,width,dtype_dest,monochrome,roi)
     i=0
     for fn in fseq:
-        frame = Image.open(fn)
+        filename, page = tiff_reader.split_page(fn)
+        frame = Image.open(filename)
+        if page is not None: frame.seek(page)
+        if roi is not None: frame = frame.crop((roi[2],roi[0],roi[3]+1,roi[1]+1))
         if monochrome and (frame.mode=='RGB'): # collapse RGB to mono channel
-            frame = __make_monochromatic__(np.array(frame),dtype_dest)
-            A[...,i]=np.array(frame)
+            __make_monochromatic__(np.asarray(frame),dtype_dest,A[i])
         elif frame.mode=='RGB': # correct colour channels for RGB so 'imshow' works natively
-            A[...,i]=np.roll(np.array(frame),2,2)
+            A[i]=np.moveaxis(np.roll(np.asarray(frame),2,2),2,0)
         else: # Write as-is for mono format
-            A[...,i]=np.array(frame)
+            A[i]=np.asarray(frame)
         i+=1
     return A
 
 ##########################################################################################
 # Parallel wrapper to load a chunk of images using PythonMagick bindings to ImageMagick.
-def __magick_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome):
+# Frames are written into A, as for __pil_load_wrapper__.
+def __magick_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome,roi=None,A=None):
     import PythonMagick
-    if monochrome: A = np.zeros((height,width,len(fseq)),dtype=dtype_dest) # MONO
-    else: A = np.zeros((height,width,3,len(fseq)),dtype=dtype_dest)        # RGB
+    if A is None: A = __alloc_chunk__(len(fseq),height,width,dtype_dest,monochrome,roi)
     i=0
     
     for fn in fseq:
@@ -103,6 +152,9 @@ def __magick_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome):
             if extraPixels < 0: raise IndexError("ERROR: insufficient bytes for data"\
                                                 +" in frame: %s (%i)" % (fn,extraPixels))
             frame = frame[:-extraPixels].reshape(height,width)
+
+        # Crop to region of interest before any further processing
+        if roi is not None: frame = frame[roi[0]:roi[1]+1,roi[2]:roi[3]+1,...]
     
         # Collapse color channel data on `monochrome' flag.
         if monochrome and ('RGB' in str(imageObj.colorSpace())):
@@ -111,20 +163,117 @@ def __magick_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome):
         del imageObj
         del buffer
 
-        A[...,i]=frame.astype(dtype_dest)
+        if len(frame.shape) == 3: A[i]=np.moveaxis(frame,2,0)
+        else: A[i]=frame
         i+=1
     return A
 
+##########################################################################################
+# Parallel wrapper to load a chunk of TIFF files or pages straight from their strips (see
+# tiff_reader), skipping the decode and copies of the PIL or Magick wrapper. Files that
+# tiff_reader can't decode (ie. compressed) are passed to fallback, the PIL or Magick wrapper.
+# Frames are written as the fallback would: RGB channels are rolled for Pillow, and 12-bit
+# pixels are scaled to the 16-bit range as ImageMagick does.
+def __tiff_load_wrapper__(fseq,width,height,dtype_dest,dtype_src,monochrome,roi=None,A=None,\
+                          fallback=None):
+    if A is None: A = __alloc_chunk__(len(fseq),height,width,dtype_dest,monochrome,roi)
+    # Only the current file is kept open, so that pages of a multipage TIFF share one
+    # handle without holding a handle for every file of the chunk.
+    f = None
+    try:
+        for i,fn in enumerate(fseq):
+            page = tiff_reader.get_page(fn)
+            if not tiff_reader.native_readable(page):
+                fallback([fn],width,height,dtype_dest,dtype_src,monochrome,roi,A[i:i+1])
+                continue
+            filename = tiff_reader.split_page(fn)[0]
+            if (f is None) or (f.name != filename):
+                if f is not None: f.close()
+                f = open(filename,'rb')
+            scale12 = (page['bits'] == 12) and (fallback is __magick_load_wrapper__)
+            if (page['samples'] == 1) and not scale12:
+                # Mono pixels go straight into the output frame
+                tiff_reader.read_page(f,page,roi,A[i])
+                continue
+            frame = tiff_reader.read_page(f,page,roi)
+            if scale12: frame = ((frame.astype(np.uint32)*65535+2047)//4095).astype(np.uint16)
+            if frame.ndim == 3:
+                if monochrome: __make_monochromatic__(frame,dtype_dest,A[i])
+                elif fallback is __pil_load_wrapper__: A[i]=np.moveaxis(np.roll(frame,2,2),2,0)
+                else: A[i]=np.moveaxis(frame,2,0)
+            else:
+                A[i]=frame
+    finally:
+        if f is not None: f.close()
+    return A
+
+##########################################################################################
+# Size and bit depth of the first page of a TIFF from its IFD, for files that
+# neither Pillow nor ImageMagick can read (ie. packed 12-bit for Pillow).
+# Returns (source dtype, bits per pixel), or None if tiff_reader can't read it either.
+def __tiff_header__(ImageSequence,fn):
+    try:
+        page = tiff_reader.get_page(fn)
+    except (IOError,IndexError):
+        return None
+    if not tiff_reader.native_readable(page): return None
+    ImageSequence.width = page['width']
+    ImageSequence.height = page['height']
+    if page['samples'] == 3: ImageSequence.mode = 'RGB'
+    else: ImageSequence.mode = 'L'
+    if page['bits'] == 12: return 'uint12', 12
+    return tiff_reader.page_dtype(page).type, page['bits']
+
+##########################################################################################
+# Size and pixel format (width, height, bits, samples) of a chunk of TIFF files or pages.
+def __tiff_geometry__(fseq):
+    L=[]
+    for fn in fseq:
+        page = tiff_reader.get_page(fn)
+        L.append((page['width'],page['height'],page['bits'],page['samples']))
+    return L
+
+def still_info(all_images,IO_threads=8,IO_backend='threads'):
+    """
+    Describe a sequence of TIFF images from their headers only, without decoding pixels.
+    The header of every file is read, in parallel, and all must give the same size
+    and pixel format. Returns dict with keys
+        nframes, width, height, bits_per_pixel, rgb
+    """
+    n_jobs = max(1,min(int(IO_threads),len(all_images)))
+    b = max(1,len(all_images)//(4*n_jobs))
+    L = __run_tasks__(__tiff_geometry__,[(all_images[a:a+b],) for a in range(0,len(all_images),b)],\
+                      n_jobs,IO_backend)
+    geometry = [g for chunk in L for g in chunk]
+    for fn,g in zip(all_images,geometry):
+        if g != geometry[0]:
+            raise ValueError("%s is %i x %i, %i bit, %i channel(s), but %s is %i x %i, %i bit, %i channel(s)"\
+                             % ((fn,)+g+(all_images[0],)+geometry[0]))
+    width, height, bits, samples = geometry[0]
+    return {'nframes':len(all_images), 'width':width, 'height':height,\
+            'bits_per_pixel':bits, 'rgb':samples>=3}
+
 ##########################################################################################
 # Summation for RGB channel data into monochrome - no information is lost.
-# if overflow, warn user.
-def __make_monochromatic__(im,dtype):
+# if overflow, warn user. If out is given, the sum is written into it.
+def __make_monochromatic__(im,dtype,out=None):
+    nchannels = im.shape[2]
+    if (nchannels > 1) and np.issubdtype(im.dtype,np.integer) and np.issubdtype(dtype,np.integer)\
+       and (nchannels*int(np.iinfo(im.dtype).max) <= np.iinfo(dtype).max):
+        # Sum can't overflow: add the channels straight into out, without a converted
+        # copy of the whole image (np.sum over the short last axis is much slower).
+        if out is None: out = np.empty(im.shape[:2],dtype=dtype)
+        np.add(im[...,0],im[...,1],out=out,dtype=dtype)
+        for c in range(2,nchannels): np.add(out,im[...,c],out=out,dtype=dtype)
+        return out
     im_newtype = im.astype(dtype)
     mono = np.sum(im_newtype,axis=2)
     if np.any( mono == np.iinfo(dtype).max ) \
     and not np.any( im_newtype == np.iinfo(dtype).max ):
         print("WARNING: Possible overflow/clipping detected when summing RGB channels.")
-    return mono
+    if out is None: return mono
+    out[...] = mono
+    return out
 
 ####################################################################################
 # Read numbered image sequence from list all_images
@@ -132,16 +281,8 @@ def __make_monochromatic__(im,dtype):
 # Use multiple processes to read lots of images at once if
 # the disk read speed justifies it (i.e SSD).
 def load_image_sequence(ImageSequence,all_images,frames=None,monochrome=False,\
-                        dtype=None,use_magick=True):
+                        dtype=None,use_magick=True,roi=None,out=None):
     
-    # Attempt setup of parallel file I/O.
-    if ImageSequence.IO_threads > 1:
-        try:
-            from joblib import Parallel, delayed
-        except ImportError:
-            print("Error, joblib is not installed. Multithreaded file I/O will be disabled.")
-            ImageSequence.IO_threads=1
-
     # Attempt to import PythonMagick if requested
     if use_magick:
         try:
@@ -161,19 +302,22 @@ def load_image_sequence(ImageSequence,all_images,frames=None,monochrome=False,\
             raise ImportError("Pillow library is not installed. Try `pip install pillow'")
 
 
-    # Reduce range of frames?
+    # Reduce range of frames? Only the selected files are opened.
     if frames is not None:
-        if len(all_images)>frames[1]:
-            all_images=all_images[frames[0]:frames[1]]
+        all_images=[all_images[i] for i in frame_select.frame_indices(frames,len(all_images))]
 
     # Use first image to set dtype and size.
+    # Pages of a multipage TIFF are given as "filename[n]".
+    I0_path, I0_page = tiff_reader.split_page(all_images[0])
     # Read with Pillow?
     if not use_magick:
         try:
-            I0 = Image.open(all_images[0])
+            I0 = Image.open(I0_path)
+            if I0_page is not None: I0.seek(I0_page)
             ImageSequence.mode = I0.mode
             #print('\t',I0)  # Debugging, check PIL mode
-            I0_dtype = np.array(I0).dtype
+            # Big-endian modes (ie. I;16B) are stored in native byte order
+            I0_dtype = np.array(I0).dtype.newbyteorder('=')
             if dtype is None: ImageSequence.dtype = I0_dtype
             else: ImageSequence.dtype=dtype
             print("\tPIL thinks the bit depth is %s" % I0_dtype)
@@ -181,7 +325,16 @@ def load_image_sequence(ImageSequence,all_images,frames=None,monochrome=False,\
             ImageSequence.width = I0.width
             ImageSequence.height = I0.height
         except IOError as e:
-            if os.path.isfile(all_images[0]) and not use_magick:
+            native = __tiff_header__(ImageSequence,all_images[0])
+            if native is not None:
+                # Pillow can't decode it, but it can be read straight from the TIFF strips
+                I0_dtype, bits_per_pixel = native
+                print("\tTIFF header gives bit depth %s" % I0_dtype)
+                if dtype is None:
+                    if I0_dtype == 'uint12': ImageSequence.dtype=np.uint16
+                    else: ImageSequence.dtype=I0_dtype
+                else: ImageSequence.dtype=dtype
+            elif os.path.isfile(I0_path) and not use_magick:
                 # Format unrecognized.
                 print("\tThe image format was not recognized by PIL! Trying ImageMagick")
                 use_magick=True
@@ -237,42 +390,55 @@ def load_image_sequence(ImageSequence,all_images,frames=None,monochrome=False,\
         # so there's no overflowing when we do summation.
         ImageSequence.increase_dtype()
 
+    # TIFF files and pages of a multipage TIFF are read straight from the file where possible.
+    if 'tif' in os.path.splitext(I0_path)[-1].lower():
+        imageHandler=functools.partial(__tiff_load_wrapper__,fallback=imageHandler)
+
+    # Region of interest (y1,y2,x1,x2), inclusive. Each frame is cropped as it is read.
+    roi = frame_select.check_roi(roi,ImageSequence.height,ImageSequence.width)
+
     # Number of parallel workers.
     n_jobs = int(ImageSequence.IO_threads)
     if n_jobs > len(all_images): n_jobs = len(all_images)
     if n_jobs <= 1: n_jobs = 1
     
-    # Chunk size for parallel I/O.
-    # To get a single task run on each processor we would set the chunk size
-    b=len(all_images)/n_jobs
-    # However this can produce tasks that have to each have a very large amount of RAM
-    # and return a very large array to the parent, which could generate IOError: bad message length.
-    # On macOS 10.13.6, I get this error when the child returns more than 300 MB.
-    # Therefore we will reduce the chunk size if it is too large.
-    if b>10*n_jobs: b=int(b/10)
-    # Ensure b>=1!
-    if b<1: b=1
+    # Allocate the whole sequence once (or use the caller's array, out). With threads,
+    # each task decodes its files straight into their frames of this array, so there
+    # is only one copy of the data in memory.
+    IO_backend = ImageSequence.IO_backend
+    if use_magick and getattr(ImageSequence,'IO_backend_default',False):
+        # PythonMagick's bindings hold the GIL while decoding, so threads would
+        # decode one file at a time. Use worker processes unless told otherwise.
+        IO_backend = 'processes'
+    ImageSequence.arr = __alloc_chunk__(0,ImageSequence.height,ImageSequence.width,\
+                                        ImageSequence.dtype,monochrome,roi)
+    shape = (len(all_images),)+ImageSequence.arr.shape[1:]
+    if out is None: ImageSequence.arr = np.zeros(shape,dtype=ImageSequence.dtype)
+    else: ImageSequence.arr = frame_select.check_out(out,shape,ImageSequence.dtype)
+
+    # Chunk size for parallel I/O. A few tasks per worker evens out the load.
+    b = max(1,len(all_images)//(4*n_jobs))
+    if IO_backend == 'processes':
+        # Each chunk is returned to the parent, which could generate IOError: bad message length
+        # if it is too large. On macOS 10.13.6, I get this error when the child returns more
+        # than 300 MB. Therefore the chunks are kept smaller.
+        b = max(1,min(b,int(3e8//max(ImageSequence.arr[0].nbytes,1))))
     
     print("\tReading files into memory...")
     t0=time.time()
-    if n_jobs > 1:
-        # Read image sequence in parallel
-        if ImageSequence.Joblib_Verbosity >= 1: print("%i tasks on %i processors" % (len(all_images)/b,n_jobs))
-        L = Parallel(n_jobs=n_jobs,verbose=ImageSequence.Joblib_Verbosity)(delayed(imageHandler)(all_images[a:a+int(b)],ImageSequence.width,ImageSequence.height,ImageSequence.dtype,I0_dtype,monochrome) for a in range(0,len(all_images),int(b)))
-    else:
-        # Plain list. might have to rearrange this if it consumes too much RAM.
-        L = [imageHandler(all_images[a:a+int(b)],ImageSequence.width,ImageSequence.height,ImageSequence.dtype,\
-                 I0_dtype,monochrome) for a in range(0,len(all_images),int(b))]
-    
-    # Repack list of results into a single numpy array.
-    if len(L[0].shape) == 3:
-        # monochrome arrays
-        ImageSequence.arr = np.dstack(L)
-        ImageSequence.arr=ImageSequence.arr.swapaxes(2,0).swapaxes(1,2)
+    tasks = [(all_images[a:a+b],ImageSequence.width,ImageSequence.height,ImageSequence.dtype,\
+              I0_dtype,monochrome,roi) for a in range(0,len(all_images),b)]
+    if IO_backend == 'processes':
+        # Worker processes can't see the output array, so copy their chunks in.
+        L = __run_tasks__(imageHandler,tasks,n_jobs,IO_backend,ImageSequence.Joblib_Verbosity)
+        for j in range(len(L)):
+            ImageSequence.arr[j*b:j*b+len(L[j])] = L[j]
+            L[j] = None
     else:
-        # colour arrays
-        ImageSequence.arr = np.concatenate(L,axis=3)
-        ImageSequence.arr = np.rollaxis(np.rollaxis(ImageSequence.arr,3,0),3,1)
+        # Threads (or serial) decode straight into the output array.
+        # Pillow and the direct TIFF strip reader release the GIL while reading.
+        tasks = [t+(ImageSequence.arr[j*b:(j+1)*b],) for j,t in enumerate(tasks)]
+        __run_tasks__(imageHandler,tasks,n_jobs,IO_backend,ImageSequence.Joblib_Verbosity)
 
     ImageSequence.src_bpp = bits_per_pixel
     read_nbytes = bits_per_pixel * np.prod(ImageSequence.arr.shape) / 8
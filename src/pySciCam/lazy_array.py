@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Array-like container that reads frames on demand for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import itertools, threading
+from collections import OrderedDict
+import numpy as np
+
+# Default size limit of the shared chunk cache, in bytes.
+DEFAULT_CACHE_SIZE = 1024**3
+
+# Frames are cached in chunks of up to MAX_CHUNK_FRAMES frames and about CHUNK_BYTES.
+MAX_CHUNK_FRAMES = 16
+CHUNK_BYTES = 32*1024**2
+
+####################################################################################
+class ChunkCache:
+    """
+    Memory-bounded least-recently-used cache of decoded chunks of frames, shared
+    by all LazyFrameArrays. Entries are keyed by (owner, chunk number).
+    When more than max_bytes are held, the least recently used chunks are dropped.
+    """
+
+    def __init__(self,max_bytes=DEFAULT_CACHE_SIZE):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.chunks = OrderedDict()
+        self.lock = threading.Lock()
+        return
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def get(self,key):
+        with self.lock:
+            arr = self.chunks.get(key)
+            if arr is not None: self.chunks.move_to_end(key)
+            return arr
+
+    def put(self,key,arr):
+        arr.setflags(write=False)
+        with self.lock:
+            if key in self.chunks: self.nbytes -= self.chunks.pop(key).nbytes
+            self.chunks[key] = arr
+            self.nbytes += arr.nbytes
+            self.__evict__()
+        return
+
+    def resize(self,max_bytes):
+        with self.lock:
+            self.max_bytes = int(max_bytes)
+            self.__evict__()
+        return
+
+    def drop(self,owner):
+        """ Remove all chunks of one owner """
+        with self.lock:
+            for key in [k for k in self.chunks if k[0] == owner]:
+                self.nbytes -= self.chunks.pop(key).nbytes
+        return
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+            self.nbytes = 0
+        return
+
+    def __evict__(self):
+        while (self.nbytes > self.max_bytes) and (len(self.chunks) > 0):
+            self.nbytes -= self.chunks.popitem(last=False)[1].nbytes
+        return
+
+# Cache shared by all lazy sequences. Use chunk_cache.resize(nbytes) to change its
+# size limit, or resize(0) to turn it off.
+chunk_cache = ChunkCache()
+__owners__ = itertools.count()
+
+####################################################################################
+class LazyFrameArray:
+    """
+    Stand-in for ImageSequence.arr which reads and decodes frames only when they
+    are indexed. The first axis is always the frame number.
+
+    read_frames(frames) must return an ndarray holding the frames selected by
+    frames, a (start,end) tuple or an ascending list of frame numbers.
+
+    Indexing returns NumPy arrays, i.e. arr[1000:1010] reads just those ten frames,
+    and arr[5,...,10:20] reads a single frame then crops it. Operations that need
+    every pixel (np.asarray, np.flip, etc.) will read the whole sequence.
+
+    LazyFrameArray is read-only: use fill() to mask pixels of every frame.
+
+    Frames are read in chunks of neighbouring frames, which are kept in the shared
+    chunk_cache, so going back and forth around the same frames is served from
+    memory. cache_hits and cache_misses count chunks found and not found in the
+    cache. Reads larger than the cache bypass it. Set cached=False to not use it.
+    """
+
+    def __init__(self,read_frames,nframes,frame_shape,dtype,cached=True):
+        self.read_frames = read_frames
+        self.shape = (int(nframes),)+tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.cached = cached
+        self.owner = next(__owners__)
+        frame_bytes = max(1,int(np.prod(self.shape[1:]))*self.dtype.itemsize)
+        self.chunk_frames = int(max(1,min(MAX_CHUNK_FRAMES,CHUNK_BYTES//frame_bytes)))
+        self.cache_hits = 0
+        self.cache_misses = 0
+        return
+
+    def __del__(self):
+        if getattr(self,'cached',False) and (chunk_cache is not None): chunk_cache.drop(self.owner)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size*self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "LazyFrameArray(shape=%s, dtype=%s)" % (str(self.shape),self.dtype)
+
+    # Convert key on first axis to a list of frame indices.
+    def __frame_indices__(self,key):
+        N=self.shape[0]
+        if isinstance(key,slice):
+            return list(range(*key.indices(N))), False
+        elif isinstance(key,(int,np.integer)):
+            if key<0: key+=N
+            if key<0 or key>=N: raise IndexError("frame index %i out of range for %i frames" % (key,N))
+            return [int(key)], True
+        else:
+            key=np.asarray(key)
+            if key.dtype==bool: key=np.nonzero(key)[0]
+            key=key.astype(np.int64).ravel()
+            key[key<0]+=N
+            if np.any(key<0) or np.any(key>=N): raise IndexError("frame index out of range for %i frames" % N)
+            return [int(k) for k in key], False
+
+    def __getitem__(self,key):
+        if not isinstance(key,tuple): key=(key,)
+        if len(key)>0 and key[0] is Ellipsis:
+            frame_key=slice(None); rest=key
+        elif len(key)>0:
+            frame_key=key[0]; rest=key[1:]
+        else:
+            frame_key=slice(None); rest=()
+
+        indices, drop_axis = self.__frame_indices__(frame_key)
+        # Read all the requested frames in one call, in file order.
+        unique = sorted(set(indices))
+        if len(unique) == 0:
+            out = np.empty((0,)+self.shape[1:],dtype=self.dtype)
+        else:
+            out = self.__read_cached__(unique)
+            if unique != indices: out = out[np.searchsorted(unique,indices)]
+
+        if drop_axis: out=out[0]
+        else: rest=(slice(None),)+rest
+        if len(rest)>0: out=out[rest]
+        return out
+
+    # Read an ascending list of frames through the chunk cache.
+    def __read_cached__(self,indices):
+        nbytes = len(indices)*int(np.prod(self.shape[1:]))*self.dtype.itemsize
+        if (not self.cached) or (nbytes > chunk_cache.max_bytes//2):
+            return self.read_frames(indices)
+        C, N = self.chunk_frames, self.shape[0]
+
+        found = {}
+        missing = []
+        for c in sorted(set([i//C for i in indices])):
+            arr = chunk_cache.get((self.owner,c))
+            if arr is None: missing.append(c)
+            else: found[c] = arr
+        self.cache_hits += len(found)
+        self.cache_misses += len(missing)
+
+        # Read all the missing chunks in one call
+        if len(missing) > 0:
+            data = self.read_frames([f for c in missing for f in range(c*C,min((c+1)*C,N))])
+            pos = 0
+            for c in missing:
+                n = min((c+1)*C,N)-c*C
+                found[c] = data[pos:pos+n]
+                if len(missing) > 1: found[c] = found[c].copy()
+                chunk_cache.put((self.owner,c),found[c])
+                pos += n
+
+        out = np.empty((len(indices),)+self.shape[1:],dtype=self.dtype)
+        indices = np.asarray(indices)
+        for c in found:
+            sel = np.nonzero(indices//C == c)[0]
+            out[sel] = found[c][indices[sel]-c*C]
+        return out
+
+    def __array__(self,dtype=None,copy=None):
+        out=self[:]
+        if dtype is not None: out=out.astype(dtype)
+        return out
+
+    def __iter__(self):
+        for i in range(self.shape[0]): yield self[i]
+
+    def astype(self,dtype):
+        """ Return a LazyFrameArray that converts frames to dtype as they are read """
+        # Frames are read through this array's cache
+        def read_frames(frames):
+            if isinstance(frames,tuple): frames=list(range(*frames))
+            return self.__read_cached__(frames).astype(dtype)
+        return LazyFrameArray(read_frames,self.shape[0],self.shape[1:],dtype,cached=False)
+
+    def fill(self,key,value):
+        """
+        Return a LazyFrameArray that sets frames[key] = value as frames are read, for
+        masking. key indexes an array of whole frames, ie. (Ellipsis,slice(y1,y2),slice(x1,x2))
+        """
+        def read_frames(frames):
+            if isinstance(frames,tuple): frames=list(range(*frames))
+            out = self.__read_cached__(frames)
+            out[key] = value
+            return out
+        return LazyFrameArray(read_frames,self.shape[0],self.shape[1:],self.dtype,cached=False)
@@ -23,75 +23,307 @@ __copyright__="Copyright (c) 2018-2024 D.Duke"
 # Known movie file extensions supported & tested.
 movie_formats=['.mp4','.avi']
 
-import time, os
+import time, os, bisect, shutil, subprocess, fractions, threading
 import numpy as np
 from . import image_sequence_handler
+from . import frame_select
+
+# Description of each movie read so far (see movie_info), kept while the file's
+# size and mtime are unchanged.
+__info_cache__ = {}
 
 ####################################################################################
-def load_movie(ImageSequence,filename,frames=None,monochrome=False,dtype=None):
-    t0 = time.time()
-    
+# Number of frames in a movie.
+def movie_frame_count(filename):
+    return movie_info(filename)['nframes']
+
+def movie_info(filename,packets=False):
+    """
+    Describe a movie from its container, without decoding any frames. The number of
+    frames is taken from the container's header for the video stream (with ffprobe).
+    The packets of the video stream are only listed (see __packet_index__) if the header
+    does not give the count, the frame rate is variable, or packets=True. The packets
+    give the exact number of frames, the time of each and which are keyframes.
+    Returns dict with keys nframes, width, height, fps, duration, vfr, times,
+    keyframes, listed (True if the packets were listed) and meta (imageio's metadata).
+    fps is the average for vfr movies.
+    times are from the frame rate if the packets were not listed, and keyframes is then
+    None. If neither the header nor the packets can be read, nframes is estimated from
+    the duration and times is None. The result is cached until the file is modified.
+    """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    if key in __info_cache__ and __info_cache__[key][0] == (st.st_size,st.st_mtime_ns):
+        info = __info_cache__[key][1]
+        if (not packets) or (info['keyframes'] is not None) or info['listed']: return info
+
     try:
         import imageio
     except ImportError:
         raise ImportError("Cannot open movie: imageio not installed.")
-    try:
-        import tqdm
-        it_fun = lambda a,b: tqdm.tqdm(range(a,b))
-    except ImportError:
-        print("Warning: tqdm library not installed. No progress bar!")
-        it_fun = range
-    
     try:
         vid = imageio.get_reader(filename,'ffmpeg')
     except ImportError:
         raise ImportError("Cannot open movie: ffmpeg not installed.")
+    meta = vid.get_meta_data()
+    vid.close()
+
+    nframes, vfr = __container_frame_count__(filename)
+    times = keyframes = None
+    listed = packets or (nframes is None) or vfr
+    if listed:
+        try:
+            times, keyframes = __packet_index__(filename)
+            if len(times) < 1: raise IOError("no video packets found")
+            nframes = len(times)
+            times = np.asarray(times)
+            # Constant frame rate movies only vary by rounding of the timestamps.
+            intervals = np.diff(times)
+            vfr = (len(intervals) > 1) and (np.ptp(intervals) > 0.01*np.median(intervals))
+        except (IOError,ValueError,TypeError) as e:
+            # ValueError or TypeError if ffmpeg's listing could not be parsed
+            print("\tWarning: could not list frames of movie (%s), estimating frame count" % e)
+            times = keyframes = None
+            vfr = False
+    if nframes is None: nframes = __frame_count_from_meta__(meta)
+    elif (times is None) and meta.get('fps'): times = np.arange(nframes)/float(meta['fps'])
+
+    info = {'nframes':nframes, 'width':int(meta['size'][0]), 'height':int(meta['size'][1]),\
+            'fps':meta.get('fps'), 'duration':meta.get('duration'), 'vfr':vfr, 'times':times,\
+            'keyframes':keyframes, 'meta':meta, 'listed':listed}
+    __info_cache__[key] = ((st.st_size,st.st_mtime_ns),info)
+    return info
+
+# Number of frames of the first video stream from the container's header, read with
+# ffprobe. nb_frames is given by the index of mp4 and avi files, otherwise it is worked
+# out from the stream's duration and frame rate. Returns (nframes, vfr), where vfr is
+# True if the stream's average frame rate differs from its base rate, or (None, False)
+# if ffprobe is not installed or gives no count.
+def __container_frame_count__(filename):
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None: return None, False
+    cmd = [ffprobe,'-v','error','-select_streams','v:0','-show_entries',\
+           'stream=nb_frames,duration_ts,time_base,avg_frame_rate,r_frame_rate',\
+           '-of','default=noprint_wrappers=1',filename]
+    try:
+        p = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    except OSError:
+        return None, False
+    if p.returncode != 0: return None, False
+    fields = dict([line.split('=',1) for line in p.stdout.decode().splitlines() if '=' in line])
+    try:
+        rate = fractions.Fraction(fields['avg_frame_rate'])
+        vfr = rate != fractions.Fraction(fields['r_frame_rate'])
+        if fields['nb_frames'].isdigit() and (int(fields['nb_frames']) > 0):
+            return int(fields['nb_frames']), vfr
+        nframes = round(int(fields['duration_ts'])*fractions.Fraction(fields['time_base'])*rate)
+    except (KeyError,ValueError,ZeroDivisionError):
+        return None, False
+    if nframes < 1: return None, False
+    return int(nframes), vfr
+
+# Number of frames from imageio metadata dict.
+def __frame_count_from_meta__(meta):
+    nframes = meta.get('nframes',float('inf'))
+    if not np.isfinite(nframes):
+        # If the frame rate is constant this should work ...
+        nframes = meta['duration']*meta['fps']
+    return int(nframes)
+
+####################################################################################
+# Selected frames further apart than this are reached by seeking again, rather than
+# by decoding and discarding the frames in between (the same limit as imageio uses).
+SEEK_GAP = 100
+
+# ffmpeg arguments to start decoding at frame number start. The long stretch is a fast
+# keyframe seek before the input, and the last 10 sec an exact seek after it, as imageio does.
+# If the frame timestamps are known (see __packet_index__), an exact seek to halfway between
+# the previous frame and this one is used instead, which only decodes from the last keyframe.
+def __seek_params__(start,fps,times=None):
+    if start <= 0: return [], []
+    if (times is not None) and (start < len(times)):
+        return ['-ss','%.06f' % (0.5*(times[start-1]+times[start]))], []
+    starttime = start/float(fps)
+    seek_slow = min(10,starttime)
+    seek_fast = starttime - seek_slow
+    return ['-ss','%.06f' % seek_fast], ['-ss','%.06f' % seek_slow]
+
+####################################################################################
+def __packet_index__(filename):
+    """
+    List the packets of the first video stream by demuxing the movie with ffmpeg,
+    without decoding it. Returns (times, keyframes): the presentation time of each
+    frame in seconds from the start of the movie, in order, and the numbers of the
+    frames that are keyframes.
+    """
+    import imageio_ffmpeg
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(),'-v','error','-i',filename,'-map','0:v:0',\
+           '-c','copy','-f','framecrc','-']
+    p = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise IOError("Could not read packets of %s: %s" % (filename,p.stderr.decode(errors='replace')))
+    timebase = None
+    packets = []
+    for line in p.stdout.decode().splitlines():
+        if line.startswith('#tb 0:'): timebase = fractions.Fraction(line.split(':')[1].strip())
+        elif not line.startswith('#'):
+            # stream, dts, pts, duration, size, checksum[, F=flags][, side data]
+            fields = [f.strip() for f in line.split(',')]
+            # Flags are only listed when not just 0x1 (keyframe). 0x4 marks packets that
+            # are decoded but not shown, ie. trimmed by an mp4 edit list.
+            flags = [int(f[2:],16) for f in fields[6:] if f.startswith('F=')]
+            flags = flags[0] if len(flags) > 0 else 1
+            if not flags & 4: packets.append((int(fields[2]),bool(flags & 1)))
+    packets.sort()
+    times = [float(pts*timebase) for pts,key in packets]
+    keyframes = [i for i,(pts,key) in enumerate(packets) if key]
+    return times, keyframes
+
+# Split sorted frame numbers wanted into at most nseg runs, each starting on a keyframe
+# (except the first), with about the same number of frames in each.
+def __segments__(wanted,keyframes,nseg):
+    keys = [k for k in keyframes if wanted[0] < k <= wanted[-1]]
+    starts = []
+    for s in range(1,nseg):
+        i = bisect.bisect_right(keys,wanted[len(wanted)*s//nseg])-1
+        if (i >= 0) and ((len(starts) == 0) or (keys[i] > starts[-1])): starts.append(keys[i])
+    bounds = [0]+[bisect.bisect_left(wanted,k) for k in starts]+[len(wanted)]
+    return [wanted[a:b] for a,b in zip(bounds[:-1],bounds[1:]) if b > a]
+
+# ffmpeg output argument to pass every decoded frame through once, rather than dropping
+# or repeating frames to make a constant frame rate. -fps_mode replaced -vsync in ffmpeg 5.1.
+def __passthrough_params__():
+    import imageio_ffmpeg
+    try:
+        version = tuple(int(v) for v in imageio_ffmpeg.get_ffmpeg_version().split('.')[:2])
+    except ValueError:
+        version = (99,) # git builds
+    if version >= (5,1): return ['-fps_mode','passthrough']
+    return ['-vsync','passthrough']
+
+def __decode_frames__(filename,wanted,fps,frame_shape,times=None):
+    """
+    Decode the frames numbered in wanted (sorted, no repeats) from a movie, reading it
+    in order through a single ffmpeg pipe. The decoder only seeks to the first frame,
+    and again for gaps longer than SEEK_GAP frames; frames in between are skipped.
+    Yields (frame number, frame) with frame a read-only (height,width,3) uint8 view of
+    the decoded bytes.
+    """
+    import imageio_ffmpeg
+    j = 0
+    while j < len(wanted):
+        pos = wanted[j]
+        iargs, oargs = __seek_params__(pos,fps,times)
+        gen = imageio_ffmpeg.read_frames(filename,'rgb24',input_params=iargs,\
+                                         output_params=oargs+__passthrough_params__())
+        try:
+            gen.__next__() # metadata
+            for raw in gen:
+                if pos == wanted[j]:
+                    yield pos, np.frombuffer(raw,dtype=np.uint8).reshape(frame_shape)
+                    j += 1
+                    if (j == len(wanted)) or (wanted[j]-pos > SEEK_GAP): break
+                pos += 1
+            else:
+                return # end of stream
+        finally:
+            gen.close()
+    return
+
+####################################################################################
+# Decode the frames in wanted, copying each into its place(s) in ImageSequence.arr as
+# given by slots. Returns the number of places filled.
+def __decode_into__(ImageSequence,filename,wanted,slots,region,monochrome,fps,frame_shape,\
+                    times=None,bar=None,lock=None):
+    ndone = 0
+    for framenum, frame in __decode_frames__(filename,wanted,fps,frame_shape,times):
+        frame = frame[region]
+        first = slots[framenum][0]
+        if monochrome:
+            # Channels are summed in one pass straight into the array
+            image_sequence_handler.__make_monochromatic__(frame,ImageSequence.dtype,\
+                                                          ImageSequence.arr[first])
+        else:
+            ImageSequence.arr[first] = frame
+        for i in slots[framenum][1:]: ImageSequence.arr[i] = ImageSequence.arr[first]
+        ndone += len(slots[framenum])
+        if bar is not None:
+            with lock: bar.update(len(slots[framenum]))
+    return ndone
+
+####################################################################################
+def load_movie(ImageSequence,filename,frames=None,monochrome=False,dtype=None,roi=None,out=None,\
+               nthreads=1):
+    t0 = time.time()
     
+    try:
+        import tqdm
+        progress = lambda n: tqdm.tqdm(total=n)
+    except ImportError:
+        print("Warning: tqdm library not installed. No progress bar!")
+        progress = None
+
+    # Container metadata and frame times, read once per file.
+    info = movie_info(filename,packets=(nthreads > 1))
+    meta = info['meta']
 
     # Copy metadata of video into ImageSequence
-    for k in vid.get_meta_data().keys():
-        ImageSequence.__dict__[k] = vid.get_meta_data()[k]
-        print('\t%s: %s' % (k,vid.get_meta_data()[k]))
+    for k in meta.keys():
+        ImageSequence.__dict__[k] = meta[k]
+        print('\t%s: %s' % (k,meta[k]))
+    if info['vfr']: print('\tVariable frame rate, fps is the average')
 
-    # Default start frame is zero
-    start = 0
+    # Default range is all frames.
+    end = info['nframes']
     
-    # Default end frame is number of frames
-    #end = vid.get_length() # returns infinity?
-    #end = vid.count_frames() # causes a RuntimeError?
+    # Reduce range of frames? Only the selected frames are decoded.
+    indices = frame_select.frame_indices(frames,end)
+    if frames is not None: print('\tReading %s' % frame_select.describe(indices))
+    # Time of each frame loaded, in seconds from the start of the movie.
+    if info['times'] is not None: ImageSequence.frame_times = info['times'][indices]
     
-    # If the frame rate is constant this should work ...
-    end = int(vid.get_meta_data()['duration']*vid.get_meta_data()['fps'])
-    
-    # Reduce range of frames?
-    if frames is not None:
-        start=frames[0]
-        end=frames[1]
-    
-    
-    # Initialize array with first frame
-    frame = vid.get_data(start)
+    # Frames are decoded as 8-bit RGB
+    frame_shape = (int(meta['size'][1]),int(meta['size'][0]),3)
     ImageSequence.mode='MOVIE'
-    if dtype is None: ImageSequence.dtype=frame.dtype
+    if dtype is None: ImageSequence.dtype=np.dtype(np.uint8)
     else: ImageSequence.dtype=dtype
-    ImageSequence.width=frame.shape[1]
-    ImageSequence.height=frame.shape[0]
-    if len(frame.shape)<3: monochrome=True # Force mono mode if no colour channels
-    elif monochrome:
-        if dtype is None: ImageSequence.increase_dtype()
-        ImageSequence.arr = np.zeros((int(end-start),int(ImageSequence.height),int(ImageSequence.width)),dtype=ImageSequence.dtype)
+    # Region of interest (y1,y2,x1,x2), inclusive. Frames are cropped as they are decoded.
+    roi = frame_select.check_roi(roi,frame_shape[0],frame_shape[1])
+    if roi is None: region = (slice(None),slice(None))
+    else: region = (slice(roi[0],roi[1]+1),slice(roi[2],roi[3]+1))
+    ImageSequence.height = len(range(frame_shape[0])[region[0]])
+    ImageSequence.width = len(range(frame_shape[1])[region[1]])
+    if monochrome and (dtype is None): ImageSequence.increase_dtype()
+    if monochrome: shape = (len(indices),int(ImageSequence.height),int(ImageSequence.width))
+    else: shape = (len(indices),int(ImageSequence.height),int(ImageSequence.width),3)
+    if out is not None:
+        # Decode straight into caller's array
+        ImageSequence.arr = frame_select.check_out(out,shape,ImageSequence.dtype)
+        ImageSequence.dtype = out.dtype
     else:
-        ImageSequence.arr = np.zeros((end-start,height,width,3),dtype=ImageSequence.dtype)
+        ImageSequence.arr = np.zeros(shape,dtype=ImageSequence.dtype)
     
-    # Loop through frames, loading.
-    i=0
-    for framenum in it_fun(start, end):
-        frame = vid.get_data(framenum)
-        if monochrome and (len(frame.shape)>2):
-            frame = image_sequence_handler.__make_monochromatic__(frame,ImageSequence.dtype)
-        ImageSequence.arr[i,...]=frame.copy()
-        i+=1
-    vid.close()
+    # Decode the movie in order, copying each selected frame into its place(s) in the array.
+    slots = {}
+    for i,framenum in enumerate(indices): slots.setdefault(framenum,[]).append(i)
+    wanted = sorted(slots)
+    bar = None if progress is None else progress(len(indices))
+    if (nthreads > 1) and (len(wanted) > 1):
+        # Split at keyframes, and decode each segment with its own ffmpeg process.
+        times, keyframes = info['times'], info['keyframes']
+        if keyframes is None: keyframes = wanted # even split
+        segments = __segments__(wanted,keyframes,int(nthreads))
+        print('\tDecoding %i segments in parallel' % len(segments))
+        lock = threading.Lock()
+        tasks = [(ImageSequence,filename,seg,slots,region,monochrome,meta['fps'],frame_shape,\
+                  times,bar,lock) for seg in segments]
+        ndone = sum(image_sequence_handler.__run_tasks__(__decode_into__,tasks,int(nthreads)))
+    else:
+        ndone = __decode_into__(ImageSequence,filename,wanted,slots,region,monochrome,\
+                                meta['fps'],frame_shape,info['times'],bar,threading.Lock())
+    if bar is not None: bar.close()
+    if ndone < len(indices):
+        print("\tWarning: movie ended after %i of %i frames selected" % (ndone,len(indices)))
 
     # Estimate bits per pixel
     read_nbytes = os.path.getsize(filename)
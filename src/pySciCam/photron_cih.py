@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Read Photron camera information header (.cih and .cihx) files for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    Photron FastCam Viewer saves a header file alongside each MRAW recording.
+    Older versions write a plain text .cih file of "Key : Value" lines. Newer
+    versions write .cihx, which is an XML <cih> document (sometimes following a
+    short binary preamble). Both give the resolution, bit depth, colour type,
+    frame count and frame rate, so MRAW files can be opened without specifying
+    these by hand.
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import os
+
+# Header file extensions, in order of preference
+cih_formats = ['.cihx','.cih']
+
+####################################################################################
+# Find header file for an MRAW file, i.e. foo.mraw -> foo.cihx or foo.cih
+def find_cih(filename):
+    base = os.path.splitext(filename)[0]
+    for ext in cih_formats:
+        for e in (ext,ext.upper()):
+            if os.path.isfile(base+e): return base+e
+    return None
+
+####################################################################################
+# Parse text .cih file into dict of raw string values
+def __parse_cih_text__(text):
+    fields = {}
+    for line in text.splitlines():
+        if line.startswith('#') or not ':' in line: continue
+        k, v = line.split(':',1)
+        fields[k.strip()] = v.strip()
+    return fields
+
+####################################################################################
+# Parse XML .cihx file into dict of raw string values, keyed as the .cih equivalents
+def __parse_cihx_xml__(text):
+    import xml.etree.ElementTree as ET
+    a = text.find('<cih>')
+    b = text.find('</cih>')
+    if a < 0 or b < 0: raise IOError("No <cih> block found in .cihx file")
+    root = ET.fromstring(text[a:b+6])
+    paths = {'Record Rate(fps)':'recordInfo/recordRate',\
+             'Total Frame':'frameInfo/totalFrame',\
+             'Start Frame':'frameInfo/startFrame',\
+             'Image Width':'imageDataInfo/resolution/width',\
+             'Image Height':'imageDataInfo/resolution/height',\
+             'Color Type':'imageDataInfo/colorInfo/type',\
+             'Color Bit':'imageDataInfo/colorInfo/bit',\
+             'EffectiveBit Depth':'imageDataInfo/effectiveBit/depth',\
+             'EffectiveBit Side':'imageDataInfo/effectiveBit/side',\
+             'File Format':'imageFileInfo/fileFormat'}
+    fields = {}
+    for k in paths:
+        node = root.find(paths[k])
+        if node is not None and node.text is not None: fields[k] = node.text.strip()
+    return fields
+
+####################################################################################
+def read_cih(filename):
+    """
+    Read a .cih or .cihx header. Returns dict with keys
+        width, height, nframes, fps, bits_per_pixel, color, rgb, bayer,
+        effective_bits, file_format
+    Values not present in the header are None.
+    """
+    with open(filename,'rb') as f: raw = f.read()
+    text = raw.decode('UTF-8',errors='ignore')
+    if '<cih>' in text: fields = __parse_cihx_xml__(text)
+    else: fields = __parse_cih_text__(text)
+
+    def get(k,conv=int):
+        try: return conv(fields[k])
+        except (KeyError,ValueError): return None
+
+    info = {'width':get('Image Width'), 'height':get('Image Height'),\
+            'nframes':get('Total Frame'), 'fps':get('Record Rate(fps)',float),\
+            'effective_bits':get('EffectiveBit Depth'),\
+            'file_format':fields.get('File Format')}
+
+    # Colour bit depth is per pixel, so RGB data is 3x the per-channel depth.
+    color = fields.get('Color Type','Mono').strip().lower().startswith('color')
+    bits = get('Color Bit')
+    info['color'] = color
+    info['rgb'] = color and (bits is not None) and (bits > 16)
+    info['bayer'] = color and not info['rgb']
+    if info['rgb']: bits //= 3
+    info['bits_per_pixel'] = bits
+    return info
+
+####################################################################################
+# pySciCam rawtype string matching a header, i.e. 'photron_mraw_color_12bit_bayer'
+def rawtype_from_cih(info):
+    if info['bits_per_pixel'] is None: return None
+    if info['file_format'] is not None and info['file_format'].lower() != 'mraw':
+        raise ValueError("Photron file format %s is not supported" % info['file_format'])
+    if info['color']: rawtype = 'photron_mraw_color_%ibit' % info['bits_per_pixel']
+    else: rawtype = 'photron_mraw_mono_%ibit' % info['bits_per_pixel']
+    if info['bayer']: rawtype += '_bayer'
+    return rawtype
@@ -10,7 +10,9 @@
 
     Department of Mechanical & Aerospace Engineering
     Monash University, Australia
-    
+
+    See frame_select for the frames, roi and out arguments.
+
     Please see help(pySciCam) for more information.
 
 """
@@ -29,18 +31,23 @@ cimport numpy as np
 from libc.math cimport floor, ceil
 from libc.stdio cimport FILE, fopen, fclose, fread, fseek, SEEK_END, SEEK_SET, SEEK_CUR
 from libc.stdlib cimport malloc, free
-cdef FILE * cfile
 
 # this is the type of the output array.
 DTYPE = np.uint16
 ctypedef np.uint16_t DTYPE_t
 
+from . import frame_select
+
+include "raw_unpack.pxi"
+
+
 @cython.cdivision(True)
-#@cython.boundscheck(False)
+@cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
-def read_mraw(filename, int width, int height, int rgbmode = 0, tuple frames=None,\
-                          int bits_per_pixel=12, long long start_offset = 0, int quiet = 0):
+def read_mraw(filename, int width, int height, int rgbmode = 0, frames=None,\
+                          int bits_per_pixel=12, long long start_offset = 0, int quiet = 0,\
+                          int nthreads = 1, int scanline_pad = -1, roi = None, out = None):
 
     cdef double t0 = time.time()
     cdef double bytes_per_pixel
@@ -50,27 +57,27 @@ def read_mraw(filename, int width, int height, int rgbmode = 0, tuple frames=Non
     # width and height MUST be specified.
     if (width is None) or (height is None):
         raise ValueError("RAW reader requires height and width")
+    if not bits_per_pixel in (8,12,16):
+        raise ValueError("Unknown bits_per_pixel=%i" % bits_per_pixel)
 
     # Get size of binary file before we start reading
     # (it might be smaller than we think)
     cdef long long nbytes = os.path.getsize(filename)
 
-    # Scanlines are padded to nearest 16 bytes
-    cdef unsigned int scanline_pad = int((width*1.5)%16)
-    cdef unsigned int scanline_bytes = int(width*1.5) + scanline_pad
-    
-    # Bytes padding between frames
-    cdef int frame_pad =0
-    if scanline_pad > 0: frame_pad = 0
+    # Values (pixels or colour samples) per scanline
+    cdef long long values_per_row = width
+    if rgbmode == 1: values_per_row *= 3
+    cdef long long row_bytes = (values_per_row*bits_per_pixel)//8
 
-    cdef int bytes_per_frame = int(height*width*bytes_per_pixel) \
-                            + scanline_pad*height + frame_pad
-
-    # Given the supplied width and height, determine number of frames
-    cdef int nframes =  int(floor(nbytes/bytes_per_frame))
-
-    if nframes < 1 : raise IOError("File has no frames at specified resolution")
+    # 12-bit scanlines are assumed padded to nearest 16 bytes,
+    # unless scanline_pad is known (ie. from .cih header)
+    cdef long long row_pad = 0
+    if scanline_pad >= 0: row_pad = scanline_pad
+    elif bits_per_pixel == 12: row_pad = int((width*1.5)%16)
+    if (bits_per_pixel == 12) and (values_per_row % 2 != 0):
+        raise ValueError("12-bit packed MRAW requires an even number of pixels per scanline")
 
+    cdef long long bytes_per_frame = (row_bytes + row_pad)*height
 
     # check start_offset
     if start_offset < 0:
@@ -80,6 +87,12 @@ def read_mraw(filename, int width, int height, int rgbmode = 0, tuple frames=Non
     if (quiet == 0) and (start_offset > 0):
         print('Offset by %i bytes' % start_offset)
 
+    # Given the supplied width and height, determine number of frames
+    cdef int nframes =  int(floor((nbytes-start_offset)/bytes_per_frame))
+
+    if nframes < 1 : raise IOError("File has no frames at specified resolution")
+
+
     if quiet == 0: print("File contains %i frames (%i x %i)" % (nframes,width,height))
     cdef int remainder_bytes = np.mod(nbytes,bytes_per_pixel*width*height)
     if remainder_bytes > 0:
@@ -87,75 +100,67 @@ def read_mraw(filename, int width, int height, int rgbmode = 0, tuple frames=Non
 
 
 
-    # Limit number of frames loaded from file (good for testing)
-    cdef long long start = start_offset # bytes
-    cdef long long end = nbytes
-    if frames is not None:
-        if frames[1] > 0:
-            start = start_offset + int(bytes_per_frame*frames[0])
-            end = start_offset + int(bytes_per_frame*frames[1])
-        if start > nbytes:
-            raise ValueError("frame range: Cannot start reading beyond end of file!")
-        if end > nbytes:
-            print("Warning: requested read past EOF, truncating")
-            end = nbytes
-        if quiet == 0: print("Reading frames %i to %i" % frames)
-        nframes = frames[1]-frames[0]
+    # Select frames to load. Only these are read from the file.
+    indices = frame_select.frame_indices(frames, nframes, quiet)
+    if (quiet == 0) and (frames is not None):
+        print("Reading %s" % frame_select.describe(indices))
+    nframes = len(indices)
+    runs = frame_select.frame_runs(indices)
+
+    # Region of interest (inclusive bounds)
+    roi = frame_select.check_roi(roi, height, width)
+    cdef int out_height = height, out_width = width
+    if roi is not None:
+        out_height = roi[1]-roi[0]+1
+        out_width = roi[3]-roi[2]+1
+        if quiet == 0: print("Reading region of interest %i x %i" % (out_width,out_height))
 
     # make new image array (flattened)
     cdef long long totalpixels
     if rgbmode==1: totalpixels = 3*nframes
     else: totalpixels = nframes
-    totalpixels *= height
-    totalpixels *= width
-    cdef np.ndarray[DTYPE_t, ndim=1] images = np.zeros(int(totalpixels),dtype=DTYPE)
-
-    # read array in
-    cdef long long i
-    cdef int flag
-    cdef int npixels = int(ceil((end-start)/bytes_per_pixel))
-    filename_byte_string = filename.encode("UTF-8")
-    cdef char * fname = filename_byte_string
-    cdef unsigned char * buffer = <unsigned char*>malloc(3)
-    cdef unsigned int buf2
-
-    cfile = fopen(fname, "rb")
-    if cfile:
-        if start>0: fseek (cfile, start, SEEK_SET)
-        if bits_per_pixel==12: # loop every 3 bytes, read 2 pixels
-            for i in xrange(0,len(images),2):
-                flag = fread (&buffer, 1, 3, cfile)
-                buf2 = <int>buffer
-
-                # Read two pixels from three bytes
-                images[i]   = <DTYPE_t>(((buf2 & 0xFF) << 4) | ((buf2 & 0xF000) >> 12)  )
-                images[i+1] = <DTYPE_t>(((buf2 & 0xFF0000) >> 16) | (buf2 & 0xF00) )
-
-                # Scanline padded to nearest 16 bytes
-                if (i>0) and (i%width==0):
-                    fseek (cfile, scanline_pad, SEEK_CUR)
-                    if (i%(width*height)==0):
-                        fseek (cfile, frame_pad, SEEK_CUR)
-
-        elif bits_per_pixel==16: # loop every 2 bytes, write 1 pixel
-            for i in xrange(0,len(images)):
-                flag = fread (&buffer, 1, 2, cfile)
-                buf2 = <int>buffer
-                images[i]   = <DTYPE_t>(buf2 & 0xFFFF)
-
-        elif bits_per_pixel==8: # loop 1 byte, 1 pixel.
-            for i in xrange(0,len(images)):
-                flag = fread (&buffer, 1, 1, cfile)
-                buf2 = <int>buffer
-                images[i]   = <DTYPE_t>(buf2 & 0xFFFF)
-
-    fclose(cfile)
-
-    if quiet == 0: print('Read %.1f MiB in %.1f sec' % ((end-start)/1048576,time.time()-t0))
+    totalpixels *= out_height
+    totalpixels *= out_width
+    if rgbmode==1: shape = (nframes,3,out_height,out_width)
+    else: shape = (nframes,out_height,out_width)
+    frame_select.check_out(out, shape, DTYPE)
+    # RGB samples are interleaved in the file, so can't be unpacked straight into out.
+    cdef bint direct = (rgbmode==0) and frame_select.direct_out(out, DTYPE)
+    cdef np.ndarray[DTYPE_t, ndim=1] images
+    if direct: images = out.reshape(-1)
+    else: images = np.zeros(int(totalpixels),dtype=DTYPE)
+
+    cdef DTYPE_t * data = <DTYPE_t *> images.data
+
+    # Read the file in large blocks of whole frames and unpack each block
+    # with the GIL released, optionally on several threads.
+    # With a region of interest, only the scanlines needed are read.
+    cdef int mode
+    if bits_per_pixel == 12: mode = UNPACK_12BIT_MSB
+    elif bits_per_pixel == 16: mode = UNPACK_16BIT
+    else: mode = UNPACK_8BIT
+    if (quiet == 0) and (nthreads > 1): print("Unpacking on %i threads" % nthreads)
+    cdef long long pos
+    cdef long long values_per_pixel = values_per_row // width
+    if roi is not None:
+        pos = read_frame_blocks(filename.encode("UTF-8"), data, start_offset, runs, height,\
+                                row_bytes, row_pad, values_per_row, mode, nthreads,\
+                                (roi[0], out_height, roi[2]*values_per_pixel,\
+                                 out_width*values_per_pixel))
+    elif row_pad == 0:
+        pos = read_frame_blocks(filename.encode("UTF-8"), data, start_offset, runs, 1,\
+                                row_bytes*height, 0, values_per_row*height, mode, nthreads)
+    else:
+        pos = read_frame_blocks(filename.encode("UTF-8"), data, start_offset, runs, height,\
+                                row_bytes, row_pad, values_per_row, mode, nthreads)
+
+    if quiet == 0: print('Read %.1f MiB in %.1f sec' % (pos/1048576,time.time()-t0))
 
     # Return 3D array (un-flatten the output)
     if rgbmode==1:
-        return np.moveaxis(images.reshape((nframes,height,width,3)),[0,3,1,2],[0,1,2,3])
+        arr = np.moveaxis(images.reshape((nframes,out_height,out_width,3)),[0,3,1,2],[0,1,2,3])
     else:
-        return images.reshape((nframes,height,width))
-
+        arr = images.reshape((nframes,out_height,out_width))
+    if out is None: return arr
+    if not direct: out[...] = arr
+    return out
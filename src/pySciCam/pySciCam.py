@@ -50,7 +50,15 @@ Class to read images from high speed and scientific cameras in Python
     used, which is easier to install. However, Pillow only supports 8-bit RGB, and
     8,16,32 bit greyscale.
     
-    Experimental multipage TIFF support added in v0.4.3
+    Experimental multipage TIFF support added in v0.4.3. The pages of a multipage
+    TIFF are counted exactly from the file's index, and uncompressed pages are read
+    straight from the file in parallel.
+
+    The frames of a movie are counted from its container's header, or from the
+    packets in the container if the header has no count or the frame rate varies,
+    without decoding them. So the array is allocated to the right size and variable
+    frame rate movies are read correctly. The time of each frame loaded, in seconds
+    from the start of the movie, is kept in the frame_times attribute.
     
     EXAMPLE USAGE:
     
@@ -63,6 +71,13 @@ Class to read images from high speed and scientific cameras in Python
         # Read a RAW binary blob from a particular camera
         data = pySciCam.ImageSequence("foo.raw",rawtype='bar_cam')
         
+        # Read every 10th frame of a movie
+        data = pySciCam.ImageSequence("movie.mp4",frames=slice(0,None,10))
+        
+        # Frame count, shape and dtype of a recording, from its headers only
+        info = pySciCam.probe("foo.raw",rawtype='bar_cam')
+        print(info.N, info.shape(), info.dtype, info.nbytes)
+        
         # Print pixel values of the 10th frame of monochrome data
         from matplotlib import pyplot
         pyplot.imshow(data.arr[9,...])
@@ -75,6 +90,9 @@ Class to read images from high speed and scientific cameras in Python
     KEYWORD ARGS FOR ImageSequence CLASS:
         frames:
             2-tuple of form (start,end) to trim a range of frames.
+            Can also be a slice, ie. slice(0,None,10) for every 10th
+            frame, or a list of frame numbers. Only the selected frames
+            are read from disk or decoded.
         
         dtype:
             force the destination array to a certain data type, for
@@ -92,10 +110,53 @@ Class to read images from high speed and scientific cameras in Python
         IO_threads:
             Number of I/O threads for parallel reading of sets of still
             images. Default is 4. Set to 1 to disable parallel I/O.
+
+        IO_backend:
+            How sets of still images are read in parallel. 'threads'
+            uses a pool of threads that is kept between loads, and decodes
+            straight into the array. 'processes' uses joblib worker
+            processes, which helps for decoders that hold the GIL but pays
+            for process startup and copying of pixel data. 'serial'
+            disables parallel I/O. The default is 'threads', or
+            'processes' for images read with PythonMagick, which holds
+            the GIL while decoding.
             
         use_magick:
             Manually disable use of PythonMagick, if not installed. Falls
             back to PIL, which is easier to install but supports fewer formats.
+
+        out:
+            preallocated array to load the images into, ie. an np.memmap
+            on a fast scratch disk for sequences larger than RAM, or a
+            buffer reused between loads. Must have the shape of the data
+            loaded, and a dtype that can hold it (this is used as the
+            dtype if dtype is not given). Not used with lazy=True.
+
+        dir_index:
+            for directories of many images (ie. on network storage), keep
+            the sorted list of files in an index file, which is reused
+            until files are added to or removed from the directory.
+            True to write .pySciCam_index inside the directory, or the
+            name of the index file to use. Default is False.
+
+        cache_dir:
+            directory for an on-disk cache of decoded data. The first
+            time a recording is opened with a given set of keyword args,
+            the decoded array is saved there. Opening it again with the
+            same args maps the saved array from disk instead of reading
+            and decoding the recording. The cache is invalidated when a
+            file's size or modification time changes. Not used with lazy=True
+            or defer_bayer=True.
+
+        cache_size:
+            size limit of cache_dir in bytes. Least recently used entries
+            are deleted to stay under it. Default is 16 GiB.
+
+        roi:
+            4-tuple (y1,y2,x1,x2) region of interest to load, with the
+            same inclusive bounds as crop(). Unlike crop(), the region is
+            applied while reading: RAW readers skip the other scanlines
+            and columns, and images and movies are cropped frame by frame.
             
     ADDITIONAL ARGS FOR RAW TYPES:
     
@@ -104,7 +165,9 @@ Class to read images from high speed and scientific cameras in Python
             that don't specify it
             
         rawtype:
-            string describing the format of a RAW (binary) file
+            string describing the format of a RAW (binary) file.
+            For Photron MRAW files with a .cih or .cihx header file
+            alongside, rawtype, width and height are read from the header.
             
         b16_doubleExposure:
             boolean. If PCO B16 image, is it a double exposure?
@@ -114,11 +177,48 @@ Class to read images from high speed and scientific cameras in Python
             
         old_packing_order: (chronos formats only)
             unpack 12-bit RAW data from Chronos firmware 0.2
+
+        nthreads: (chronos, photron and movie formats only)
+            number of threads used to read and unpack RAW data in parallel.
+            Default is 1 (serial). For movies, the frames are split at
+            keyframes into nthreads segments, which are decoded at the
+            same time by separate ffmpeg processes.
+
+        memmap:
+            boolean. For RAW types that store plain 8 or 16 bit pixels
+            (see raw_handler.memmap_types), map the file into memory
+            instead of reading it. Opening is instant and pixels are
+            read on demand. Changes to the array are not written to disk.
+
+        lazy:
+            boolean. Don't load the images when opening. Instead, arr is
+            an array-like LazyFrameArray and indexing it reads only the
+            frames requested, ie. data.arr[1000:1010]. N, width, height
+            and shape() are known straight away. Methods that modify
+            the whole array (crop, flip etc) will read every frame.
+            Frames are read in small chunks, which are kept in memory in
+            a cache shared by all lazy sequences, so going back and forth
+            over the same frames doesn't read them again. The cache_hits
+            and cache_misses attributes count chunks found and read.
+
+        chunk_cache_size:
+            size limit in bytes of the chunk cache for lazy=True and
+            defer_bayer=True. This is shared by all sequences. Default
+            is 1 GiB, 0 disables it.
+
+        defer_bayer: (chronos14_color and photron bayer formats only)
+            boolean. Read the colour camera's Bayer mosaic into memory
+            but don't demosaic it. arr is then a LazyFrameArray that
+            demosaics frames in chunks as they are indexed, keeping
+            recent chunks in the chunk cache (see lazy). The mosaic is a
+            third of the size of the colour frames, and frames that are
+            never read are never decoded. Can't be used with out.
     
     BUILT-IN FUNCTIONS
     
         open(self,[path,frames,monochrome,dtype,width,height,rawtype,
-             b16_doubleExposure,start_offset,use_magick):
+             b16_doubleExposure,start_offset,use_magick,nthreads,memmap,lazy,
+             roi,out,dir_index,cache_dir,cache_size,chunk_cache_size,defer_bayer]):
              function called by class constructor to open images.
     
         shape():
@@ -146,6 +246,13 @@ Class to read images from high speed and scientific cameras in Python
         
         flipv():
             flip images top to bottom.
+
+        iter_chunks(chunk_frames=100,frames=None):
+            generator yielding (start_index, array) for successive blocks of
+            up to chunk_frames frames, optionally of a selection of frames
+            given as for the frames kwarg ((start,end), slice or list).
+            start_index is the frame number of the first frame in the block.
+            Open with lazy=True so that only one block is held in memory.
         
     
     Future support planned for:
@@ -169,6 +276,48 @@ import numpy as np
 from . import raw_handler
 from . import movie_handler
 from . import image_sequence_handler
+from . import frame_select
+from . import tiff_reader
+from . import file_index
+from . import frame_cache
+from . import lazy_array
+from .lazy_array import LazyFrameArray
+
+##########################################################################################
+# Find the files to read for path, which is a file, wildcard or directory.
+# Returns (extension, naturally sorted list of files with the first known extension found),
+# or (None, []). A single multipage TIFF is expanded to its list of pages, "file.tif[n]".
+# The pages are counted from the chain of IFDs in the file, so the number of frames is exact.
+# Directories are listed in one pass (see file_index), optionally kept in an index file.
+def __find_images__(path,dir_index=False):
+    if os.path.isdir(path):
+        ext, all_images = file_index.list_directory(path,ImageSequence.all_known_extensions,\
+                                                    dir_index)
+        if ext is None: return None, []
+    else:
+        # Wildcard search
+        all_images = glob.glob(path)
+    
+        # Set extension and filter on this.
+        ext=None
+        for f in all_images:
+            if os.path.splitext(f)[-1].lower() in ImageSequence.all_known_extensions:
+                ext=os.path.splitext(f)[-1].lower()
+                break
+        if ext is None: return None, []
+    
+        # Natural sort and all matching extension
+        all_images = natsorted([f for f in all_images if os.path.splitext(f)[-1].lower()==ext])
+
+    # Check for multipage TIFF.
+    if (len(all_images)==1) and ('tif' in ext):
+        try:
+            npages = tiff_reader.page_count(all_images[0])
+        except IOError as e:
+            print("\t%s" % e)
+            npages = 1
+        if npages>=2: all_images=tiff_reader.page_names(all_images[0],npages)
+    return ext, all_images
 
 ##########################################################################################
 class ImageSequence:
@@ -192,6 +341,19 @@ class ImageSequence:
         else:
             self.Joblib_Verbosity=int(kwargs['Joblib_Verbosity'])
             del kwargs['Joblib_Verbosity']
+
+        if not 'IO_backend' in kwargs.keys():
+            # Default is a persistent pool of threads, except for images decoded
+            # by PythonMagick (see image_sequence_handler)
+            self.IO_backend='threads'
+            self.IO_backend_default=True
+        else:
+            self.IO_backend=str(kwargs['IO_backend']).lower()
+            self.IO_backend_default=False
+            del kwargs['IO_backend']
+        if not self.IO_backend in image_sequence_handler.IO_backends:
+            raise ValueError("Unknown IO_backend `%s'. Allowed choices: %s"\
+                             % (self.IO_backend,image_sequence_handler.IO_backends))
          
         self.N=0
         self.arr = None
@@ -210,88 +372,191 @@ class ImageSequence:
     # Some handlers require some data that isn't autodetected (dtype, width, height, etc).
     def open(self,path,frames=None,monochrome=True,dtype=None,\
                        width=None,height=None,rawtype=None,b16_doubleExposure=True,\
-                       start_offset=0,use_magick=True):
+                       start_offset=0,use_magick=True,nthreads=1,memmap=False,lazy=False,\
+                       roi=None,out=None,dir_index=False,cache_dir=None,\
+                       cache_size=frame_cache.DEFAULT_CACHE_SIZE,chunk_cache_size=None,\
+                       defer_bayer=False):
         
-        # Wildcard search
         print("Reading %s" % path)
-        if os.path.isdir(path):
-            path+='/'
-            all_images = glob.glob(path+'*')
-        else:
-            all_images = glob.glob(path)
-        
-        # Set extension and filter on this.
-        self.ext=None
-        for f in all_images:
-            if os.path.splitext(f)[-1].lower() in self.all_known_extensions:
-                self.ext=os.path.splitext(f)[-1].lower()
-                break
+        self.ext, all_images = __find_images__(path,dir_index)
         if self.ext is None:
             print("** Error, no recognized file extensions found")
             return
         
-        # Natural sort and all matching extension
-        all_images = [f for f in natsorted(all_images) if os.path.splitext(f)[-1].lower()==self.ext]
-        
         # Number of images found
         if len(all_images)<1:
             print("** Error, no images found in path")
             return
+        elif tiff_reader.split_page(all_images[0])[1] is not None:
+            print("\tTreating as multipage TIFF - %i pages" % len(all_images))
         elif len(all_images)>1:
             print("\tFound %i images with extension %s" % (len(all_images),self.ext))
 
-        # Check for multipage TIFF
-        if use_magick and (len(all_images)==1) and ('tif' in self.ext):
-            try:
-                from PythonMagick import Image
-                I0 = Image(all_images[0])
-                if (I0.magick()=='TIFF'):
-                    approxNoFrames=int(I0.fileSize()/I0.size().width()/I0.size().height()/I0.depth()*8) # includes header, so > true N frames.
-                    if approxNoFrames>=2:
-                        if frames is None:
-                            print("\tTreating as multipage TIFF - estimated %i frames from file size" % approxNoFrames)
-                            all_images=["%s[%i]" % (all_images[0],n) for n in range(approxNoFrames)]
-                        else:
-                            print("\tTreating as multipage TIFF - frames specified explicitly")
-                            all_images=["%s[%i]" % (all_images[0],n) for n in range(frames[0],frames[1])]
-            except ImportError:
-                print("PythonMagick library is not installed.")
-                print("Falling back to Pillow (fewer file formats supported)")
-                use_magick = False
-            
+        # Caller-supplied output array sets the dtype, unless given explicitly.
+        if out is not None:
+            if lazy: raise ValueError("out cannot be used with lazy=True")
+            if defer_bayer: raise ValueError("out cannot be used with defer_bayer=True")
+            if dtype is None: dtype = out.dtype
+
+        # Settings for the loading subroutines. These are kept so that
+        # frames can be read again later on demand (lazy mode).
+        if self.ext == '.b16': rawtype='b16'
+        elif self.ext == '.b16dat': rawtype='b16dat'
+        self.files = all_images
+        self.load_settings = dict(monochrome=monochrome,dtype=dtype,width=width,height=height,\
+                                  rawtype=rawtype,b16_doubleExposure=b16_doubleExposure,\
+                                  start_offset=start_offset,use_magick=use_magick,\
+                                  nthreads=nthreads,memmap=memmap,roi=roi)
 
-        # Call appropriate loading subroutine
+        if chunk_cache_size is not None: lazy_array.chunk_cache.resize(chunk_cache_size)
+
+        if lazy and memmap and (self.ext in raw_handler.raw_formats):
+            print("\tMemory-mapped arrays are already read on demand, ignoring lazy flag")
+            lazy = False
+
+        # Lazy sequences only decode the frames read anyway
+        if lazy and defer_bayer:
+            print("\tFrames are already decoded on demand, ignoring defer_bayer flag")
+            defer_bayer = False
+        self.load_settings['defer_bayer'] = defer_bayer
+
+        if lazy:
+            self.__open_lazy__(all_images,frames)
+        elif (cache_dir is not None) and defer_bayer:
+            print("\tDeferred Bayer decoding, not using cache_dir")
+            self.__load_into__(self,all_images,frames,out)
+        elif cache_dir is not None:
+            self.__load_cached__(all_images,frames,out,cache_dir,cache_size)
+        else:
+            self.__load_into__(self,all_images,frames,out)
+
+        # update array properties
+        self.height, self.width = self.__frame_size__()
+        self.dtype = self.arr.dtype
+        self.N = self.arr.shape[0]
+
+        if isinstance(self.arr,LazyFrameArray):
+            print("\tData read on demand:\t",self.shape(),'\t',self.dtype)
+        elif isinstance(self.arr,np.memmap):
+            # Don't scan the whole file
+            print("\tData mapped from disk:\t",self.shape(),'\t',self.dtype)
+        else:
+            print("\tData in memory:\t",self.shape())
+            print("\tIntensity range:\t",self.arr.min(),"to",self.arr.max(),'\t',self.dtype)
+        self.stored_bits_per_pixel()
+        print("\tArray size:\t%.1f MB" % (np.prod(self.arr.shape)*self.bpp/1024./1024.))
+        return
+
+    # Call appropriate loading subroutine to read files into target,
+    # which is an ImageSequence (either this one, or a temporary one
+    # for reading part of a lazy sequence).
+    # If out is given, the data ends up in that array.
+    def __load_into__(self,target,all_images,frames,out=None):
+        s = self.load_settings
         if self.ext in movie_handler.movie_formats:
             # Movie formats
-            movie_handler.load_movie(self,all_images[0],frames,monochrome,dtype)
+            movie_handler.load_movie(target,all_images[0],frames,s['monochrome'],s['dtype'],\
+                                     s['roi'],out,s['nthreads'])
         
         elif self.ext in raw_handler.raw_formats:
             # Hardware-specific raw formats.
             #  the variable rawtype specifies which reader is to be used,
             #  as the extension does not always tell us enough. For B16,
             #  we can infer it from the extension.
-            if self.ext == '.b16': rawtype='b16'
-            elif self.ext == '.b16dat': rawtype='b16dat'
-            raw_handler.load_raw(self,all_images,rawtype,width,height,frames,dtype,\
-                                 b16_doubleExposure,start_offset)
+            raw_handler.load_raw(target,all_images,s['rawtype'],s['width'],s['height'],frames,\
+                                 s['dtype'],s['b16_doubleExposure'],s['start_offset'],\
+                                 s['nthreads'],s['memmap'],s['roi'],out,s['defer_bayer'])
 
         else:
             # Sequences of images (ie TIFFs, BMPs)
-            image_sequence_handler.load_image_sequence(self,all_images,frames,\
-                            monochrome,dtype,use_magick)
-        
-        # update array properties
-        self.width = self.arr.shape[2]
-        self.height = self.arr.shape[1]
-        self.dtype = self.arr.dtype
-        self.N = self.arr.shape[0]
+            image_sequence_handler.load_image_sequence(target,all_images,frames,\
+                            s['monochrome'],s['dtype'],s['use_magick'],s['roi'],out)
 
-        print("\tData in memory:\t",self.shape())
-        print("\tIntensity range:\t",self.arr.min(),"to",self.arr.max(),'\t',self.dtype)
-        self.stored_bits_per_pixel()
-        print("\tArray size:\t%.1f MB" % (np.prod(self.arr.shape)*self.bpp/1024./1024.))
+        # Handlers that can't write straight into out (ie. Bayer decoding,
+        # memory-mapped files) are copied in afterwards.
+        if (out is not None) and (target.arr is not out):
+            frame_select.check_out(out,target.arr.shape,target.arr.dtype)
+            out[...] = target.arr
+            target.arr = out
+        return
+
+    # Map decoded data from the on-disk cache in cache_dir (see frame_cache) if it is
+    # there, otherwise load it and add it to the cache.
+    def __load_cached__(self,all_images,frames,out,cache_dir,cache_size):
+        key = frame_cache.cache_key(all_images,frames,self.ext,self.load_settings)
+        if frame_cache.load(self,cache_dir,key):
+            print("\tDecoded data found in cache %s" % cache_dir)
+            if out is not None:
+                frame_select.check_out(out,self.arr.shape,self.arr.dtype)
+                out[...] = self.arr
+                self.arr = out
+            return
+        self.__load_into__(self,all_images,frames,out)
+        # Memory-mapped RAW files are already read straight from disk
+        if not isinstance(self.arr,np.memmap):
+            frame_cache.store(self,cache_dir,key,cache_size)
+        return
+
+    # New empty ImageSequence with the same I/O settings, to load frames into.
+    def __scratch__(self):
+        scratch = ImageSequence(IO_threads=self.IO_threads,Joblib_Verbosity=self.Joblib_Verbosity,\
+                                IO_backend=self.IO_backend)
+        scratch.IO_backend_default = self.IO_backend_default
+        return scratch
+
+    # Set up self.arr as a LazyFrameArray. Only the first frame is read now, to
+    # find the frame size and dtype. The number of frames comes from the file size,
+    # file count or the movie's container.
+    def __open_lazy__(self,all_images,frames):
+        s = self.load_settings
+        if self.ext in movie_handler.movie_formats:
+            nframes = movie_handler.movie_frame_count(all_images[0])
+        elif self.ext in raw_handler.raw_formats:
+            nframes = raw_handler.raw_frame_count(all_images,s['rawtype'],s['width'],s['height'],\
+                                                  s['b16_doubleExposure'],s['start_offset'])
+        else:
+            nframes = len(all_images)
+
+        # Frame numbers in the file(s) that the lazy array covers
+        self.frame_index = frame_select.frame_indices(frames,nframes)
+
+        # Read first frame to get the frame shape & dtype
+        scratch = self.__scratch__()
+        self.__load_into__(scratch,*self.__window__((0,1)))
+        # Keep metadata found by the handler (mode, src_bpp, fps etc)
+        for k in scratch.__dict__:
+            if not k in ('arr','N','IO_threads','Joblib_Verbosity','IO_backend','IO_backend_default'):
+                self.__dict__[k] = scratch.__dict__[k]
+        if hasattr(scratch,'frame_times'):
+            self.frame_times = movie_handler.movie_info(all_images[0])['times'][self.frame_index]
+        self.arr = LazyFrameArray(self.__read_frames__,len(self.frame_index),scratch.arr.shape[1:],\
+                                  scratch.arr.dtype)
         return
 
+    # Arguments to __load_into__ for the given frames of a lazy sequence
+    def __window__(self,frames):
+        indices = [self.frame_index[i] for i in frame_select.frame_indices(frames,len(self.frame_index))]
+        if (self.ext in movie_handler.movie_formats) or (self.ext in raw_handler.raw_formats):
+            return self.files, frame_select.compact(indices)
+        else:
+            return [self.files[i] for i in indices], None
+
+    # Read the given frames of a lazy sequence into a new array.
+    def __read_frames__(self,frames):
+        scratch = self.__scratch__()
+        self.__load_into__(scratch,*self.__window__(frames))
+        return scratch.arr
+
+    # Chunks of frames of a lazy sequence found in, and missing from, the in-memory
+    # chunk cache (see lazy_array). Always 0 for sequences loaded into memory.
+    @property
+    def cache_hits(self):
+        return getattr(self.arr,'cache_hits',0)
+
+    @property
+    def cache_misses(self):
+        return getattr(self.arr,'cache_misses',0)
+
     # Calculate stored bits per pixel based on self.dtype.
     # the source data may have had a different value (it would be in self.src_bpp)
     def stored_bits_per_pixel(self):
@@ -317,38 +582,82 @@ class ImageSequence:
                     self.arr=self.arr.astype(self.dtype)
         return
 
+    # Iterate over the sequence in blocks of chunk_frames frames.
+    # Yields (start_index, array) where array holds the next chunk_frames frames of the
+    # selection frames (see frame_select), and start_index is the first frame's number.
+    # For lazy sequences each block is read from disk when it is needed, so peak memory
+    # is set by chunk_frames rather than the length of the recording.
+    def iter_chunks(self,chunk_frames=100,frames=None):
+        if self.arr is None: return
+        chunk_frames = int(chunk_frames)
+        if chunk_frames < 1: raise ValueError("chunk_frames must be at least 1")
+        indices = frame_select.frame_indices(frames,self.N,quiet=1)
+        for a in range(0,len(indices),chunk_frames):
+            block = indices[a:a+chunk_frames]
+            if isinstance(self.arr,LazyFrameArray):
+                # Read in file order, then put the frames in the order asked for
+                unique = sorted(set(block))
+                arr = self.arr.read_frames(frame_select.compact(unique))
+                if unique != block: arr = arr[np.searchsorted(unique,block)]
+            else:
+                # Contiguous and evenly spaced blocks are views of the array
+                s = frame_select.as_slice(block)
+                if s is None: arr = self.arr[block]
+                else: arr = self.arr[s]
+            yield block[0], arr
+        return
+
     # Shape of image array
     def shape(self):
-        if isinstance(self.arr,np.ndarray):
+        if isinstance(self.arr,(np.ndarray,LazyFrameArray)):
             return self.arr.shape
         else:
             return None
 
+    # Axes of self.arr holding the image rows and columns. Colour movies are
+    # stored (N,H,W,3), other colour data (N,3,H,W).
+    def __image_axes__(self):
+        if (self.arr.ndim == 4) and (self.arr.shape[-1] == 3) and (self.arr.shape[1] != 3):
+            return -3, -2
+        return -2, -1
+
+    # Height and width of each image in self.arr
+    def __frame_size__(self):
+        y_axis, x_axis = self.__image_axes__()
+        return self.arr.shape[y_axis], self.arr.shape[x_axis]
+
     # Crop array to y1:y2, x1:x2
     def crop(self,y1,y2,x1,x2):
-        self.arr = self.arr[...,y1:y2+1,x1:x2+1]
-        self.width = self.arr.shape[-1]
-        self.height = self.arr.shape[-2]
+        if self.__image_axes__() == (-3,-2): self.arr = self.arr[...,y1:y2+1,x1:x2+1,:]
+        else: self.arr = self.arr[...,y1:y2+1,x1:x2+1]
+        self.height, self.width = self.__frame_size__()
         return
         
+    # Set self.arr[key] = fillValue. Lazy sequences are masked as frames are read.
+    def __mask__(self,key,fillValue):
+        if self.__image_axes__() == (-3,-2): key = key+(slice(None),)
+        if isinstance(self.arr,LazyFrameArray): self.arr = self.arr.fill(key,fillValue)
+        else: self.arr[key] = fillValue
+        return
+
     # Mask circle
     def mask_radius(self,y,x,r,fillValue=0):
         yy, xx = np.meshgrid(range(self.width), range(self.height))
         mask = np.sqrt((xx-x)**2 + (yy-y)**2)<=r
-        self.arr[...,mask] = fillValue
+        self.__mask__((Ellipsis,mask),fillValue)
         return
         
     # Mask rectangle
     def mask_box(self,y1,y2,x1,x2,fillValue=0):
-        self.arr[...,y1:y2+1,x1:x2+1] = fillValue
+        self.__mask__((Ellipsis,slice(y1,y2+1),slice(x1,x2+1)),fillValue)
         
     # Flip images
     def flipv(self):
-        self.arr = np.flip(self.arr, axis=-2)
+        self.arr = np.flip(self.arr, axis=self.__image_axes__()[0])
         return
         
     def fliph(self):
-        self.arr = np.flip(self.arr, axis=-1)
+        self.arr = np.flip(self.arr, axis=self.__image_axes__()[1])
         return
         
     # Perform Bayer decoding on colour data loaded from RAW format.
@@ -358,6 +667,8 @@ class ImageSequence:
         # Use IO_threads as number of cpus to parallelize on, by default.
         if not 'ncpus' in kwargs.keys():
             kwargs['ncpus']=self.IO_threads
+        if not 'IO_backend' in kwargs.keys():
+            kwargs['IO_backend']=self.IO_backend
         #kwargs['JobLib_Verbosity']=self.Joblib_Verbosity
         
         from .bayer_decode import fbayerDecode
@@ -365,3 +676,110 @@ class ImageSequence:
         self.arr = fbayerDecode(self.arr, **kwargs)
         #print('RGB array is now of size %s' % str(self.shape()))
         return
+
+##########################################################################################
+class SequenceInfo:
+    """
+    Description of a recording, returned by probe(). Attributes are named as for
+    ImageSequence:
+        path, ext, files, rawtype, mode, N, width, height, dtype, src_bpp, fps
+    shape() is the shape of the array that ImageSequence would load with the same
+    keyword args, and nbytes is its size in memory.
+    """
+
+    def __init__(self,path,ext,files,shape,dtype,width,height,src_bpp,rawtype=None,\
+                 mode=None,fps=None):
+        self.path = path
+        self.ext = ext
+        self.files = files
+        self.rawtype = rawtype
+        self.mode = mode
+        self.N = shape[0]
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype)
+        self.src_bpp = src_bpp
+        self.fps = fps
+        self.__shape = tuple(int(n) for n in shape)
+        return
+
+    def shape(self):
+        return self.__shape
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.__shape))*self.dtype.itemsize
+
+    def __repr__(self):
+        return "SequenceInfo(%s: shape=%s, dtype=%s, src_bpp=%s, fps=%s)" \
+               % (self.path,str(self.__shape),self.dtype,str(self.src_bpp),str(self.fps))
+
+##########################################################################################
+def probe(path,frames=None,monochrome=True,dtype=None,width=None,height=None,rawtype=None,\
+          b16_doubleExposure=True,start_offset=0,roi=None,IO_threads=8,IO_backend='threads',\
+          dir_index=False,**kwargs):
+    """
+    Describe the recording at path without reading any pixels, using only file
+    headers (RAW and B16 headers, Photron .cih/.cihx, TIFF IFDs, movie containers)
+    and file sizes. For a directory of images, every file's header is checked, in
+    parallel on IO_threads threads, and all must give the same image size.
+    Takes the same keyword args as ImageSequence. Those that don't change the
+    array loaded (nthreads, lazy, use_magick etc) are ignored, as is memmap: the
+    dtype given is that of a normal read.
+    Returns SequenceInfo.
+    """
+    ext, all_images = __find_images__(path,dir_index)
+    if ext is None: raise IOError("No recognized files found at `%s'" % path)
+    mode = None
+    fps = None
+
+    # Size of each frame, shape of each frame in the array, dtype, and source bits per pixel
+    if ext in movie_handler.movie_formats:
+        m = movie_handler.movie_info(all_images[0])
+        nframes, H, W, fps, mode = m['nframes'], m['height'], m['width'], m['fps'], 'MOVIE'
+        src_dtype = np.uint8
+        if not monochrome: frame_shape = (H,W,3)
+        else: frame_shape = (H,W)
+
+    elif ext in raw_handler.raw_formats:
+        if ext == '.b16': rawtype='b16'
+        elif ext == '.b16dat': rawtype='b16dat'
+        r = raw_handler.raw_info(all_images,rawtype,width,height,b16_doubleExposure,start_offset,\
+                                 IO_threads,IO_backend)
+        rawtype, nframes, frame_shape, fps = r['rawtype'], r['nframes'], r['frame_shape'], r['fps']
+        H, W = frame_shape[-2:]
+        dtype = r['dtype'] # RAW readers always give uint16
+        monochrome = False
+
+    else:
+        # Only the headers of the selected frames are read
+        nframes = len(all_images)
+        selected = [all_images[i] for i in frame_select.frame_indices(frames,nframes,quiet=1)]
+        st = image_sequence_handler.still_info(selected,IO_threads,IO_backend)
+        H, W = st['height'], st['width']
+        src_dtype = {8:np.uint8,12:np.uint16,16:np.uint16,32:np.uint32,64:np.uint64}[st['bits_per_pixel']]
+        if st['rgb']: mode = 'RGB'
+        else: mode = 'L'
+        monochrome = monochrome or not st['rgb']
+        if not monochrome: frame_shape = (3,H,W)
+        else: frame_shape = (H,W)
+
+    # Destination dtype. When colour is summed to mono, the loaders bump up the bit depth.
+    if dtype is None:
+        dtype = np.dtype(src_dtype)
+        if monochrome and (dtype.itemsize < 8): dtype = np.dtype('u%i' % (2*dtype.itemsize))
+
+    N = len(frame_select.frame_indices(frames,nframes,quiet=1))
+    roi = frame_select.check_roi(roi,H,W)
+    if roi is not None:
+        H, W = roi[1]-roi[0]+1, roi[3]-roi[2]+1
+        if (mode == 'MOVIE') and not monochrome: frame_shape = (H,W,3)
+        else: frame_shape = frame_shape[:-2]+(H,W)
+    shape = (N,)+tuple(frame_shape)
+
+    if mode == 'MOVIE':
+        src_bpp = 8*os.path.getsize(all_images[0])/float(np.prod(shape))
+    elif ext in raw_handler.raw_formats: src_bpp = r['src_bpp']
+    else: src_bpp = st['bits_per_pixel']
+
+    return SequenceInfo(path,ext,all_images,shape,dtype,W,H,src_bpp,rawtype,mode,fps)
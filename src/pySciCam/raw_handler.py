@@ -35,10 +35,245 @@ raw_types = ['b16','b16dat',\
              'photron_mraw_color_16bit_bayer','photron_mraw_color_16bit',\
              'photron_mraw_mono_16bit']
 
+# Raw types stored as plain little-endian pixel arrays, which can be memory-mapped
+# without unpacking (memmap kwarg).
+memmap_types = ['b16','b16dat','chronos14_mono_16bit','chronos14_color_16bit',\
+                'photron_mraw_color_8bit_bayer','photron_mraw_color_8bit',\
+                'photron_mraw_mono_8bit','photron_mraw_color_16bit_bayer',\
+                'photron_mraw_color_16bit','photron_mraw_mono_16bit']
+
+import os
 import numpy as np
+from . import frame_select
+
+def __memmap_frames__(filename,dtype,frame_shape,frames=None,start_offset=0,roi=None):
+    """
+    Map a file of contiguous fixed-size frames as a read-only (copy-on-write)
+    np.memmap of shape (nframes,)+frame_shape. No pixel data is read until accessed.
+    roi=(y1,y2,x1,x2) takes a view of that region of the first two frame axes.
+    """
+    dtype = np.dtype(dtype)
+    bytes_per_frame = int(np.prod(frame_shape))*dtype.itemsize
+    nbytes = os.path.getsize(filename)
+    if start_offset < 0:
+        raise ValueError("start_offset cannot be negative")
+    nframes = (nbytes-start_offset)//bytes_per_frame
+    if nframes < 1: raise IOError("File has no frames at specified resolution")
+    print("\tFile contains %i frames (%s)" % (nframes,' x '.join([str(n) for n in frame_shape])))
+    mm = np.memmap(filename,dtype=dtype,mode='c',offset=start_offset,\
+                   shape=(nframes,)+tuple(frame_shape))
+    roi = frame_select.check_roi(roi,frame_shape[0],frame_shape[1])
+    if roi is None: region = (slice(None),slice(None))
+    else: region = (slice(roi[0],roi[1]+1),slice(roi[2],roi[3]+1))
+    if frames is None: return mm[(slice(None),)+region]
+    indices = frame_select.frame_indices(frames,nframes)
+    sel = frame_select.as_slice(indices)
+    if sel is None:
+        # Irregular selection - copy just those frames into memory
+        print("\tReading %s from memory-mapped file" % frame_select.describe(indices))
+        return np.array(mm[(indices,)+region])
+    print("\tMemory-mapping %s" % frame_select.describe(indices))
+    return mm[(sel,)+region]
+
+def __memmap_b16__(filename,doubleExposure=True,frames=None,roi=None):
+    """
+    Map the image blocks of a B16 or B16dat file as a strided, copy-on-write np.memmap,
+    skipping the headers between blocks. Returns None if the blocks are not evenly spaced
+    or overlap.
+    Frames are selected as in __memmap_frames__: evenly spaced ascending frames are a
+    view of the map, and other selections are copied from it.
+    """
+    from . import b16_raw
+    is_b16dat = filename.lower().endswith('.b16dat')
+    offsets, block_shape = b16_raw.b16_layout(filename,doubleExposure)
+    stride = np.diff(offsets)
+    if len(stride) > 0 and np.any(stride != stride[0]): return None
+    block_bytes = 2*int(np.prod(block_shape))
+    if len(stride) > 0: stride = int(stride[0])
+    else: stride = block_bytes
+    if stride < block_bytes: return None # blocks overlap
+    print("\tMemory-mapping %i image block(s) of %s" % (len(offsets),' x '.join([str(n) for n in block_shape])))
+
+    mm = np.memmap(filename,dtype='<u2',mode='c',offset=int(offsets[0]),\
+                   shape=(((len(offsets)-1)*stride + block_bytes)//2,))
+    item_strides = (block_shape[1]*block_shape[2]*2, block_shape[2]*2, 2)
+    arr = np.lib.stride_tricks.as_strided(mm,shape=(len(offsets),)+tuple(block_shape),\
+                                          strides=(stride,)+item_strides,subok=True,writeable=True)
+    roi = frame_select.check_roi(roi,block_shape[1],block_shape[2])
+    # B16dat frames are image pairs when double-exposed, otherwise single images
+    if not (is_b16dat and doubleExposure):
+        arr = arr.reshape((len(offsets)*block_shape[0],block_shape[1],block_shape[2]))
+    arr = __crop_roi__(arr,roi)
+    if frames is None: return arr
+    indices = frame_select.frame_indices(frames,arr.shape[0])
+    sel = frame_select.as_slice(indices)
+    if sel is None:
+        print("\tReading %s from memory-mapped file" % frame_select.describe(indices))
+        return np.array(arr[indices])
+    return arr[sel]
+
+# Output array to pass to a reader. Bayer data has a different shape before decoding.
+def __mono_out__(rawtype,out):
+    if ('chronos14_color' in rawtype) or ('bayer' in rawtype): return None
+    return out
+
+# View of region of interest (y1,y2,x1,x2) in the last two axes of arr.
+def __crop_roi__(arr,roi):
+    if roi is None: return arr
+    return arr[...,roi[0]:roi[1]+1,roi[2]:roi[3]+1]
+
+# LazyFrameArray of the colour frames of Bayer mosaic data, which are demosaiced with
+# bayer_args (see bayer_decode.fbayerDecode) a chunk at a time as they are indexed,
+# then cropped to bayer_crop. Only the mosaic is held in memory, a third of the size
+# of the colour frames, plus the chunks kept in lazy_array.chunk_cache.
+def __deferred_bayer__(ImageSequence,mosaic,bayer_args,bayer_crop=None):
+    from .bayer_decode import fbayerDecode
+    from .lazy_array import LazyFrameArray
+    ncpus, IO_backend = ImageSequence.IO_threads, ImageSequence.IO_backend
+
+    def read_frames(frames):
+        if isinstance(frames,tuple): block = mosaic[frames[0]:frames[1]]
+        else: block = mosaic[frames]
+        rgb = fbayerDecode(np.ascontiguousarray(block),ncpus=ncpus,IO_backend=IO_backend,\
+                           quiet=1,**bayer_args)
+        if bayer_crop is None: return rgb
+        return np.ascontiguousarray(__crop_roi__(rgb,bayer_crop))
+
+    if bayer_crop is None: height, width = mosaic.shape[1:]
+    else: height, width = bayer_crop[1]-bayer_crop[0]+1, bayer_crop[3]-bayer_crop[2]+1
+    print('\tBayer mosaic of size %s kept, frames are decoded when read' % str(mosaic.shape))
+    return LazyFrameArray(read_frames,mosaic.shape[0],(3,height,width),mosaic.dtype)
+
+# Extra pixels read around a region of interest of Bayer mosaic data, so that the
+# demosaicing filter sees the same neighbourhood as it would in the full frame.
+BAYER_ROI_MARGIN = 4
+
+def __bayer_roi__(roi,height,width):
+    """
+    Expand a region of interest of Bayer data to a window starting on an even
+    row and column (so the colour filter pattern is unchanged), plus a margin.
+    Returns (window to read, region of interest within that window).
+    """
+    y1, y2, x1, x2 = frame_select.check_roi(roi,height,width)
+    wy1 = max(y1-BAYER_ROI_MARGIN,0); wy1 -= wy1 % 2
+    wx1 = max(x1-BAYER_ROI_MARGIN,0); wx1 -= wx1 % 2
+    wy2 = min(y2+BAYER_ROI_MARGIN,height-1)
+    wx2 = min(x2+BAYER_ROI_MARGIN,width-1)
+    if (wy2-wy1) % 2 == 0 and wy2 < height-1: wy2 += 1
+    if (wx2-wx1) % 2 == 0 and wx2 < width-1: wx2 += 1
+    return (wy1,wy2,wx1,wx2), (y1-wy1,y2-wy1,x1-wx1,x2-wx1)
+
+def __read_photron_cih__(filename,rawtype=None,width=None,height=None):
+    """
+    Look for a Photron .cih/.cihx header next to an MRAW file, and use it to fill in
+    rawtype, width and height where these were not given.
+    Returns (rawtype, width, height, header dict or None).
+    """
+    if not filename.lower().endswith('.mraw'): return rawtype, width, height, None
+    if (rawtype is not None) and not ('photron_mraw' in rawtype.lower()):
+        return rawtype, width, height, None
+    from . import photron_cih
+    cih_file = photron_cih.find_cih(filename)
+    if cih_file is None: return rawtype, width, height, None
+    info = photron_cih.read_cih(cih_file)
+    if rawtype is None: rawtype = photron_cih.rawtype_from_cih(info)
+    if width is None: width = info['width']
+    if height is None: height = info['height']
+    return rawtype, width, height, info
+
+def raw_frame_count(all_images,rawtype=None,width=None,height=None,b16_doubleExposure=True,\
+                    start_offset=0):
+    """
+    Number of frames in a RAW file, worked out from its size without reading pixels.
+    For B16 files this reads only the header(s).
+    Args are as for load_raw.
+    """
+    rawtype, width, height, cih = __read_photron_cih__(all_images[0],rawtype,width,height)
+    if rawtype is None:
+        raise ValueError("Specify RAW format. Allowed choices:\n\trawtype = %s" % raw_types)
+    rawtype = rawtype.lower().strip()
+    if not rawtype in raw_types:
+        raise ValueError("Unknown RAW format `%s'. Allowed choices:\n\trawtype = %s" % (rawtype,raw_types))
+    if 'b16' in rawtype:
+        if len(all_images) > 1: return len(all_images)
+        from . import b16_raw
+        offsets, block_shape = b16_raw.b16_layout(all_images[0],b16_doubleExposure)
+        if rawtype == 'b16dat' and b16_doubleExposure: return len(offsets)
+        elif rawtype == 'b16dat': return len(offsets)*block_shape[0]
+        else: return block_shape[0]
+    if (width is None) or (height is None):
+        raise ValueError("Specify height and width") # no header data
+
+    if '8bit' in rawtype: bits_per_pixel = 8
+    elif '16bit' in rawtype: bits_per_pixel = 16
+    else: bits_per_pixel = 12
+
+    # Samples per scanline, and scanline padding (same as the readers)
+    values_per_row = width
+    scanline_pad = 0
+    if 'photron_mraw' in rawtype:
+        if 'color' in rawtype and not 'bayer' in rawtype: values_per_row *= 3
+        if bits_per_pixel == 12 and cih is None: scanline_pad = int((width*1.5)%16)
+    bytes_per_frame = ((values_per_row*bits_per_pixel)//8 + scanline_pad)*height
+
+    nframes = int((os.path.getsize(all_images[0])-start_offset)//bytes_per_frame)
+    if (cih is not None) and (cih['nframes'] is not None): nframes = min(nframes,cih['nframes'])
+    return nframes
+
+# Shape of the array that b16_raw.b16_reader returns for a whole file, from its header(s).
+def __b16_shape__(filename,doubleExposure=True):
+    from . import b16_raw
+    offsets, block_shape = b16_raw.b16_layout(filename,doubleExposure)
+    if os.path.splitext(filename)[1].lower() != '.b16dat': return tuple(block_shape)
+    elif doubleExposure: return (len(offsets),)+tuple(block_shape)
+    return (len(offsets)*block_shape[0],)+tuple(block_shape[1:])
+
+def raw_info(all_images,rawtype=None,width=None,height=None,b16_doubleExposure=True,\
+             start_offset=0,IO_threads=8,IO_backend='threads'):
+    """
+    Describe RAW file(s) from headers and file sizes only, without reading pixels.
+    Returns dict with keys
+        rawtype, nframes, frame_shape, dtype, src_bpp, fps
+    where frame_shape is the shape of each frame (or B16 block) in the array that
+    load_raw returns, ie. (3,height,width) for Bayer data after decoding.
+    For sequences of B16 files, the headers are read in parallel and must all
+    give the same image size.
+    Args are as for load_raw.
+    """
+    nframes = raw_frame_count(all_images,rawtype,width,height,b16_doubleExposure,start_offset)
+    rawtype, width, height, cih = __read_photron_cih__(all_images[0],rawtype,width,height)
+    rawtype = rawtype.lower().strip()
+    info = {'rawtype':rawtype, 'nframes':nframes, 'dtype':np.dtype(np.uint16), 'fps':None}
+    if cih is not None: info['fps'] = cih['fps']
+
+    if 'b16' in rawtype:
+        from .image_sequence_handler import __run_tasks__
+        info['src_bpp'] = 16
+        if len(all_images) > 1:
+            # Each file is one frame of the sequence
+            shapes = __run_tasks__(__b16_shape__,[(f,b16_doubleExposure) for f in all_images],\
+                                   IO_threads,IO_backend)
+            for f,shape in zip(all_images,shapes):
+                if shape != shapes[0]:
+                    raise ValueError("%s holds images of shape %s, but %s holds %s" \
+                                     % (f,str(shape),all_images[0],str(shapes[0])))
+            info['frame_shape'] = shapes[0]
+        else:
+            info['frame_shape'] = __b16_shape__(all_images[0],b16_doubleExposure)[1:]
+        return info
+
+    if '8bit' in rawtype: info['src_bpp'] = 8
+    elif '16bit' in rawtype: info['src_bpp'] = 16
+    else: info['src_bpp'] = 12
+    if ('chronos14_color' in rawtype) or ('photron_mraw_color' in rawtype):
+        info['frame_shape'] = (3,height,width) # Bayer decoded, or RGB
+    else:
+        info['frame_shape'] = (height,width)
+    return info
 
 def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
-             frames=None,dtype=None,b16_doubleExposure=True,start_offset=0):
+             frames=None,dtype=None,b16_doubleExposure=True,start_offset=0,nthreads=1,\
+             memmap=False,roi=None,out=None,defer_bayer=False):
     """
     Read RAW files.
     Args:
@@ -52,7 +287,8 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
         width,height: specification of dimensions for raw formats which do not indicate this
                  in their header. Ignored if image encodes this.
                  
-        frames: 2-tuple (start,end) to trim range of files/frames loaded
+        frames: 2-tuple (start,end) to trim range of files/frames loaded, or a slice
+                or list of frame numbers to load only those frames.
         
         dtype: Override data storage type (otherwise autodetected based on source)
         
@@ -62,13 +298,54 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
         start_offset: starting byte offset for RAW blobs (in case of unexpected header
                 data or write error.) Ignored for B16, which has a header length internal
                 variable.
+
+        nthreads: number of threads used to read and unpack Chronos and Photron RAW
+                data. Each thread reads its own block of frames from the file.
+
+        memmap: For formats listed in memmap_types, return a copy-on-write np.memmap of
+                the file instead of reading it into memory. Pixels are read on access
+                by the OS page cache. 8-bit data keeps its 8-bit dtype. Colour (Bayer)
+                data is still decoded into memory, unless defer_bayer is set.
+
+        roi: (y1,y2,x1,x2) region of interest, inclusive. Only these scanlines are read
+                from the file and only these columns are unpacked. Bayer data is read with
+                a small margin, which is cropped off after decoding.
+
+        out: preallocated array for the readers to write into. Mono formats are read straight
+                into it. Colour (Bayer) data is decoded first and then copied in by the caller.
+
+        defer_bayer: For colour (Bayer) formats, keep the mosaic as read and set ImageSequence.arr
+                to a LazyFrameArray which demosaics frames when they are indexed (see
+                __deferred_bayer__). out is not used.
+
+    For Photron MRAW files, a .cih or .cihx header file with the same name is used to
+    find rawtype, width, height, frame count and frame rate if present.
     """
+
+    # Photron header file
+    rawtype, width, height, cih = __read_photron_cih__(all_images[0],rawtype,width,height)
+    if cih is not None:
+        print('\tPhotron header: %s, %s x %s, %s frames at %s fps' % (rawtype,width,height,\
+                                                                   cih['nframes'],cih['fps']))
+        ImageSequence.fps = cih['fps']
     
     if rawtype is None:
         raise ValueError("Specify RAW format. Allowed choices:\n\trawtype = %s" % raw_types)
     
     else:
         rawtype = rawtype.lower().strip()
+
+    if memmap and not rawtype in memmap_types:
+        print("\tRAW type %s cannot be memory-mapped, reading into memory instead" % rawtype)
+        memmap = False
+
+    # Bayer data is read in a slightly larger window, and cropped after decoding.
+    # bayer_args are set to the demosaicing settings for colour formats.
+    bayer_crop = None
+    bayer_args = None
+    if (roi is not None) and (('chronos14_color' in rawtype) or ('bayer' in rawtype)) \
+       and (width is not None) and (height is not None):
+        roi, bayer_crop = __bayer_roi__(roi,height,width)
     
     # Chronos camera formats - firmware <= 0.3 12-bit packed
     if rawtype == 'chronos14_mono_old12bit' or rawtype == 'chronos14_color_old12bit':
@@ -78,12 +355,13 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
             raise ValueError("Specify height and width") # no header data
         ImageSequence.arr = ch.read_chronos_raw(all_images[0],width,height,\
                                        frames,bits_per_pixel=12,start_offset=start_offset,\
-                                                     old_packing_order=1)
+                                                     old_packing_order=1,nthreads=nthreads,roi=roi,\
+                                                     out=__mono_out__(rawtype,out))
         ImageSequence.src_bpp = 12
         ImageSequence.dtype = ImageSequence.arr.dtype
         if 'color' in rawtype.lower():
-            ImageSequence.bayerDecode(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
-                                      camera_filter='DC1394_COLOR_FILTER_GBRG')
+            bayer_args = dict(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
+                              camera_filter='DC1394_COLOR_FILTER_GBRG')
 
     # Chronos camera formats - firmware >= 0.3.1 12-bit packed
     elif rawtype == 'chronos14_mono_12bit' or rawtype == 'chronos14_color_12bit':
@@ -92,12 +370,13 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
         if (width is None) or (height is None):
             raise ValueError("Specify height and width") # no header data
         ImageSequence.arr = ch.read_chronos_raw(all_images[0],width,height,\
-                                                     frames,bits_per_pixel=12,start_offset=start_offset)
+                                                     frames,bits_per_pixel=12,start_offset=start_offset,\
+                                                     nthreads=nthreads,roi=roi,out=__mono_out__(rawtype,out))
         ImageSequence.src_bpp = 12
         ImageSequence.dtype = ImageSequence.arr.dtype
         if 'color' in rawtype.lower():
-            ImageSequence.bayerDecode(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
-                                      camera_filter='DC1394_COLOR_FILTER_GBRG')
+            bayer_args = dict(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
+                              camera_filter='DC1394_COLOR_FILTER_GBRG')
 
     # Chronos camera formats - 16-bit padded formats
     elif rawtype == 'chronos14_mono_16bit' or rawtype == 'chronos14_color_16bit':
@@ -105,13 +384,18 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
         from . import chronos14_raw as ch
         if (width is None) or (height is None):
             raise ValueError("Specify height and width") # no header data
-        ImageSequence.arr = ch.read_chronos_raw(all_images[0],width,height,
-                                       frames,bits_per_pixel=16,start_offset=start_offset)
+        if memmap:
+            ImageSequence.arr = __memmap_frames__(all_images[0],'<u2',(height,width),\
+                                                  frames,start_offset,roi)
+        else:
+            ImageSequence.arr = ch.read_chronos_raw(all_images[0],width,height,
+                                       frames,bits_per_pixel=16,start_offset=start_offset,\
+                                                     nthreads=nthreads,roi=roi,out=__mono_out__(rawtype,out))
         ImageSequence.src_bpp = 16
         ImageSequence.dtype = ImageSequence.arr.dtype
         if 'color' in rawtype.lower():
-            ImageSequence.bayerDecode(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
-                                      camera_filter='DC1394_COLOR_FILTER_GBRG')
+            bayer_args = dict(interpolation_method='DC1394_BAYER_METHOD_BILINEAR',\
+                              camera_filter='DC1394_COLOR_FILTER_GBRG')
 
     # Photron camera MRAW formats
     elif 'photron_mraw' in rawtype:
@@ -130,37 +414,72 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
         if 'color' in rawtype.lower() and not 'bayer' in rawtype.lower(): rgbmode=1
         else: rgbmode=0
 
-        ImageSequence.arr = photron_mraw.read_mraw(all_images[0],width,height,rgbmode,\
+        # Header gives exact frame count, and tells us scanlines are not padded.
+        scanline_pad = -1
+        if cih is not None:
+            scanline_pad = 0
+            if cih['nframes'] is not None:
+                frames = frame_select.compact(frame_select.frame_indices(frames,cih['nframes']))
+
+        if memmap:
+            if (width is None) or (height is None):
+                raise ValueError("Specify height and width") # no header data
+            if ImageSequence.src_bpp == 8: mm_dtype = np.uint8
+            else: mm_dtype = '<u2'
+            if rgbmode == 1:
+                ImageSequence.arr = np.moveaxis(__memmap_frames__(all_images[0],mm_dtype,\
+                                                (height,width,3),frames,start_offset,roi),3,1)
+            else:
+                ImageSequence.arr = __memmap_frames__(all_images[0],mm_dtype,(height,width),\
+                                                      frames,start_offset,roi)
+        else:
+            ImageSequence.arr = photron_mraw.read_mraw(all_images[0],width,height,rgbmode,\
                                        frames,bits_per_pixel=ImageSequence.src_bpp,\
-                                       start_offset=start_offset)
+                                       start_offset=start_offset,nthreads=nthreads,\
+                                       scanline_pad=scanline_pad,roi=roi,\
+                                       out=__mono_out__(rawtype,out))
 
         if 'bayer' in rawtype.lower():
-            ImageSequence.bayerDecode(interpolation_method='DC1394_BAYER_METHOD_SIMPLE',\
-                                      camera_filter='DC1394_COLOR_FILTER_GRBG')
+            bayer_args = dict(interpolation_method='DC1394_BAYER_METHOD_SIMPLE',\
+                              camera_filter='DC1394_COLOR_FILTER_GRBG')
 
     # PCO B16 formats
     elif rawtype == 'b16' or rawtype == 'b16dat':
         from . import b16_raw
         
-        if len(all_images) == 1:
+        if len(all_images) == 1 and memmap:
+            print('b16 / b16dat format (single file, memory-mapped)')
+            ImageSequence.arr = __memmap_b16__(all_images[0],b16_doubleExposure,frames,roi)
+            if ImageSequence.arr is None:
+                print('\tb16dat blocks cannot be mapped with a fixed stride, reading into memory instead')
+                memmap = False
+
+        if len(all_images) == 1 and not memmap:
             print('b16 / b16dat format (single file)')
-            ImageSequence.arr = b16_raw.b16_reader(all_images[0],b16_doubleExposure)
+            ImageSequence.arr = b16_raw.b16_reader(all_images[0],b16_doubleExposure,frames=frames,\
+                                                   roi=roi,out=out)
         
-        else:
+        elif len(all_images) > 1:
             print('b16 / b16dat format (multiple files)')
             if frames is None: image_subset=all_images
             else:
                 try:
-                    image_subset = all_images[frames[0]:frames[1]]
-                except IndexError:
+                    image_subset = [all_images[i] for i in \
+                                    frame_select.frame_indices(frames,len(all_images))]
+                except (IndexError,ValueError):
                     print("Error specifying frame range for b16 sequence.")
                     print("There are only %i frames available." % len(all_images))
                     print("Frames are numbered starting from zero regardless of filename!")
                     raise IndexError
         
-            from joblib import Parallel, delayed
-            list_of_images = Parallel(n_jobs=ImageSequence.IO_threads,verbose=ImageSequence.Joblib_Verbosity)(delayed(b16_raw.b16_reader)(filename,b16_doubleExposure,quiet=1) for filename in image_subset)
-            ImageSequence.arr = np.stack(list_of_images,axis=0)
+            from .image_sequence_handler import __run_tasks__
+            list_of_images = __run_tasks__(b16_raw.b16_reader,\
+                                [(filename,b16_doubleExposure,1,None,roi) for filename in image_subset],\
+                                ImageSequence.IO_threads,ImageSequence.IO_backend,\
+                                ImageSequence.Joblib_Verbosity)
+            if out is not None:
+                frame_select.check_out(out,(len(list_of_images),)+list_of_images[0].shape,np.uint16)
+            ImageSequence.arr = np.stack(list_of_images,axis=0,out=out)
             del list_of_images
         
         ImageSequence.src_bpp = 16
@@ -171,5 +490,16 @@ def load_raw(ImageSequence,all_images,rawtype=None,width=None,height=None,\
 
     else:
         raise ValueError("Unknown RAW format `%s'. Allowed choices:\n\trawtype = %s" % (rawtype,raw_types))
+
+    # Demosaic colour data now, or keep the mosaic and demosaic frames as they are read.
+    if (bayer_args is not None) and defer_bayer:
+        ImageSequence.arr = __deferred_bayer__(ImageSequence,ImageSequence.arr,bayer_args,bayer_crop)
+        bayer_crop = None
+    elif bayer_args is not None:
+        ImageSequence.bayerDecode(**bayer_args)
+
+    # Trim margin read around region of interest for Bayer decoding
+    if bayer_crop is not None:
+        ImageSequence.arr = np.ascontiguousarray(__crop_roi__(ImageSequence.arr,bayer_crop))
     
     return
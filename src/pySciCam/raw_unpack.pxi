@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+"""
+    Shared block reader and pixel unpacking kernels for the Cython RAW readers.
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    This file is textually included by chronos14_raw.pyx and photron_mraw.pyx,
+    after DTYPE_t has been defined. Frames are read in blocks of whole frames,
+    and only the frames (and scanlines) selected by the caller are read.
+    Each thread opens its own file handle and seeks to the byte range of the
+    block it is working on, so blocks are read and unpacked in parallel with
+    the GIL released.
+
+    Please see help(pySciCam) for more information.
+"""
+
+from cython.parallel cimport prange, parallel
+from libc.string cimport memcpy
+
+# Pixel packing modes understood by read_frame_blocks
+cdef enum:
+    UNPACK_12BIT = 0      # 12-bit, Chronos firmware >= 0.3.1 order (0x23, 0x1c, 0xab)
+    UNPACK_12BIT_MSB = 1  # 12-bit, MSB first (0xab, 0xc1, 0x23). Chronos <= 0.3.0, Photron
+    UNPACK_16BIT = 2      # 16-bit little-endian
+    UNPACK_8BIT = 3       # 8-bit
+
+# Approximate size of each bulk read from disk. Blocks always hold a whole
+# number of frames, so this is rounded down to a frame boundary (min. 1 frame).
+# When running multi-threaded, this budget is shared between the threads.
+READ_BLOCK_BYTES = 64*1024*1024
+MIN_BLOCK_BYTES = 4*1024*1024
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef long long unpack_bytes(const unsigned char * src, DTYPE_t * dst,\
+                            long long nbytes, int mode) noexcept nogil:
+    """ Unpack nbytes of packed pixels from src into dst. Returns number of pixels written. """
+    cdef long long j, n
+    cdef unsigned int b0, b1, b2
+    if mode == UNPACK_12BIT:
+        # Given a pair of two 12-bit pixels in hexidecmal as (0x123, 0xabc),
+        # v0.3.1 and later: (0x23, 0x1c, 0xab)
+        n = nbytes//3
+        for j in range(n):
+            b0 = src[3*j]; b1 = src[3*j+1]; b2 = src[3*j+2]
+            dst[2*j]   = <DTYPE_t>(b0 | ((b1 & 0xF0) << 4))
+            dst[2*j+1] = <DTYPE_t>((b2 << 4) | (b1 & 0x0F))
+        return 2*n
+    elif mode == UNPACK_12BIT_MSB:
+        # v0.3.0 and earlier, Photron: (0xab, 0xc1, 0x23)
+        n = nbytes//3
+        for j in range(n):
+            b0 = src[3*j]; b1 = src[3*j+1]; b2 = src[3*j+2]
+            dst[2*j]   = <DTYPE_t>((b0 << 4) | (b1 >> 4))
+            dst[2*j+1] = <DTYPE_t>(((b1 & 0x0F) << 8) | b2)
+        return 2*n
+    elif mode == UNPACK_16BIT:
+        # Already in output format on little-endian machines.
+        n = nbytes//2
+        memcpy(dst, src, 2*n)
+        return n
+    else:
+        n = nbytes
+        for j in range(n):
+            dst[j] = <DTYPE_t>src[j]
+        return n
+
+
+@cython.cdivision(True)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef long long read_frame_blocks(bytes filename, DTYPE_t * out, long long offset,\
+                                 runs, int nrows, long long row_bytes,\
+                                 long long row_pad, long long values_per_row,\
+                                 int mode, int nthreads, tuple window=None) except -1:
+    """
+    Read runs of consecutive frames from the file starting at byte offset into out.
+
+    runs is a list of [first_frame, position_in_output, count], as returned by
+    frame_select.frame_runs. Only the frames in the runs are read from disk.
+    Each frame consists of nrows scanlines of row_bytes packed pixel data
+    followed by row_pad bytes of padding. Each scanline unpacks to
+    values_per_row pixels in the output. Unpadded formats can pass nrows=1
+    and treat the whole frame as a single scanline.
+
+    window=(first_row, nrows_out, first_value, nvalues_out) limits the output to a
+    region of interest. Only those scanlines are read from disk, and only those
+    values of each scanline are unpacked. nrows must be the real number of
+    scanlines when a window is given.
+
+    Frames past the end of the file are left untouched.
+    Returns the number of bytes read from disk.
+    """
+    cdef long long row_stride = row_bytes + row_pad
+    cdef long long bytes_per_frame = row_stride * nrows
+    cdef long long nframes = sum([run[2] for run in runs])
+    if nthreads < 1: nthreads = 1
+
+    # Region of interest, in scanlines and values
+    cdef long long y0 = 0, ny = nrows, v0 = 0, nv = values_per_row
+    if window is not None:
+        y0, ny, v0, nv = window
+        if (y0 < 0) or (ny < 1) or (y0 + ny > nrows) or (v0 < 0) or (nv < 1) or\
+           (v0 + nv > values_per_row):
+            raise ValueError("Region of interest is outside the frame")
+    cdef bint full_frame = (ny == nrows) and (nv == values_per_row)
+    cdef long long values_per_frame = ny * nv
+
+    # Byte range of each scanline holding the values we want, and the
+    # offset of the first wanted value after unpacking that range.
+    cdef long long va = v0, vb = v0 + nv, byte_a, byte_b
+    if (mode == UNPACK_12BIT) or (mode == UNPACK_12BIT_MSB):
+        va -= va % 2; vb += vb % 2
+        byte_a = (va // 2) * 3; byte_b = (vb // 2) * 3
+    elif mode == UNPACK_16BIT:
+        byte_a = 2 * va; byte_b = 2 * vb
+    else:
+        byte_a = va; byte_b = vb
+    cdef long long skip = v0 - va
+    cdef bint direct = (skip == 0) and (vb - va == nv)
+    cdef long long roi_bytes = (ny - 1) * row_stride + row_bytes
+
+    # Split frames into blocks. Keep enough blocks for every thread to have work.
+    cdef long long block_budget = max(READ_BLOCK_BYTES // nthreads, MIN_BLOCK_BYTES)
+    cdef long long frames_per_block = max(1, block_budget // bytes_per_frame)
+    if nthreads > 1:
+        frames_per_block = max(1, min(frames_per_block, (nframes + nthreads - 1) // nthreads))
+    cdef long long block_bytes = frames_per_block * bytes_per_frame
+    if not full_frame: block_bytes = roi_bytes
+
+    # Each block is part of a run: (first frame in file, position in output, count)
+    blocks = []
+    for first, pos, count in runs:
+        for k in range(0, count, frames_per_block):
+            blocks.append((first + k, pos + k, min(frames_per_block, count - k)))
+    cdef long long[:, ::1] blk = np.array(blocks, dtype=np.int64).reshape((-1, 3))
+    cdef long long nblocks = blk.shape[0]
+
+    cdef char * fname = filename
+    cdef long long b, f, nwant, nread, r, nfull, rem, avail, n, total = 0
+    cdef long long failed = 0
+    cdef FILE * fh
+    cdef unsigned char * buf
+    cdef DTYPE_t * rowbuf
+    cdef DTYPE_t * dst
+
+    with nogil, parallel(num_threads=nthreads):
+        fh = fopen(fname, "rb")
+        buf = <unsigned char*>malloc(block_bytes)
+        rowbuf = <DTYPE_t*>malloc((vb - va + 2) * sizeof(DTYPE_t))
+        for b in prange(nblocks, schedule='dynamic'):
+            if (fh == NULL) or (buf == NULL) or (rowbuf == NULL):
+                failed += 1
+            elif full_frame:
+                nwant = blk[b, 2] * bytes_per_frame
+                dst = out + blk[b, 1] * values_per_frame
+
+                # Positioned read of this block on the thread's own handle
+                nread = 0
+                if fseek(fh, offset + blk[b, 0] * bytes_per_frame, SEEK_SET) == 0:
+                    nread = fread(buf, 1, nwant, fh)
+                total += nread
+
+                if row_pad == 0:
+                    # Contiguous scanlines - unpack whole block in one pass
+                    unpack_bytes(buf, dst, nread, mode)
+                else:
+                    # Skip padding at the end of every scanline
+                    nfull = nread // row_stride
+                    for r in range(nfull):
+                        unpack_bytes(buf + r*row_stride, dst + r*values_per_row,\
+                                     row_bytes, mode)
+                    rem = min(nread - nfull*row_stride, row_bytes)
+                    unpack_bytes(buf + nfull*row_stride, dst + nfull*values_per_row, rem, mode)
+            else:
+                # Region of interest: read just the wanted scanlines of each frame
+                for f in range(blk[b, 2]):
+                    dst = out + (blk[b, 1] + f) * values_per_frame
+                    nread = 0
+                    if fseek(fh, offset + (blk[b, 0] + f) * bytes_per_frame + y0 * row_stride,\
+                             SEEK_SET) == 0:
+                        nread = fread(buf, 1, roi_bytes, fh)
+                    total += nread
+                    for r in range(ny):
+                        avail = min(nread - r*row_stride - byte_a, byte_b - byte_a)
+                        if avail <= 0: break
+                        if direct:
+                            unpack_bytes(buf + r*row_stride + byte_a, dst + r*nv, avail, mode)
+                        else:
+                            n = unpack_bytes(buf + r*row_stride + byte_a, rowbuf, avail, mode)
+                            n = min(n - skip, nv)
+                            if n > 0: memcpy(dst + r*nv, rowbuf + skip, n * sizeof(DTYPE_t))
+        if fh != NULL: fclose(fh)
+        free(buf)
+        free(rowbuf)
+
+    if failed:
+        raise IOError("Could not open %s for reading" % filename.decode("UTF-8"))
+    return total
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Native TIFF page index and strip reader for pySciCam module
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Please see help(pySciCam) for more information.
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    A TIFF file is a chain of image file directories (IFDs), one per page, each
+    giving the size and pixel format of the page and the file offsets of the
+    strips holding its pixels. read_index walks this chain once, which gives the
+    exact number of pages in a multipage TIFF without decoding any of them.
+    Uncompressed pages, which is what most cameras write, can then be read straight
+    from their strips with read_page (8, 12, 16 and 32 bit mono or RGB, including
+    packed 12-bit). This is used for single-image TIFF files as well as multipage
+    ones. Other pages (compressed, tiled, etc) are left to ImageMagick or Pillow.
+
+    Pages of a multipage file are referred to as "filename[n]", as for ImageMagick.
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+import os, re, struct
+import numpy as np
+
+# IFD tags used here, and default values when they are missing from a page
+TAGS = {256:'width', 257:'height', 258:'bits', 259:'compression', 262:'photometric',\
+        266:'fill_order', 273:'strip_offsets', 277:'samples', 278:'rows_per_strip',\
+        279:'strip_byte_counts', 284:'planar', 317:'predictor', 322:'tile_width',\
+        338:'extra_samples', 339:'sample_format'}
+DEFAULTS = {'bits':1, 'compression':1, 'photometric':None, 'fill_order':1, 'samples':1,\
+            'planar':1, 'predictor':1, 'tile_width':None, 'extra_samples':None,\
+            'sample_format':1}
+
+# IFD field types: (struct format character, size in bytes)
+FIELD_TYPES = {1:('B',1), 2:('B',1), 3:('H',2), 4:('I',4), 6:('b',1), 7:('B',1),\
+               8:('h',2), 9:('i',4), 13:('I',4), 16:('Q',8), 17:('q',8), 18:('Q',8)}
+
+# Index of each file read so far, kept while the file's size and mtime are unchanged.
+__index_cache__ = {}
+
+####################################################################################
+# Split a page reference "filename[n]" into (filename, n). Plain files give (filename, None).
+def split_page(fn):
+    m = re.match(r'^(.*)\[(\d+)\]$',fn)
+    if (m is None) or os.path.exists(fn): return fn, None
+    return m.group(1), int(m.group(2))
+
+# Page references for the first npages pages of filename.
+def page_names(filename,npages):
+    return ["%s[%i]" % (filename,n) for n in range(npages)]
+
+####################################################################################
+# Values of one IFD entry. Values that don't fit in the entry are read from elsewhere in the file.
+def __entry_values__(f,entry,bo,bigtiff):
+    if bigtiff: tag, ftype, count = struct.unpack(bo+'HHQ',entry[:12]); inline=entry[12:20]
+    else: tag, ftype, count = struct.unpack(bo+'HHI',entry[:8]); inline=entry[8:12]
+    if not ftype in FIELD_TYPES: return tag, None # rationals, floats: not needed here
+    fmt, size = FIELD_TYPES[ftype]
+    if count*size <= len(inline):
+        data = inline[:count*size]
+    else:
+        f.seek(struct.unpack(bo+('Q' if bigtiff else 'I'),inline)[0])
+        data = f.read(count*size)
+        if len(data) < count*size: raise IOError("TIFF tag %i points past the end of file" % tag)
+    if count == 1: return tag, struct.unpack(bo+fmt,data)[0]
+    return tag, np.frombuffer(data,dtype=np.dtype(fmt).newbyteorder(bo)).astype(np.int64)
+
+####################################################################################
+def read_index(filename):
+    """
+    Walk the IFD chain of a TIFF (or BigTIFF) file. Returns a list with a dict for
+    each page, holding the tags in TAGS plus 'byteorder'. Raises IOError if the file
+    is not a TIFF. The result is cached until the file is modified.
+    """
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    if key in __index_cache__ and __index_cache__[key][0] == (st.st_size,st.st_mtime_ns):
+        return __index_cache__[key][1]
+
+    pages = []
+    with open(filename,'rb') as f:
+        header = f.read(16)
+        if header[:2] == b'II': bo = '<'
+        elif header[:2] == b'MM': bo = '>'
+        else: raise IOError("%s is not a TIFF file" % filename)
+        magic = struct.unpack(bo+'H',header[2:4])[0]
+        if magic == 42:
+            bigtiff = False
+            offset = struct.unpack(bo+'I',header[4:8])[0]
+            count_fmt, entry_size, next_fmt = 'H', 12, 'I'
+        elif magic == 43:
+            bigtiff = True
+            offset = struct.unpack(bo+'Q',header[8:16])[0]
+            count_fmt, entry_size, next_fmt = 'Q', 20, 'Q'
+        else:
+            raise IOError("%s is not a TIFF file" % filename)
+
+        seen = set()
+        while (offset != 0) and not (offset in seen):
+            seen.add(offset)
+            f.seek(offset)
+            n = f.read(struct.calcsize(count_fmt))
+            if len(n) < struct.calcsize(count_fmt): break # truncated file
+            n = struct.unpack(bo+count_fmt,n)[0]
+            block = f.read(n*entry_size + struct.calcsize(next_fmt))
+            if len(block) < n*entry_size + struct.calcsize(next_fmt): break
+
+            page = dict(DEFAULTS)
+            page['byteorder'] = bo
+            for j in range(n):
+                entry = block[j*entry_size:(j+1)*entry_size]
+                tag = struct.unpack(bo+'H',entry[:2])[0]
+                if tag in TAGS:
+                    tag, value = __entry_values__(f,entry,bo,bigtiff)
+                    page[TAGS[tag]] = value
+            if isinstance(page['bits'],np.ndarray): page['bits'] = int(page['bits'][0])
+            if not 'rows_per_strip' in page: page['rows_per_strip'] = page.get('height')
+            for k in ('strip_offsets','strip_byte_counts'):
+                if k in page: page[k] = np.atleast_1d(page[k]).astype(np.int64)
+            pages.append(page)
+            offset = struct.unpack(bo+next_fmt,block[n*entry_size:])[0]
+
+    # Single images are quick to index again, so only multipage files are kept.
+    if len(pages) > 1: __index_cache__[key] = ((st.st_size,st.st_mtime_ns),pages)
+    return pages
+
+# Exact number of pages in a TIFF file.
+def page_count(filename):
+    return len(read_index(filename))
+
+####################################################################################
+# Page dict for a file name or page reference "filename[n]".
+def get_page(fn):
+    filename, n = split_page(fn)
+    pages = read_index(filename)
+    if n is None: n = 0
+    if n >= len(pages): raise IndexError("%s has only %i pages" % (filename,len(pages)))
+    return pages[n]
+
+# True if read_page can decode this page: uncompressed, stripped, unsigned
+# integer mono or RGB pixels with no extra channels.
+def native_readable(page):
+    if (page.get('width') is None) or (page.get('height') is None): return False
+    if not 'strip_offsets' in page or not 'strip_byte_counts' in page: return False
+    if page['samples'] == 1: colour = page['photometric'] in (None,1)
+    elif page['samples'] == 3: colour = (page['photometric'] == 2) and (page['planar'] == 1)
+    else: colour = False
+    return colour and (page['compression'] == 1) and (page['tile_width'] is None)\
+           and (page['extra_samples'] is None) and (page['fill_order'] == 1)\
+           and (page['sample_format'] == 1) and (page['bits'] in (8,12,16,32))\
+           and (len(page['strip_offsets']) == len(page['strip_byte_counts']))
+
+# NumPy dtype that read_page returns for this page.
+def page_dtype(page):
+    if page['bits'] == 8: return np.dtype(np.uint8)
+    elif page['bits'] in (12,16): return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+####################################################################################
+# Unpack rows of 12-bit pixels, MSB first, to uint16. Each row starts on a byte boundary.
+def __unpack_12bit__(buf,nvalues):
+    nrows = buf.shape[0]
+    ntriples = (nvalues+1)//2
+    if buf.shape[1] < 3*ntriples: # odd number of values: pad the final half-triple
+        buf = np.concatenate((buf,np.zeros((nrows,3*ntriples-buf.shape[1]),dtype=np.uint8)),axis=1)
+    b = buf[:,:3*ntriples].reshape(nrows,ntriples,3).astype(np.uint16)
+    values = np.empty((nrows,ntriples,2),dtype=np.uint16)
+    values[...,0] = (b[...,0] << 4) | (b[...,1] >> 4)
+    values[...,1] = ((b[...,1] & 0x0F) << 8) | b[...,2]
+    return values.reshape(nrows,2*ntriples)[:,:nvalues]
+
+####################################################################################
+def read_page(f,page,roi=None,out=None):
+    """
+    Read an uncompressed page (see native_readable) from open file f, straight from
+    its strips. Only the scanlines inside roi=(y1,y2,x1,x2), inclusive, are read.
+    Returns (height,width) array for mono pages, or (height,width,3) for RGB.
+    If out is given, the page is written into it and out is returned. 8 and 16 bit
+    pages are then read from disk directly into out, if it has the page's dtype.
+    """
+    width, height, samples, bits = page['width'], page['height'], page['samples'], page['bits']
+    if roi is None: roi = (0,height-1,0,width-1)
+    y1, y2, x1, x2 = roi
+    nrows = y2-y1+1
+    row_bytes = (width*samples*bits+7)//8
+    rows_per_strip = min(int(page['rows_per_strip']),height)
+
+    # Read the wanted scanlines of each strip into one buffer, which can be out itself
+    # when the stored pixels are already in the layout of out. Pixels stored in the
+    # other byte order are then swapped in place.
+    dt = page_dtype(page).newbyteorder(page['byteorder'])
+    direct = (out is not None) and (bits in (8,16)) and (samples == 1) and (x1 == 0) and\
+             (x2 == width-1) and (out.dtype in (dt,page_dtype(page))) and out.flags.c_contiguous
+    if direct: buf = out.reshape(-1).view(np.uint8).reshape(nrows,row_bytes)
+    else: buf = np.zeros((nrows,row_bytes),dtype=np.uint8)
+    flat = buf.reshape(-1)
+    offsets, counts = page['strip_offsets'], page['strip_byte_counts']
+    for s in range(y1//rows_per_strip, y2//rows_per_strip+1):
+        if s >= len(offsets): break
+        a = max(y1,s*rows_per_strip)
+        b = min(y2+1,(s+1)*rows_per_strip)
+        start = (a-s*rows_per_strip)*row_bytes
+        nbytes = min((b-a)*row_bytes, int(counts[s])-start)
+        if nbytes <= 0: continue
+        f.seek(int(offsets[s])+start)
+        f.readinto(memoryview(flat)[(a-y1)*row_bytes:(a-y1)*row_bytes+nbytes])
+    if direct:
+        if out.dtype != dt: out.byteswap(inplace=True)
+        return out
+
+    # Convert to pixel values
+    nvalues = width*samples
+    if bits == 8: frame = buf[:,:nvalues]
+    elif bits == 12: frame = __unpack_12bit__(buf,nvalues)
+    else:
+        frame = buf.view(dt)[:,:nvalues]
+        if not dt.isnative: frame = frame.astype(dt.newbyteorder('='))
+
+    if samples > 1: frame = frame.reshape(nrows,width,samples)
+    frame = frame[:,x1:x2+1,...]
+    if out is None: return frame
+    out[...] = frame
+    return out
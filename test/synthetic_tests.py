@@ -0,0 +1,792 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+"""
+    Tests for pySciCam - synthetic data
+
+    Write small camera files with known pixel values into a temporary directory,
+    read them back with pySciCam and compare against NumPy.
+    Unlike run_tests.py, no sample data or plotting is needed.
+
+    @author Daniel Duke <daniel.duke@monash.edu>
+    @copyright (c) 2018-2024 LTRAC
+    @license GPL-3.0+
+    @version 0.5.1
+    @date 31/08/2024
+
+    Department of Mechanical & Aerospace Engineering
+    Monash University, Australia
+
+    Code in this directory is subject to the GPL-3.0+ license, please see ../LICENSE
+
+"""
+
+__author__="Daniel Duke <daniel.duke@monash.edu>"
+__version__="0.5.1"
+__license__="GPL-3.0+"
+__copyright__="Copyright (c) 2018-2024 D.Duke"
+
+
+import pySciCam
+from pySciCam.pySciCam import ImageSequence, probe
+from pySciCam import frame_select, tiff_reader, file_index, frame_cache
+from pySciCam.lazy_array import ChunkCache, LazyFrameArray
+import numpy as np
+import os, sys, struct, tempfile, shutil, time, traceback
+
+rng = np.random.default_rng(2024)
+
+##########################################################################################
+# Writers for synthetic test files
+
+# Pack 12-bit values in pairs. Chronos >= 0.3.1: (0x123,0xabc) -> (0x23,0x1c,0xab)
+# Chronos <= 0.3.0 and Photron, MSB first: (0x123,0xabc) -> (0x12,0x3a,0xbc)
+def pack12(values,msb_first=False):
+    v = np.asarray(values,dtype=np.uint16).reshape(-1,2)
+    b = np.empty((v.shape[0],3),dtype=np.uint8)
+    if msb_first:
+        b[:,0] = v[:,0] >> 4
+        b[:,1] = ((v[:,0] & 0x0F) << 4) | (v[:,1] >> 8)
+        b[:,2] = v[:,1] & 0xFF
+    else:
+        b[:,0] = v[:,0] & 0xFF
+        b[:,1] = ((v[:,0] >> 4) & 0xF0) | (v[:,1] & 0x0F)
+        b[:,2] = v[:,1] >> 4
+    return b.tobytes()
+
+# PCO B16 file holding one image, or B16dat holding several, each after its own header
+def write_b16(filename,images,header_bytes=1024):
+    with open(filename,'wb') as f:
+        for im in images:
+            h, w = im.shape
+            header = b'PCO-'+struct.pack('<IIIII',header_bytes+2*im.size,header_bytes,w,h,0xFFFFFFFF)
+            f.write(header.ljust(header_bytes,b'\0'))
+            f.write(im.astype('<u2').tobytes())
+    return
+
+# Text Photron .cih header
+def write_cih(filename,width,height,nframes,bits=12,color='Mono'):
+    with open(filename,'w') as f:
+        f.write("#Camera Information Header\nRecord Rate(fps) : 1000\nTotal Frame : %i\n" % nframes)
+        f.write("Image Width : %i\nImage Height : %i\nColor Type : %s\n" % (width,height,color))
+        f.write("Color Bit : %i\nFile Format : MRaw\n" % bits)
+    return
+
+# Uncompressed, single-strip TIFF with one page per array in pages.
+# Arrays are (H,W) mono or (H,W,3) RGB. bits=12 writes packed 12-bit scanlines.
+def write_tiff(filename,pages,byteorder='<',bits=None):
+    bo = byteorder
+    f = bytearray(b'II' if bo == '<' else b'MM')
+    f += struct.pack(bo+'HI',42,0)
+    next_ifd = 4
+    for arr in pages:
+        arr = np.asarray(arr)
+        h, w = arr.shape[:2]
+        spp = 1 if arr.ndim == 2 else arr.shape[2]
+        b = bits or 8*arr.dtype.itemsize
+        if b == 12:
+            data = b''.join([pack12(np.append(row,[0]*(row.size%2)),True)[:(row.size*12+7)//8]\
+                             for row in arr.reshape(h,-1)])
+        else:
+            data = arr.astype(arr.dtype.newbyteorder(bo)).tobytes()
+        f += b'\0'*(len(f)%2)
+        data_offset = len(f)
+        f += data + b'\0'*(len(data)%2)
+        bits_value = b
+        if spp == 3:
+            bits_value = len(f)
+            f += struct.pack(bo+'HHH',b,b,b)
+        struct.pack_into(bo+'I',f,next_ifd,len(f))
+        entries = [(256,4,1,w),(257,4,1,h),(258,3,spp,bits_value),(259,3,1,1),\
+                   (262,3,1,1 if spp == 1 else 2),(273,4,1,data_offset),(277,3,1,spp),\
+                   (278,4,1,h),(279,4,1,len(data))]
+        f += struct.pack(bo+'H',len(entries))
+        for tag, ftype, count, value in entries:
+            if (ftype == 3) and (count == 1): f += struct.pack(bo+'HHIHH',tag,ftype,count,value,0)
+            else: f += struct.pack(bo+'HHII',tag,ftype,count,value)
+        next_ifd = len(f)
+        f += struct.pack(bo+'I',0)
+    with open(filename,'wb') as fh: fh.write(bytes(f))
+    return
+
+# Colour movie with frame i filled with level 40*i. Returns None if it cannot be written.
+def write_movie(filename,nframes,height,width):
+    try:
+        import imageio
+        writer = imageio.get_writer(filename,fps=10,macro_block_size=1)
+    except (ImportError,ValueError,RuntimeError) as e:
+        print("Skipping movie tests: %s" % e)
+        return None
+    for i in range(nframes): writer.append_data(np.full((height,width,3),i*40,np.uint8))
+    writer.close()
+    return filename
+
+def random_frames(shape,maxval):
+    return rng.integers(0,maxval+1,shape).astype(np.uint16 if maxval > 255 else np.uint8)
+
+def equal(a,b):
+    return (np.shape(a) == np.shape(b)) and np.array_equal(np.asarray(a),np.asarray(b))
+
+##########################################################################################
+# Chronos test files holding frames ref, by rawtype
+def write_chronos(tmp,ref):
+    files = {'chronos14_mono_12bit':pack12(ref.ravel()),\
+             'chronos14_mono_old12bit':pack12(ref.ravel(),msb_first=True),\
+             'chronos14_mono_16bit':ref.astype('<u2').tobytes()}
+    for rawtype in files:
+        fn = os.path.join(tmp,rawtype+'.raw')
+        with open(fn,'wb') as f: f.write(files[rawtype])
+        files[rawtype] = fn
+    return files
+
+def chronos_unpack_tests(tmp):
+    """ Chronos 12-bit (both packing orders) and 16-bit RAW, whole files """
+    N, H, W = 7, 6, 10
+    ref = random_frames((N,H,W),4095)
+    for rawtype, fn in write_chronos(tmp,ref).items():
+        seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H)
+        assert (seq.dtype == np.uint16) and equal(seq.arr,ref), rawtype
+
+##########################################################################################
+def threaded_unpack_tests(tmp):
+    """ RAW readers unpack the same frames on any number of threads """
+    N, H, W = 9, 6, 32
+    ref = random_frames((N,H,W),4095)
+    files = write_chronos(tmp,ref)
+    # Photron MRAW without a header. 32 pixel 12-bit scanlines need no padding.
+    files['photron_mraw_mono_12bit'] = os.path.join(tmp,'mono12.mraw')
+    with open(files['photron_mraw_mono_12bit'],'wb') as f: f.write(pack12(ref.ravel(),msb_first=True))
+    files['photron_mraw_mono_16bit'] = os.path.join(tmp,'mono16.mraw')
+    with open(files['photron_mraw_mono_16bit'],'wb') as f: f.write(ref.astype('<u2').tobytes())
+    for rawtype, fn in files.items():
+        for nthreads in (1,3,16):
+            seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H,nthreads=nthreads)
+            assert equal(seq.arr,ref), (rawtype,nthreads)
+
+##########################################################################################
+def memmap_tests(tmp):
+    """ Memory-mapped 8 and 16-bit RAW and MRAW files """
+    N, H, W = 6, 4, 5
+    ref16 = random_frames((N,H,W),65535)
+    ref8 = random_frames((N,H,W),255)
+    for rawtype, ref in (('chronos14_mono_16bit',ref16),('photron_mraw_mono_16bit',ref16),\
+                         ('photron_mraw_mono_8bit',ref8)):
+        fn = os.path.join(tmp,rawtype+'.raw')
+        with open(fn,'wb') as f: f.write(ref.astype(ref.dtype.newbyteorder('<')).tobytes())
+        seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H,memmap=True)
+        assert isinstance(seq.arr,np.memmap) and equal(seq.arr,ref), rawtype
+    # Interleaved RGB is mapped as (N,3,H,W)
+    ref = random_frames((N,H,W,3),255)
+    fn = os.path.join(tmp,'rgb.mraw')
+    with open(fn,'wb') as f: f.write(ref.tobytes())
+    seq = ImageSequence(fn,rawtype='photron_mraw_color_8bit',width=W,height=H,memmap=True)
+    assert isinstance(seq.arr,np.memmap) and equal(seq.arr,np.moveaxis(ref,3,1))
+
+##########################################################################################
+def lazy_tests(tmp):
+    """ LazyFrameArray and lazy ImageSequence against arrays in memory """
+    ref = random_frames((40,3,4),65535)
+    def read_frames(frames):
+        if isinstance(frames,tuple): frames = list(range(*frames))
+        assert list(frames) == sorted(frames)
+        return ref[frames].copy()
+    arr = LazyFrameArray(read_frames,*ref.shape[:1],ref.shape[1:],ref.dtype)
+    assert (arr.shape == ref.shape) and (len(arr) == 40) and (arr.ndim == 3)
+    for key in (5,-1,slice(3,30,4),[9,2,2,39],(Ellipsis,1),(7,Ellipsis,slice(1,3)),np.arange(40) % 7 == 0):
+        assert equal(arr[key],ref[key]), key
+    assert equal(np.asarray(arr),ref)
+    assert equal(arr.astype(np.float64)[2:4],ref[2:4].astype(np.float64))
+    masked = ref.copy()
+    masked[...,1:2,0:3] = 9
+    assert equal(arr.fill((Ellipsis,slice(1,2),slice(0,3)),9)[:],masked)
+    assert equal(arr[:],ref) # fill doesn't change the frames read
+
+    # Lazy ImageSequence reads the same frames as an eager one
+    N, H, W = 9, 4, 6
+    ref = random_frames((N,H,W),65535)
+    fn = os.path.join(tmp,'lazy.raw')
+    with open(fn,'wb') as f: f.write(ref.astype('<u2').tobytes())
+    kw = dict(rawtype='chronos14_mono_16bit',width=W,height=H)
+    seq = ImageSequence(fn,lazy=True,frames=slice(0,None,2),**kw)
+    assert isinstance(seq.arr,LazyFrameArray) and equal(seq.arr[1:3],ref[2:6:2])
+    seq.mask_box(1,2,0,1,fillValue=0)
+    masked = ref[::2].copy()
+    masked[:,1:3,0:2] = 0
+    assert equal(seq.arr[:],masked)
+    eager = ImageSequence(fn,frames=slice(0,None,2),**kw)
+    eager.mask_box(1,2,0,1,fillValue=0)
+    assert equal(eager.arr,masked)
+    seq.crop(0,2,1,4)
+    assert (seq.width, seq.height) == (4,3) and equal(seq.arr,masked[:,0:3,1:5])
+
+##########################################################################################
+def iter_chunks_tests(tmp):
+    """ Chunks of any frame selection, from lazy and eager sequences """
+    N, H, W = 9, 4, 6
+    ref = random_frames((N,H,W),65535)
+    fn = os.path.join(tmp,'chunks.raw')
+    with open(fn,'wb') as f: f.write(ref.astype('<u2').tobytes())
+    for lazy in (False,True):
+        seq = ImageSequence(fn,rawtype='chronos14_mono_16bit',width=W,height=H,lazy=lazy)
+        for frames in (None,(1,4),slice(0,None,2),[3,0,8]):
+            idx = frame_select.frame_indices(frames,N)
+            chunks = list(seq.iter_chunks(2,frames))
+            assert [c[0] for c in chunks] == idx[::2], (lazy,frames)
+            assert max([len(c[1]) for c in chunks]) <= 2
+            assert equal(np.concatenate([c[1] for c in chunks]),ref[idx]), (lazy,frames)
+
+##########################################################################################
+def b16_tests(tmp):
+    """ PCO B16 and B16dat, single and double exposed, read and memory-mapped """
+    N, H, W = 5, 8, 6
+    ref = random_frames((N,H,W),65535)
+    fn = os.path.join(tmp,'single.b16')
+    write_b16(fn,ref[:1])
+    assert equal(ImageSequence(fn).arr,ref[0].reshape(2,H//2,W))
+    assert equal(ImageSequence(fn,b16_doubleExposure=False).arr,ref[:1])
+    fn = os.path.join(tmp,'blocks.b16dat')
+    write_b16(fn,ref)
+    for memmap in (False,True):
+        seq = ImageSequence(fn,memmap=memmap)
+        assert equal(seq.arr,ref.reshape(N,2,H//2,W)), memmap
+        assert isinstance(seq.arr,np.memmap) == memmap
+        assert equal(ImageSequence(fn,memmap=memmap,b16_doubleExposure=False).arr,ref), memmap
+
+##########################################################################################
+def photron_cih_tests(tmp):
+    """ Photron MRAW described by a .cih header: size, depth, frame count and rate """
+    N, H, W = 5, 4, 8
+    ref = random_frames((N,H,W),4095)
+    fn = os.path.join(tmp,'mono12.mraw')
+    with open(fn,'wb') as f: f.write(pack12(ref.ravel(),msb_first=True))
+    write_cih(os.path.join(tmp,'mono12.cih'),W,H,N)
+    seq = ImageSequence(fn)
+    assert equal(seq.arr,ref) and (seq.fps == 1000)
+    # Frames past the count in the header are not read
+    write_cih(os.path.join(tmp,'mono12.cih'),W,H,3)
+    assert equal(ImageSequence(fn).arr,ref[:3])
+    # RGB colour depth is given per pixel
+    ref = random_frames((N,H,W,3),255)
+    fn = os.path.join(tmp,'rgb8.mraw')
+    with open(fn,'wb') as f: f.write(ref.tobytes())
+    write_cih(os.path.join(tmp,'rgb8.cih'),W,H,N,24,'Color')
+    assert equal(ImageSequence(fn).arr,np.moveaxis(ref,3,1))
+
+##########################################################################################
+def frame_select_tests(tmp):
+    """ Frame selections and runs """
+    fi = frame_select.frame_indices
+    assert fi(None,4) == [0,1,2,3]
+    assert fi((1,3),10) == [1,2]
+    assert fi((8,20),10,quiet=1) == [8,9]
+    assert fi(slice(0,None,3),10) == [0,3,6,9]
+    assert fi([5,-1,0],10) == [5,9,0]
+    assert fi(np.arange(10) % 4 == 0,10) == [0,4,8]
+    for bad, err in (((10,12),ValueError),([10],IndexError),([0.5],TypeError),(slice(5,2),ValueError)):
+        try: fi(bad,10)
+        except err: pass
+        else: raise AssertionError("frames=%s should raise %s" % (bad,err.__name__))
+    assert frame_select.frame_runs([3,4,5,9,10,2]) == [[3,0,3],[9,3,2],[2,5,1]]
+    assert frame_select.compact([4,5,6]) == (4,7)
+    assert frame_select.compact([4,6]) == [4,6]
+    assert frame_select.as_slice([2,5,8]) == slice(2,9,3)
+    assert frame_select.as_slice([2,5,9]) is None
+    assert frame_select.as_slice([5,2]) is None
+
+def frame_pushdown_tests(tmp):
+    """ Readers return just the frames selected, in the order given """
+    N, H, W = 7, 6, 10
+    ref = random_frames((N,H,W),4095)
+    selections = ((2,5),slice(1,None,2),[6,0,3],[4,4])
+    for rawtype, fn in write_chronos(tmp,ref).items():
+        for frames in selections:
+            idx = frame_select.frame_indices(frames,N)
+            seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H,frames=frames,nthreads=2)
+            assert equal(seq.arr,ref[idx]), (rawtype,frames)
+            if '16bit' in rawtype:
+                seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H,frames=frames,memmap=True)
+                assert equal(seq.arr,ref[idx]), (rawtype,frames)
+
+    # B16dat blocks, read and memory-mapped, including descending and unordered lists
+    fn = os.path.join(tmp,'blocks.b16dat')
+    write_b16(fn,ref)
+    for frames in selections+([4,0],[3,1,2]):
+        idx = frame_select.frame_indices(frames,N)
+        for memmap in (False,True):
+            seq = ImageSequence(fn,frames=frames,memmap=memmap)
+            assert equal(seq.arr,ref.reshape(N,2,H//2,W)[idx]), (frames,memmap)
+            seq = ImageSequence(fn,frames=frames,memmap=memmap,b16_doubleExposure=False)
+            assert equal(seq.arr,ref[idx]), (frames,memmap)
+    # Evenly spaced blocks stay mapped
+    assert isinstance(ImageSequence(fn,frames=slice(1,None,2),memmap=True).arr,np.memmap)
+
+##########################################################################################
+def roi_tests(tmp):
+    """ Readers return just the region of interest """
+    assert frame_select.check_roi((1,2,3,4),5,5) == (1,2,3,4)
+    for roi in ((0,5,0,1),(2,1,0,1),(0,1,0,5),(0,1,2)):
+        try: frame_select.check_roi(roi,5,5)
+        except ValueError: pass
+        else: raise AssertionError("roi %s should be rejected" % str(roi))
+
+    N, H, W = 7, 6, 10
+    ref = random_frames((N,H,W),4095)
+    rois = ((1,4,2,7),(0,5,3,3),(2,2,0,9))
+    for rawtype, fn in write_chronos(tmp,ref).items():
+        for roi in rois:
+            seq = ImageSequence(fn,rawtype=rawtype,width=W,height=H,roi=roi,frames=(1,6),nthreads=2)
+            assert equal(seq.arr,ref[1:6,roi[0]:roi[1]+1,roi[2]:roi[3]+1]), (rawtype,roi)
+            assert (seq.width, seq.height) == (roi[3]-roi[2]+1,roi[1]-roi[0]+1)
+    fn = os.path.join(tmp,'blocks.b16dat')
+    write_b16(fn,ref)
+    for roi in rois:
+        for memmap in (False,True):
+            seq = ImageSequence(fn,roi=roi,memmap=memmap,b16_doubleExposure=False)
+            assert equal(seq.arr,ref[:,roi[0]:roi[1]+1,roi[2]:roi[3]+1]), (roi,memmap)
+    fn = os.path.join(tmp,'mono12.mraw')
+    with open(fn,'wb') as f: f.write(pack12(ref.ravel(),msb_first=True))
+    write_cih(os.path.join(tmp,'mono12.cih'),W,H,N)
+    assert equal(ImageSequence(fn,roi=(1,3,2,5)).arr,ref[:,1:4,2:6])
+
+    # Odd width: every other 12-bit scanline starts half way through a byte
+    N, H, W = 3, 6, 9
+    ref = random_frames((N,H,W),4095)
+    fn = os.path.join(tmp,'odd_width.raw')
+    with open(fn,'wb') as f: f.write(pack12(ref.ravel()))
+    for roi in ((1,4,2,6),(0,5,0,8),(3,3,1,1),(2,5,3,8)):
+        seq = ImageSequence(fn,rawtype='chronos14_mono_12bit',width=W,height=H,roi=roi,nthreads=2)
+        assert equal(seq.arr,ref[:,roi[0]:roi[1]+1,roi[2]:roi[3]+1]), roi
+
+##########################################################################################
+def out_tests(tmp):
+    """ Readers fill caller-supplied arrays, including np.memmap on disk """
+    out = np.zeros((2,3),np.uint32)
+    assert frame_select.check_out(out,(2,3),np.uint16) is out
+    try: frame_select.check_out(np.zeros((2,3),np.uint8),(2,3),np.uint16)
+    except ValueError: pass
+    else: raise AssertionError("uint8 out should not accept uint16 data")
+
+    N, H, W = 7, 6, 10
+    ref = random_frames((N,H,W),4095)
+    files = write_chronos(tmp,ref)
+    files['b16dat'] = os.path.join(tmp,'blocks.b16dat')
+    write_b16(files['b16dat'],ref)
+    for rawtype, fn in files.items():
+        kw = dict(rawtype=rawtype,width=W,height=H)
+        if rawtype == 'b16dat': kw = dict(b16_doubleExposure=False)
+        for dtype in (np.uint16,np.uint32):
+            out = np.full((N,H,W),7,dtype)
+            assert ImageSequence(fn,out=out,**kw).arr is out
+            assert equal(out,ref), (rawtype,dtype)
+        out = np.memmap(os.path.join(tmp,'out.dat'),dtype=np.uint16,mode='w+',shape=(3,2,4))
+        assert ImageSequence(fn,out=out,frames=[5,1,2],roi=(2,3,4,7),**kw).arr is out
+        out.flush()
+        assert equal(np.fromfile(os.path.join(tmp,'out.dat'),np.uint16).reshape(3,2,4),\
+                     ref[[5,1,2],2:4,4:8]), rawtype
+        del out
+
+##########################################################################################
+# Directory of single-page TIFF files, one per frame
+def write_tiff_sequence(d,ref,byteorder='<',bits=None):
+    os.mkdir(d)
+    for i in range(len(ref)): write_tiff(os.path.join(d,'frame_%i.tif' % (i+1)),[ref[i]],byteorder,bits)
+    return d
+
+def tiff_sequence_tests(tmp):
+    """ TIFF sequences read in parallel into one stack """
+    N, H, W = 12, 5, 6
+    for maxval in (255,65535):
+        ref = random_frames((N,H,W),maxval)
+        d = write_tiff_sequence(os.path.join(tmp,'seq%i' % maxval),ref)
+        for threads in (1,4):
+            kw = dict(use_magick=False,IO_threads=threads,dtype=np.uint16)
+            seq = ImageSequence(d,**kw)
+            assert (seq.dtype == np.uint16) and equal(seq.arr,ref), (maxval,threads)
+            assert equal(ImageSequence(d,frames=[9,2,3],roi=(1,3,2,4),**kw).arr,\
+                         ref[[9,2,3],1:4,2:5]), (maxval,threads)
+            out = np.full((N,H,W),7,np.uint32)
+            assert ImageSequence(d,out=out,**kw).arr is out
+            assert equal(out,ref), (maxval,threads)
+
+##########################################################################################
+def io_backend_tests(tmp):
+    """ Every I/O backend loads the same TIFF sequence """
+    ref = random_frames((6,5,4),65535)
+    d = write_tiff_sequence(os.path.join(tmp,'seq'),ref)
+    for backend in ('serial','threads','processes'):
+        seq = ImageSequence(d,use_magick=False,IO_threads=2,IO_backend=backend)
+        assert equal(seq.arr,ref), backend
+    try: ImageSequence(d,IO_backend='fibres')
+    except ValueError: pass
+    else: raise AssertionError("unknown IO_backend should be rejected")
+
+##########################################################################################
+def multipage_tiff_tests(tmp):
+    """ Pages of a multipage TIFF, indexed without decoding """
+    N, H, W = 9, 5, 6
+    ref = random_frames((N,H,W),65535)
+    fn = os.path.join(tmp,'multipage.tif')
+    write_tiff(fn,list(ref))
+    assert tiff_reader.page_count(fn) == N
+    for threads in (1,3):
+        kw = dict(use_magick=False,IO_threads=threads,dtype=np.uint16)
+        assert equal(ImageSequence(fn,**kw).arr,ref), threads
+        assert equal(ImageSequence(fn,frames=(1,3),**kw).arr,ref[1:3]), threads
+        assert equal(ImageSequence(fn,frames=[8,0,4],**kw).arr,ref[[8,0,4]]), threads
+
+##########################################################################################
+def tiff_strip_tests(tmp):
+    """ Direct strip reader: bit depths, byte orders, RGB and file handles """
+    N, H, W = 4, 5, 6
+    cases = [('8bit',random_frames((N,H,W),255),'<',None),\
+             ('16bit_be',random_frames((N,H,W),65535),'>',None),\
+             ('12bit',random_frames((N,H,W),4095),'<',12),\
+             ('12bit_odd',random_frames((N,H,W-1),4095),'>',12)]
+    for name, ref, bo, bits in cases:
+        d = write_tiff_sequence(os.path.join(tmp,name),ref,bo,bits)
+        for backend in ('serial','threads'):
+            kw = dict(use_magick=False,IO_threads=2,IO_backend=backend,dtype=np.uint16)
+            seq = ImageSequence(d,**kw)
+            assert (seq.dtype == np.uint16) and seq.arr.dtype.isnative, name
+            assert equal(seq.arr,ref), (name,backend)
+            assert equal(ImageSequence(d,roi=(1,3,2,4),frames=[3,1],**kw).arr,\
+                         ref[[3,1],1:4,2:5]), name
+        # Native byte order when the dtype is not given
+        seq = ImageSequence(d,use_magick=False)
+        assert seq.arr.dtype.isnative and np.dtype(seq.dtype).isnative and equal(seq.arr,ref), name
+
+    # RGB, summed to mono or kept as colour
+    ref = random_frames((N,H,W,3),255)
+    d = write_tiff_sequence(os.path.join(tmp,'rgb'),ref)
+    seq = ImageSequence(d,use_magick=False)
+    assert (seq.dtype == np.uint16) and equal(seq.arr,ref.sum(axis=-1,dtype=np.uint16))
+    seq = ImageSequence(d,use_magick=False,monochrome=False)
+    assert equal(seq.arr,np.moveaxis(np.roll(ref,2,3),3,1))
+    assert (seq.width, seq.height) == (W,H)
+
+    # Many files on few file descriptors: only one file is open per task at a time
+    try:
+        import resource
+    except ImportError:
+        return
+    ref = random_frames((300,2,3),255)
+    d = os.path.join(tmp,'many')
+    os.mkdir(d)
+    for i in range(len(ref)): write_tiff(os.path.join(d,'f%04i.tif' % i),[ref[i]])
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,(min(64,hard),hard))
+    try:
+        seq = ImageSequence(d,use_magick=False,IO_threads=1)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE,(soft,hard))
+    assert equal(seq.arr,ref.astype(np.uint16))
+
+##########################################################################################
+def probe_tests(tmp):
+    """ probe gives the shape and dtype of a load without reading the pixels """
+    N, H, W = 6, 4, 8
+    ref = random_frames((N,H,W),4095)
+    files = write_chronos(tmp,ref)
+    cases = [(fn,dict(rawtype=rawtype,width=W,height=H)) for rawtype, fn in files.items()]
+    fn = os.path.join(tmp,'mono12.mraw')
+    with open(fn,'wb') as f: f.write(pack12(ref.ravel(),msb_first=True))
+    write_cih(os.path.join(tmp,'mono12.cih'),W,H,N)
+    cases.append((fn,{}))
+    fn = os.path.join(tmp,'blocks.b16dat')
+    write_b16(fn,ref)
+    cases.append((fn,{}))
+    cases.append((write_tiff_sequence(os.path.join(tmp,'seq'),ref),dict(use_magick=False)))
+    for fn, kw in cases:
+        for sel in ({},dict(frames=[4,1]),dict(roi=(0,1,3,6),frames=(2,5))):
+            info = probe(fn,**sel,**kw)
+            seq = ImageSequence(fn,**sel,**kw)
+            assert (info.shape() == seq.shape()) and (info.dtype == seq.dtype), (fn,sel)
+
+##########################################################################################
+def file_index_tests(tmp):
+    """ Directory listing: natural order, hidden files and the index file """
+    d = os.path.join(tmp,'listing')
+    os.mkdir(d)
+    for name in ('im_10.tif','im_2.tif','im_1.TIF','._im_1.tif','.hidden.tif','notes.txt'):
+        open(os.path.join(d,name),'w').close()
+    ext, files = file_index.list_directory(d,['.tif','.raw'])
+    assert ext == '.tif'
+    assert [os.path.basename(f) for f in files] == ['im_1.TIF','im_2.tif','im_10.tif']
+    assert file_index.list_directory(d,['.raw']) == (None,[])
+
+    # The index is reused until the directory changes
+    scans = []
+    scan = file_index.__scan__
+    def counted_scan(path,extensions):
+        scans.append(path)
+        return scan(path,extensions)
+    file_index.__scan__ = counted_scan
+    try:
+        for index in (os.path.join(tmp,'listing.idx'),True):
+            del scans[:]
+            assert file_index.list_directory(d,['.tif'],index)[1] == files
+            assert file_index.list_directory(d,['.tif'],index)[1] == files
+            assert len(scans) == 1, index
+        time.sleep(0.01)
+        open(os.path.join(d,'im_3.tif'),'w').close()
+        assert len(file_index.list_directory(d,['.tif'],True)[1]) == 4
+
+        # A file added while the directory is scanned is found next time
+        def racing_scan(path,extensions):
+            listing = scan(path,extensions)
+            time.sleep(0.01)
+            open(os.path.join(path,'im_4.tif'),'w').close()
+            return listing
+        file_index.__scan__ = racing_scan
+        os.remove(os.path.join(d,file_index.INDEX_NAME))
+        assert len(file_index.list_directory(d,['.tif'],True)[1]) == 4
+        file_index.__scan__ = scan
+        assert len(file_index.list_directory(d,['.tif'],True)[1]) == 5
+    finally:
+        file_index.__scan__ = scan
+
+##########################################################################################
+def disk_cache_tests(tmp):
+    """ Decoded frames are cached on disk until the data or header changes """
+    N, H, W = 5, 4, 8
+    ref = random_frames((N,H,W),4095)
+    fn = os.path.join(tmp,'sample.mraw')
+    with open(fn,'wb') as f: f.write(pack12(ref.ravel(),msb_first=True))
+    write_cih(os.path.join(tmp,'sample.cih'),W,H,N)
+    cache = os.path.join(tmp,'cache')
+    assert equal(ImageSequence(fn,cache_dir=cache).arr,ref)
+    assert len([f for f in os.listdir(cache) if f.endswith('.npy')]) == 1
+    assert equal(ImageSequence(fn,cache_dir=cache).arr,ref)
+    time.sleep(0.01)
+    write_cih(os.path.join(tmp,'sample.cih'),W,H,3)
+    assert equal(ImageSequence(fn,cache_dir=cache).arr,ref[:3])
+    time.sleep(0.01)
+    with open(fn,'r+b') as f: f.write(b'\0'*6)
+    ref[0,0,:4] = 0
+    assert equal(ImageSequence(fn,cache_dir=cache).arr,ref[:3])
+    frame_cache.evict(cache,0)
+    assert len(os.listdir(cache)) == 0
+
+##########################################################################################
+def chunk_cache_tests(tmp):
+    """ In-memory LRU chunk cache, and its use by LazyFrameArray """
+    cache = ChunkCache(100)
+    for i in range(4): cache.put(('a',i),np.zeros(40,np.uint8))
+    assert (len(cache) == 2) and (cache.nbytes == 80) and (cache.get(('a',0)) is None)
+    assert cache.get(('a',3)) is not None
+    cache.drop('a')
+    assert (len(cache) == 0) and (cache.nbytes == 0)
+
+    ref = random_frames((40,3,4),65535)
+    reads = []
+    def read_frames(frames):
+        if isinstance(frames,tuple): frames = list(range(*frames))
+        reads.append(len(frames))
+        return ref[frames].copy()
+    arr = LazyFrameArray(read_frames,*ref.shape[:1],ref.shape[1:],ref.dtype)
+    assert equal(arr[5],ref[5])
+    hits, nreads = arr.cache_hits, len(reads)
+    assert equal(arr[6],ref[6]) and (arr.cache_hits == hits+1) and (len(reads) == nreads)
+    assert equal(arr[::-1],ref[::-1])
+    hits = arr.cache_hits
+    assert equal(arr[[30,2]],ref[[30,2]]) and (arr.cache_hits == hits+2)
+
+##########################################################################################
+def movie_tests(tmp):
+    """ Colour movie size, levels, crop and frame selection """
+    N, H, W = 6, 48, 64
+    fn = write_movie(os.path.join(tmp,'colour.mp4'),N,H,W)
+    if fn is None: return
+    for lazy in (False,True):
+        seq = ImageSequence(fn,monochrome=False,lazy=lazy)
+        assert (seq.shape() == (N,H,W,3)) and ((seq.width, seq.height) == (W,H))
+        levels = np.asarray(seq.arr)[:,H//2,W//2,0].astype(int)
+        assert np.all(np.abs(levels-np.arange(N)*40) <= 4), levels
+        sel = ImageSequence(fn,monochrome=False,lazy=lazy,frames=[5,1,1])
+        assert equal(np.asarray(sel.arr),np.asarray(seq.arr)[[5,1,1]])
+        idx = [c[0] for c in seq.iter_chunks(2,slice(0,None,3))]
+        assert idx == [0]
+        seq.crop(2,11,4,23)
+        assert (seq.shape() == (N,10,20,3)) and ((seq.width, seq.height) == (20,10))
+        seq.mask_box(0,1,0,1,fillValue=255)
+        assert np.all(np.asarray(seq.arr)[:,0:2,0:2,:] == 255)
+    assert probe(fn,monochrome=False).shape() == (N,H,W,3)
+
+##########################################################################################
+def parallel_movie_tests(tmp):
+    """ Movie segments decoded in parallel give the same frames as one pass """
+    N, H, W = 6, 16, 24
+    fn = write_movie(os.path.join(tmp,'colour.mp4'),N,H,W)
+    if fn is None: return
+    serial = ImageSequence(fn,monochrome=False).arr
+    for frames in (None,[5,0,2,3],slice(1,None,2)):
+        idx = frame_select.frame_indices(frames,N)
+        for nthreads in (2,3):
+            seq = ImageSequence(fn,monochrome=False,frames=frames,nthreads=nthreads)
+            assert equal(seq.arr,serial[idx]), (frames,nthreads)
+
+##########################################################################################
+def movie_count_tests(tmp):
+    """ Movie frame count from the container header, the packets or the metadata """
+    N, H, W = 6, 16, 24
+    fn = write_movie(os.path.join(tmp,'colour.mp4'),N,H,W)
+    if fn is None: return
+    from pySciCam import movie_handler
+    assert movie_handler.movie_frame_count(fn) == N
+    info = movie_handler.movie_info(fn,packets=True)
+    assert (info['nframes'] == N) and (len(info['times']) == N) and (info['keyframes'][0] == 0)
+
+    container_count = movie_handler.__container_frame_count__
+    packet_index = movie_handler.__packet_index__
+    def unlisted(filename): raise AssertionError("packets listed although the header has a count")
+    def unparsed(filename): raise ValueError("invalid literal for int() with base 10: 'NOPTS'")
+    try:
+        # Packets are not listed when the container gives the count
+        movie_handler.__container_frame_count__ = lambda filename: (N,False)
+        movie_handler.__packet_index__ = unlisted
+        movie_handler.__info_cache__.clear()
+        info = movie_handler.movie_info(fn)
+        assert (info['nframes'] == N) and (len(info['times']) == N) and (info['keyframes'] is None)
+        seq = ImageSequence(fn,monochrome=False,frames=[4,1])
+        assert np.all(np.abs(seq.arr[:,H//2,W//2,0].astype(int)-[160,40]) <= 4)
+        # Estimated from the metadata if there is no count and the packets can't be parsed
+        movie_handler.__container_frame_count__ = lambda filename: (None,False)
+        movie_handler.__packet_index__ = unparsed
+        movie_handler.__info_cache__.clear()
+        assert movie_handler.movie_frame_count(fn) == N
+    finally:
+        movie_handler.__container_frame_count__ = container_count
+        movie_handler.__packet_index__ = packet_index
+        movie_handler.__info_cache__.clear()
+
+    # Header fields as ffprobe prints them, without nb_frames
+    if os.name != 'posix': return
+    ffprobe = os.path.join(tmp,'ffprobe')
+    with open(ffprobe,'w') as f:
+        f.write("#!/bin/sh\nprintf 'r_frame_rate=10/1\\navg_frame_rate=10/1\\ntime_base=1/10240\\n")
+        f.write("duration_ts=%i\\nnb_frames=N/A\\n'\n" % (N*1024))
+    os.chmod(ffprobe,0o755)
+    path = os.environ['PATH']
+    os.environ['PATH'] = tmp+os.pathsep+path
+    try:
+        assert container_count(fn) == (N,False)
+    finally:
+        os.environ['PATH'] = path
+
+##########################################################################################
+def mono_movie_tests(tmp):
+    """ Monochrome movies are the sum of the colour channels """
+    N, H, W = 6, 16, 24
+    fn = write_movie(os.path.join(tmp,'colour.mp4'),N,H,W)
+    if fn is None: return
+    colour = ImageSequence(fn,monochrome=False).arr
+    for nthreads in (1,2):
+        seq = ImageSequence(fn,monochrome=True,nthreads=nthreads)
+        assert (seq.dtype == np.uint16) and equal(seq.arr,colour.sum(axis=-1,dtype=np.uint16))
+        seq = ImageSequence(fn,monochrome=True,nthreads=nthreads,roi=(2,9,3,12),frames=[4,0])
+        assert equal(seq.arr,colour[[4,0],2:10,3:13].sum(axis=-1,dtype=np.uint16))
+
+##########################################################################################
+def bayer_tests(tmp):
+    """ Thread-parallel Bayer decoding against the frame-by-frame wrapper """
+    from pySciCam import bayer_decode
+    from ctypes import c_uint, c_uint32
+    for dtype, maxval in ((np.uint8,255),(np.uint16,4095)):
+        mosaic = random_frames((5,8,12),maxval).astype(dtype)
+        for method in ('DC1394_BAYER_METHOD_NEAREST','DC1394_BAYER_METHOD_BILINEAR',\
+                       'DC1394_BAYER_METHOD_DOWNSAMPLE'):
+            m = bayer_decode.dc1394bayer_methods.index(method)
+            nx, ny = mosaic.shape[1:]
+            if 'DOWNSAMPLE' in method: nx, ny = nx//2, ny//2
+            ref = bayer_decode.__libbayer_wrapper__(mosaic,c_uint(512+1),c_uint(m),\
+                                c_uint32(8*np.dtype(dtype).itemsize),nx,ny)
+            for ncpus, backend in ((1,'threads'),(3,'threads'),(2,'serial'),(2,'processes')):
+                rgb = bayer_decode.fbayerDecode(mosaic,method,'DC1394_COLOR_FILTER_GBRG',\
+                                                ncpus=ncpus,IO_backend=backend,quiet=1)
+                assert equal(rgb,ref), (dtype,method,ncpus,backend)
+            # Frames are written into a slice of a preallocated array
+            out = np.zeros_like(ref)
+            bayer_decode.__libbayer_wrapper__(mosaic[1:3],c_uint(512+1),c_uint(m),\
+                                c_uint32(8*np.dtype(dtype).itemsize),nx,ny,out[1:3])
+            assert equal(out[1:3],ref[1:3]) and not np.any(out[[0,3,4]]), (dtype,method)
+
+##########################################################################################
+def batched_bayer_tests(tmp):
+    """ Batched libbayer decoder: strided input and output, OpenMP threads """
+    from pySciCam import bayer_decode
+    from ctypes import c_uint, c_uint32
+    libbayer = bayer_decode.__load_libbayer__()
+    for dtype, maxval in ((np.uint8,255),(np.uint16,4095)):
+        bits = 8*np.dtype(dtype).itemsize
+        batched = getattr(libbayer,'dc1394_bayer_decoding_%ibit_frames' % bits,None)
+        if batched is None:
+            print("Skipping batched Bayer tests: libbayer has no batched decoder")
+            return
+        mosaic = random_frames((6,8,12),maxval).astype(dtype)
+        m = bayer_decode.dc1394bayer_methods.index('DC1394_BAYER_METHOD_BILINEAR')
+        ref = bayer_decode.__libbayer_wrapper__(mosaic,c_uint(512+1),c_uint(m),c_uint32(bits),8,12)
+        # Strided input is read in place
+        strided = np.concatenate([mosaic,mosaic],axis=2)[...,:12]
+        for nthreads in (1,4):
+            out = np.zeros_like(ref)
+            bayer_decode.__libbayer_frames__(batched,strided,out,c_uint(512+1),c_uint(m),\
+                                             c_uint32(bits),nthreads)
+            assert equal(out,ref), (dtype,nthreads)
+        # Strided output, ie. every other frame of a larger array
+        out = np.zeros((12,)+ref.shape[1:],dtype)
+        bayer_decode.__libbayer_frames__(batched,mosaic,out[::2],c_uint(512+1),c_uint(m),\
+                                         c_uint32(bits),2)
+        assert equal(out[::2],ref) and not np.any(out[1::2]), dtype
+        rgb = bayer_decode.fbayerDecode(strided,'DC1394_BAYER_METHOD_BILINEAR',\
+                                        'DC1394_COLOR_FILTER_GBRG',ncpus=3,quiet=1)
+        assert equal(rgb,ref), dtype
+
+##########################################################################################
+def deferred_bayer_tests(tmp):
+    """ Deferred Bayer decoding gives the same colour frames as decoding on load """
+    N, H, W = 4, 6, 8
+    ref = random_frames((N,H,W),65535)
+    fn = os.path.join(tmp,'color.raw')
+    with open(fn,'wb') as f: f.write(ref.astype('<u2').tobytes())
+    kw = dict(rawtype='chronos14_color_16bit',width=W,height=H)
+    seq = ImageSequence(fn,**kw)
+    assert seq.shape() == (N,3,H,W)
+    deferred = ImageSequence(fn,defer_bayer=True,**kw)
+    assert isinstance(deferred.arr,LazyFrameArray) and (deferred.shape() == seq.shape())
+    assert equal(deferred.arr[[3,1]],seq.arr[[3,1]])
+    assert equal(np.asarray(deferred.arr),seq.arr)
+
+##########################################################################################
+tests = [chronos_unpack_tests, threaded_unpack_tests, memmap_tests, lazy_tests,\
+         iter_chunks_tests, b16_tests, photron_cih_tests, frame_select_tests,\
+         frame_pushdown_tests, roi_tests, out_tests, tiff_sequence_tests,\
+         io_backend_tests, multipage_tiff_tests, tiff_strip_tests, probe_tests,\
+         file_index_tests, disk_cache_tests, chunk_cache_tests, movie_tests,\
+         parallel_movie_tests, movie_count_tests, mono_movie_tests, bayer_tests,\
+         batched_bayer_tests, deferred_bayer_tests]
+
+def run_synthetic_tests():
+    """ Run each test in its own temporary directory. Returns (passed, total). """
+    passed = 0
+    failed = []
+    for test in tests:
+        print("\n*** %s ***" % test.__name__)
+        tmp = tempfile.mkdtemp(prefix='pySciCam_test_')
+        try:
+            test(tmp)
+            passed += 1
+        except Exception:
+            traceback.print_exc()
+            failed.append(test.__name__)
+        finally:
+            shutil.rmtree(tmp,ignore_errors=True)
+    print('*'*80)
+    for name in failed: print("FAILED: %s" % name)
+    return passed, len(tests)
+
+
+#################################
+if __name__=='__main__':
+    """ Run the tests when the synthetic_tests.py script is invoked from command line """
+    p,n = run_synthetic_tests()
+    print("Passed %i of %i synthetic data tests" % (p,n))
+    sys.exit(0 if p == n else 1)